@@ -5,11 +5,18 @@
 #
 from __future__ import with_statement
 
+import codecs
+from collections import OrderedDict, deque
+import importlib
+import mmap
 import os
 import re
 import shutil
+import threading
 import urllib
 
+__version__ = '1.6'
+
 
 class UnicodeException(Exception):
     def __str__(self):
@@ -134,6 +141,33 @@ class DocProvider(object):
         wluri = wluri(uri)
         return self.by_slug(wluri.slug)
 
+    def by_slugs(self, slugs):
+        """Returns a dict of file-like objects for many slugs at once.
+
+        Providers which can fetch documents in bulk should override it.
+        """
+        return dict((slug, self.by_slug(slug)) for slug in slugs)
+
+    def mtime_by_slug(self, slug):
+        """Should return the document's modification time, or None if unknown."""
+        return None
+
+    def mtime_by_uri(self, uri, wluri=WLURI):
+        wluri = wluri(uri)
+        return self.mtime_by_slug(wluri.slug)
+
+    def document_by_uri(self, uri, doc_class, **kwargs):
+        """Returns a parsed document (like a WLDocument) for the URI."""
+        f = self.by_uri(uri)
+        try:
+            return doc_class.from_file(f, provider=self, **kwargs)
+        finally:
+            f.close()
+
+    def prefetch(self, uris, doc_class, **kwargs):
+        """Hints that documents will soon be needed. Does nothing by default."""
+        pass
+
 
 class DirDocProvider(DocProvider):
     """ Serve docs from a directory of files in form <slug>.xml """
@@ -146,6 +180,158 @@ class DirDocProvider(DocProvider):
         fname = slug + '.xml'
         return open(os.path.join(self.dir, fname))
 
+    def mtime_by_slug(self, slug):
+        return os.path.getmtime(os.path.join(self.dir, slug + '.xml'))
+
+
+class CachingDocProvider(DocProvider):
+    """Wraps a DocProvider, remembering the documents parsed from it.
+
+    Up to max_documents documents are kept (all of them if it's None),
+    least recently used are dropped first. A document is parsed again
+    when the wrapped provider reports a different modification time.
+    Callers get forks of the kept documents, so they can modify them.
+    Converters use whatever provider the document has, so caching is
+    for callers that open the same documents many times to set up.
+
+    With prefetch_workers, documents passed to prefetch(), like by
+    WLDocument.parts(prefetch=True), are parsed in that many background
+    threads. No more than prefetch_workers of them are parsed ahead of
+    being asked for, the rest wait in a queue.
+    """
+
+    def __init__(self, provider, max_documents=16, prefetch_workers=0):
+        self.provider = provider
+        self.max_documents = max_documents
+        self.prefetch_workers = prefetch_workers
+        self.documents = OrderedDict()
+        self.pending = {}
+        self.queue = deque()
+        self.pool = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        """Pickles the settings only, the copy starts with an empty cache."""
+        return self.provider, self.max_documents, self.prefetch_workers
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def by_slug(self, slug):
+        return self.provider.by_slug(slug)
+
+    def by_uri(self, uri, wluri=WLURI):
+        return self.provider.by_uri(uri, wluri)
+
+    def by_slugs(self, slugs):
+        return self.provider.by_slugs(slugs)
+
+    def mtime_by_uri(self, uri, wluri=WLURI):
+        return self.provider.mtime_by_uri(uri, wluri)
+
+    def _key(self, uri, doc_class, kwargs):
+        return (unicode(uri), doc_class, repr(sorted(kwargs.items())))
+
+    def _parse(self, uri, doc_class, kwargs, mtime=None):
+        if mtime is None:
+            mtime = self.mtime_by_uri(uri)
+        return mtime, super(CachingDocProvider, self).document_by_uri(
+                uri, doc_class, **kwargs)
+
+    def prefetch(self, uris, doc_class, **kwargs):
+        with self.lock:
+            uris = [uri for uri in uris
+                    if self._key(uri, doc_class, kwargs) not in self.pending
+                    and self._key(uri, doc_class, kwargs) not in self.documents]
+        # The wrapped provider may fetch them all at once.
+        self.provider.prefetch(uris, doc_class, **kwargs)
+        if not self.prefetch_workers:
+            return
+        with self.lock:
+            if self.pool is None:
+                from multiprocessing.pool import ThreadPool
+                self.pool = ThreadPool(self.prefetch_workers)
+            # Parts of a part are needed before the rest of the book's.
+            self.queue.extendleft(reversed(
+                [(uri, doc_class, kwargs) for uri in uris]))
+            self._schedule()
+
+    def _schedule(self):
+        """Starts parsing queued documents, up to prefetch_workers at once.
+
+        Must be called with the lock held.
+        """
+        while self.queue and self.pool is not None and \
+                len(self.pending) < self.prefetch_workers:
+            uri, doc_class, kwargs = self.queue.popleft()
+            key = self._key(uri, doc_class, kwargs)
+            if key not in self.pending and key not in self.documents:
+                self.pending[key] = self.pool.apply_async(
+                        self._parse, (uri, doc_class, kwargs))
+
+    def _collect(self):
+        """Moves prefetched documents into the cache.
+
+        Failed ones are left pending, for their errors to be raised when
+        they're asked for. Must be called with the lock held.
+        """
+        for key, result in self.pending.items():
+            if result.ready() and result.successful():
+                del self.pending[key]
+                self.documents[key] = result.get()
+                self.misses += 1
+        self._trim()
+
+    def _trim(self):
+        if self.max_documents is not None:
+            while len(self.documents) > self.max_documents:
+                self.documents.popitem(last=False)
+
+    def document_by_uri(self, uri, doc_class, **kwargs):
+        key = self._key(uri, doc_class, kwargs)
+        with self.lock:
+            pending = self.pending.pop(key, None)
+            cached = self.documents.pop(key, None)
+            self._schedule()
+        if pending is not None:
+            # Errors are raised here, in the same order as without prefetching.
+            cached = pending.get()
+            self.misses += 1
+        else:
+            # Asked for once, as it may take a request.
+            mtime = self.mtime_by_uri(uri) if cached is not None else None
+            if cached is not None and cached[0] == mtime:
+                self.hits += 1
+            else:
+                self.misses += 1
+                cached = self._parse(uri, doc_class, kwargs, mtime)
+        with self.lock:
+            self.documents[key] = cached
+            self._trim()
+        return cached[1].fork()
+
+    def clear(self):
+        with self.lock:
+            self.documents.clear()
+            self.pending.clear()
+            self.queue.clear()
+
+    def close(self):
+        """Stops the prefetching threads, if any.
+
+        Documents they've parsed are kept, the rest are dropped.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        with self.lock:
+            self._collect()
+            self.pending.clear()
+            self.queue.clear()
+
 
 import lxml.etree as etree
 import dcparser
@@ -187,14 +373,13 @@ def wrap_text(ocrtext, creation_date, bookinfo=DEFAULT_BOOKINFO):
 
 
 def serialize_raw(element):
-    b = u'' + (element.text or '')
+    b = [element.text or u'']
 
     for child in element.iterchildren():
-        e = etree.tostring(child, method='xml', encoding=unicode,
-                pretty_print=True)
-        b += e
+        b.append(etree.tostring(child, method='xml', encoding=unicode,
+                pretty_print=True))
 
-    return b
+    return u''.join(b)
 
 SERIALIZERS = {
     'raw': serialize_raw,
@@ -207,6 +392,174 @@ def get_resource(path):
     return os.path.join(os.path.dirname(__file__), path)
 
 
+class XSLTCache(object):
+    """Registry of compiled XSLT stylesheets, shared by all converters.
+
+    Stylesheets are keyed by their path and compiled again only
+    when the file's modification time changes.
+    """
+
+    def __init__(self):
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """Returns a compiled etree.XSLT for the stylesheet at path."""
+        path = os.path.abspath(path)
+        mtime = os.path.getmtime(path)
+        cached = self._cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        xslt = etree.XSLT(etree.parse(path))
+        self._cache[path] = (mtime, xslt)
+        return xslt
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._cache)}
+
+XSLT_CACHE = XSLTCache()
+
+def get_xslt(path):
+    """Returns a compiled XSLT stylesheet from the shared cache."""
+    return XSLT_CACHE.get(path)
+
+
+_resources = {}
+
+def read_resource(path):
+    """Returns the contents of a resource file, read once per process."""
+    try:
+        return _resources[path]
+    except KeyError:
+        with open(get_resource(path), 'rb') as f:
+            data = _resources[path] = f.read()
+        return data
+
+
+# Modules doing the conversion to each format.
+WARMUP_MODULES = {
+    'html': 'html',
+    'txt': 'text',
+    'epub': 'epub',
+    'mobi': 'epub',
+    'pdf': 'pdf',
+    'fb2': 'fb2',
+}
+
+def warmup(formats=None, languages=('pol',)):
+    """Loads everything the converters need ahead of time.
+
+    Meant to be called before forking worker processes, so that they
+    share compiled stylesheets, hyphenation dictionaries, fonts and
+    resource files copy-on-write. Formats default to all those whose
+    dependencies are installed. Languages are codes (ISO 639-2 or 639-1)
+    of hyphenation dictionaries to load.
+    """
+    if formats is None:
+        names, strict = set(WARMUP_MODULES.values()), False
+    else:
+        names, strict = set(WARMUP_MODULES[f] for f in formats), True
+    for name in sorted(names):
+        try:
+            module = importlib.import_module('librarian.' + name)
+        except ImportError:
+            if strict:
+                raise
+            continue
+        module.warmup(languages)
+
+
+_thread_data = threading.local()
+FEED_CHUNK_SIZE = 1 << 16
+
+def get_xml_parser():
+    """Returns an XMLParser reused by all document loads in this thread."""
+    try:
+        return _thread_data.parser
+    except AttributeError:
+        parser = _thread_data.parser = etree.XMLParser(remove_blank_text=False)
+        return parser
+
+
+def parse_xml_string(data, offset=0):
+    """Parses XML from a byte string or a buffer (like a mmap).
+
+    Only data[offset:] is parsed. Byte order marks are removed anywhere
+    in the data, like the unicode-level replace used to. Data is copied
+    only if it has some.
+    """
+    if data.find(codecs.BOM_UTF8, offset) != -1:
+        data = bytes(data[offset:]).replace(codecs.BOM_UTF8, '')
+        offset = 0
+    parser = get_xml_parser()
+    if isinstance(data, str):
+        if offset:
+            data = data[offset:]
+        return etree.fromstring(data, parser).getroottree()
+
+    try:
+        for start in xrange(offset, len(data), FEED_CHUNK_SIZE):
+            parser.feed(bytes(data[start:start + FEED_CHUNK_SIZE]))
+    except:
+        # Reset the parser, so it can be reused.
+        try:
+            parser.close()
+        except etree.XMLSyntaxError:
+            pass
+        raise
+    return parser.close().getroottree()
+
+
+def map_xml_file(source):
+    """Returns the contents of a path or a file-like object.
+
+    Regular files are memory-mapped, and the caller should close the
+    returned mmap. Otherwise a byte string is returned.
+    """
+    if isinstance(source, basestring):
+        with open(source, 'rb') as f:
+            return map_xml_file(f)
+
+    try:
+        fileno = source.fileno()
+        mappable = source.tell() == 0 and os.fstat(fileno).st_size > 0
+    except (AttributeError, IOError, OSError, ValueError):
+        mappable = False
+    if not mappable:
+        data = source.read()
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        return data
+    return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+
+def parse_xml_file(source):
+    """Parses XML from a path, a file-like object or an already parsed tree.
+
+    Regular files are memory-mapped and fed straight to the parser.
+    """
+    if isinstance(source, etree._ElementTree):
+        return source
+    if isinstance(source, etree._Element):
+        return source.getroottree()
+
+    data = map_xml_file(source)
+    try:
+        return parse_xml_string(data)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
 class OutputFile(object):
     """Represents a file returned by one of the converters."""
 
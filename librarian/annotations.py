@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""Dictionary of annotations harvested from many books.
+
+Annotations are kept in an SQLite database. Each distinct annotation
+(same type and HTML) is stored once and indexed by its headword, the
+text before the qualifiers and the em dash. Occurrences link it to
+the books it appears in.
+
+Books are identified by their file names without extension. A book is
+harvested again only when its source changes, and its old occurrences
+are then replaced, so the dictionary can be updated one book at a time.
+
+    index = AnnotationIndex('annotations.sqlite')
+    for path, error in index.update(glob.glob('books/*.xml'), processes=4):
+        ...
+    for row in index.lookup(u'gemajna'):
+        ...
+"""
+from __future__ import with_statement
+import hashlib
+import os.path
+import re
+import sqlite3
+
+import librarian
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS book (
+    slug TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS annotation (
+    id INTEGER PRIMARY KEY,
+    headword TEXT,
+    type TEXT NOT NULL,
+    qualifiers TEXT NOT NULL,
+    text TEXT NOT NULL,
+    html TEXT NOT NULL UNIQUE
+);
+CREATE INDEX IF NOT EXISTS annotation_headword ON annotation (headword);
+CREATE TABLE IF NOT EXISTS occurrence (
+    annotation_id INTEGER NOT NULL REFERENCES annotation (id),
+    book TEXT NOT NULL REFERENCES book (slug),
+    position INTEGER NOT NULL,
+    PRIMARY KEY (book, position)
+);
+CREATE INDEX IF NOT EXISTS occurrence_annotation ON occurrence (annotation_id);
+"""
+
+# Headword is what comes before the qualifiers and the em dash.
+RE_HEADWORD = re.compile(ur'\s*([^\u2014(]*?)\s*(?:\([^)]*\)\s*)?\u2014', re.UNICODE)
+
+
+def get_headword(text):
+    """Returns the lowercased headword of an annotation's text, or None."""
+    match = RE_HEADWORD.match(text)
+    if match and match.group(1):
+        return match.group(1).lower()
+    return None
+
+
+def book_slug(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def fingerprint(data):
+    """Identifies the source of a book and the librarian version used."""
+    digest = hashlib.sha1(librarian.__version__)
+    digest.update('\0')
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def harvest(path):
+    """Extracts annotations from a WL source file.
+
+    Returns (path, annotations, error), with annotations being tuples of
+    type, qualifiers, text and html, in the order they appear in.
+    Runs in worker processes, so errors are returned, not raised.
+    """
+    from librarian import html
+    from librarian.parser import WLDocument
+
+    try:
+        wldoc = WLDocument.from_file(path, parse_dublincore=False)
+        annotations = [(fn_type, qualifiers, text, html_str)
+            for anchor, fn_type, qualifiers, text, html_str
+            in html.iter_source_annotations(wldoc)]
+    except Exception, e:
+        # Like ValidationError for a wrong root; one book mustn't stop the run.
+        return path, None, unicode(e) or repr(e)
+    return path, annotations, None
+
+
+class AnnotationIndex(object):
+    """Headword-indexed, de-duplicated store of annotations."""
+
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def fingerprint(self, slug):
+        row = self.db.execute(
+            'SELECT fingerprint FROM book WHERE slug = ?', (slug,)).fetchone()
+        return row[0] if row else None
+
+    def store(self, slug, digest, annotations):
+        """Replaces the annotations of a book."""
+        with self.db:
+            old_ids = self._remove(slug)
+            self.db.execute('INSERT INTO book (slug, fingerprint) VALUES (?, ?)',
+                            (slug, digest))
+            for position, (fn_type, qualifiers, text, html_str) in enumerate(annotations):
+                self.db.execute(
+                    'INSERT OR IGNORE INTO annotation '
+                    '(headword, type, qualifiers, text, html) VALUES (?, ?, ?, ?, ?)',
+                    (get_headword(text), fn_type, u','.join(qualifiers), text, html_str))
+                self.db.execute(
+                    'INSERT INTO occurrence (annotation_id, book, position) '
+                    'SELECT id, ?, ? FROM annotation WHERE html = ?',
+                    (slug, position, html_str))
+            self._prune(old_ids)
+
+    def remove(self, slug):
+        """Removes a book and the annotations found only in it."""
+        with self.db:
+            self._prune(self._remove(slug))
+
+    def _remove(self, slug):
+        """Removes a book, returning ids of annotations it had."""
+        old_ids = [row[0] for row in self.db.execute(
+            'SELECT DISTINCT annotation_id FROM occurrence WHERE book = ?', (slug,))]
+        self.db.execute('DELETE FROM occurrence WHERE book = ?', (slug,))
+        self.db.execute('DELETE FROM book WHERE slug = ?', (slug,))
+        return old_ids
+
+    def _prune(self, ids):
+        """Removes those of the annotations that no book has any more."""
+        for annotation_id in ids:
+            self.db.execute(
+                'DELETE FROM annotation WHERE id = ? AND NOT EXISTS '
+                '(SELECT 1 FROM occurrence WHERE annotation_id = ?)',
+                (annotation_id, annotation_id))
+
+    def update(self, paths, processes=None, force=False):
+        """Harvests annotations from the books that changed.
+
+        Books are processed in a pool of worker processes, as many as
+        there are CPUs unless given; with processes=1 no pool is used.
+        Yields (path, error) for each harvested book, error being None
+        on success. Books with errors are left as they were.
+        """
+        todo = {}
+        for path in paths:
+            with open(path, 'rb') as f:
+                digest = fingerprint(f.read())
+            if force or digest != self.fingerprint(book_slug(path)):
+                todo[path] = digest
+        if not todo:
+            return
+
+        if processes == 1 or len(todo) == 1:
+            pool = None
+            results = (harvest(path) for path in todo)
+        else:
+            from multiprocessing import Pool
+
+            # Workers share the compiled stylesheets copy-on-write.
+            librarian.warmup(['html'], ())
+            pool = Pool(processes)
+            results = pool.imap_unordered(harvest, todo, chunksize=4)
+        try:
+            for path, annotations, error in results:
+                if error is None:
+                    self.store(book_slug(path), todo[path], annotations)
+                yield path, error
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def lookup(self, headword):
+        """Returns annotations with the given headword.
+
+        Each is a tuple of type, qualifiers list, text, html and the
+        number of its occurrences, most frequent first.
+        """
+        rows = self.db.execute(
+            'SELECT type, qualifiers, text, html, COUNT(*) AS n '
+            'FROM annotation JOIN occurrence ON annotation_id = id '
+            'WHERE headword = ? GROUP BY id ORDER BY n DESC, id',
+            (headword.lower(),))
+        return [(fn_type, qualifiers.split(u',') if qualifiers else [], text, html_str, n)
+                for fn_type, qualifiers, text, html_str, n in rows]
@@ -10,7 +10,6 @@ import optparse
 
 from librarian import DirDocProvider, ParseError
 from librarian.parser import WLDocument
-from librarian.cover import DefaultEbookCover
 
 
 class Option(object):
@@ -39,6 +38,7 @@ class Book2Anything(object):
     uses_cover = False # Can it add a cover?
     cover_optional = True # Only relevant if uses_cover
     uses_provider = False # Does it need a DocProvider?
+    header_only = False # Does it only need Dublin Core?
     transform = None # Transform method. Uses WLDocument.as_{ext} by default.
     parser_options = [] # List of Option objects for additional parser args.
     transform_options = [] # List of Option objects for additional transform args.
@@ -100,6 +100,7 @@ class Book2Anything(object):
             transform_args['verbose'] = True
         # Add cover support, if any.
         if cls.uses_cover:
+            from librarian.cover import DefaultEbookCover
             if options.image_cache:
                 def cover_class(*args, **kwargs):
                     return DefaultEbookCover(image_cache=options.image_cache, *args, **kwargs)
@@ -128,7 +129,8 @@ class Book2Anything(object):
                 output_file = None
 
             # Do the transformation.
-            doc = WLDocument.from_file(main_input, provider=provider, **parser_args)
+            doc = WLDocument.from_file(main_input, provider=provider,
+                    header_only=cls.header_only, **parser_args)
             transform = cls.transform
             if transform is None:
                 transform = getattr(WLDocument, 'as_%s' % cls.ext)
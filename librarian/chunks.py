@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""Batch access to chunks of a document, for editors.
+
+A chunk is an element addressed by a path like `./utwor/akap[3]`, as
+in WLDocument.chunk(): `tag[n]` is the n-th (from 0) child element,
+if it's a `tag`, and a plain `tag` is any child `tag`. A leading `.`
+starts from the document, otherwise paths start from the root element.
+"""
+import re
+
+from lxml import etree
+
+from librarian import serialize_children
+
+STEP = re.compile(r'([^\[]+)\[(\d+)\]')
+NAME = re.compile(r'^[^\[\]/.*@()=\'"\s]+$')
+
+
+def qualified_name(elem):
+    """The element's name, as XPath's name() would give it."""
+    if elem.prefix:
+        return '%s:%s' % (elem.prefix, etree.QName(elem).localname)
+    return etree.QName(elem).localname
+
+
+class ChunkIndex(object):
+    """Elements of a document, indexed by path.
+
+    Serves many chunk lookups without compiling XPath for each one.
+    Children of an element are indexed, in one pass, when a path first
+    leads through it. Paths with steps other than `tag` and `tag[n]`
+    are looked up with XPath. The index is dropped after merge(), but
+    it doesn't notice other changes to the tree.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self._elements = None
+
+    def _children(self, path):
+        """Returns child paths of the element at path, by name."""
+        children = self._by_name.get(path)
+        if children is None:
+            children = self._by_name[path] = {}
+            position = 0
+            for child in self._elements[path]:
+                if not isinstance(child.tag, basestring):
+                    continue
+                # Paths are kept as tuples of (name, position) steps.
+                child_path = path + ((qualified_name(child), position),)
+                self._elements[child_path] = child
+                children.setdefault(child_path[-1][0], []).append(child_path)
+                position += 1
+        return children
+
+    def _resolve(self, path):
+        """Returns the paths matching path, or None if it isn't indexable."""
+        if self._elements is None:
+            root = self.document.edoc.getroot()
+            self._root_path = ((qualified_name(root), 0),)
+            self._elements = {self._root_path: root}
+            self._by_name = {(): {self._root_path[0][0]: [self._root_path]}}
+        steps = path.split('/')
+        if steps[0] == '.':
+            current = [()]
+            steps = steps[1:]
+        else:
+            current = [self._root_path]
+        for step in steps:
+            match = STEP.match(step)
+            if match:
+                step = match.group(1), int(match.group(2))
+                for p in current:
+                    self._children(p)
+                current = [p + (step,) for p in current
+                           if p + (step,) in self._elements]
+            elif NAME.match(step):
+                current = [child for p in current
+                           for child in self._children(p).get(step, ())]
+            else:
+                return None
+        return current
+
+    def get(self, path):
+        """Returns the element at path, or None, like WLDocument.chunk()."""
+        paths = self._resolve(path)
+        if paths is None:
+            return self.document.chunk(path)
+        return self._elements[paths[0]] if paths else None
+
+    def serialize(self, paths, format='raw'):
+        """Serializes contents of many chunks.
+
+        Returns a dict mapping paths to serialized contents, or to None
+        for paths not found.
+        """
+        result = {}
+        for path in paths:
+            elem = self.get(path)
+            result[path] = None if elem is None else \
+                serialize_children(elem, format)
+        return result
+
+    def merge(self, chunk_dict):
+        """Replaces contents of many chunks, like WLDocument.merge_chunks().
+
+        All paths are looked up before the tree is changed. A chunk
+        inside another merged chunk isn't merged. Returns a list of
+        failures for the chunks that couldn't be merged.
+        """
+        unmerged = []
+        targets = []
+        keys = {}
+        for key, data in chunk_dict.iteritems():
+            try:
+                node = self.get(key)
+                if node is None:
+                    raise IndexError('list index out of range')
+            except Exception, e:
+                unmerged.append(repr(
+                    (key, self.document.path_to_xpath(key), e)))
+            else:
+                targets.append((node, key, data))
+                keys[node] = key
+
+        parser = etree.XMLParser()
+        replaced = False
+        for node, key, data in targets:
+            try:
+                for ancestor in node.iterancestors():
+                    if ancestor in keys:
+                        raise ValueError('Chunk inside another merged chunk: %s'
+                                         % keys[ancestor])
+                repl = etree.fromstring(u"<%s>%s</%s>" % (
+                    node.tag, data, node.tag), parser)
+                node.getparent().replace(node, repl)
+                self.document._touch(repl)
+                replaced = True
+            except Exception, e:
+                unmerged.append(repr(
+                    (key, self.document.path_to_xpath(key), e)))
+        if replaced:
+            self._elements = None
+        return unmerged
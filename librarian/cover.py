@@ -9,6 +9,18 @@ from StringIO import StringIO
 from librarian import get_resource, OutputFile, URLOpener
 
 
+_fonts = {}
+
+def get_font(path, size):
+    """Returns a TrueType font, loaded once per process."""
+    key = path, size
+    try:
+        return _fonts[key]
+    except KeyError:
+        font = _fonts[key] = ImageFont.truetype(path, size)
+        return font
+
+
 class Metric(object):
     """Gets metrics from an object, scaling it by a factor."""
     def __init__(self, obj, scale):
@@ -148,6 +160,14 @@ class Cover(object):
         elif scale:
             self.scale_after = scale
 
+    @classmethod
+    def warmup(cls, width=None, height=None):
+        """Loads the fonts used for a cover of the given size."""
+        scale = max(float(width or 0) / cls.width, float(height or 0) / cls.height)
+        metr = Metric(cls, scale if scale >= 1 else cls.scale)
+        get_font(cls.author_font_ttf, metr.author_font_size)
+        get_font(cls.title_font_ttf, metr.title_font_size)
+
     def pretty_author(self):
         """Allows for decorating author's name."""
         return self.author
@@ -177,7 +197,7 @@ class Cover(object):
             metr.height - top,
             )
             
-        author_font = ImageFont.truetype(
+        author_font = get_font(
             self.author_font_ttf, metr.author_font_size)
         tbox.text(self.pretty_author(), self.author_color, author_font,
             metr.author_lineskip, self.author_shadow)
@@ -189,7 +209,7 @@ class Cover(object):
             metr.width - metr.title_margin_left - metr.title_margin_right,
             metr.height - top,
             )
-        title_font = ImageFont.truetype(
+        title_font = get_font(
             self.title_font_ttf, metr.title_font_size)
         tbox.text(self.pretty_title(), self.title_color, title_font,
             metr.title_lineskip, self.title_shadow)
@@ -311,7 +331,7 @@ class WLCover(Cover):
 
         # Write author name.
         box = TextBox(metr.title_box_width, metr.height, padding_y=metr.box_padding_y)
-        author_font = ImageFont.truetype(
+        author_font = get_font(
             self.author_font_ttf, metr.author_font_size)
         box.text(self.pretty_author(),
                  font=author_font,
@@ -326,7 +346,7 @@ class WLCover(Cover):
         box.skip(metr.box_below_line)
 
         # Write title.
-        title_font = ImageFont.truetype(
+        title_font = get_font(
             self.title_font_ttf, metr.title_font_size)
         box.text(self.pretty_title(),
                  line_height=metr.title_lineskip,
@@ -20,7 +20,9 @@ class TextPlus(unicode):
     pass
 
 class DatePlus(date):
-    pass
+    def __reduce__(self):
+        # date pickles its value only, keep attributes like lang.
+        return type(self), (self.year, self.month, self.day), self.__dict__
 
 
 # ==============
@@ -326,6 +328,20 @@ class WorkInfo(object):
             self.fmap[field.name] = field
             if field.salias: self.fmap[field.salias] = field
 
+    def __getstate__(self):
+        """Pickles the already validated values, without the field map."""
+        state = dict(self.__dict__)
+        del state['fmap']
+        return state
+
+    def __setstate__(self, state):
+        fmap = {}
+        for field in self.FIELDS:
+            fmap[field.name] = field
+            if field.salias: fmap[field.salias] = field
+        object.__setattr__(self, 'fmap', fmap)
+        self.__dict__.update(state)
+
     def __getattribute__(self, name):
         try:
             field = object.__getattribute__(self, 'fmap')[name]
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""On-disk cache of parsed documents.
+
+Entries are keyed by a hash of the source bytes, the librarian version
+and the parsing options. Each entry holds the serialized tree, so
+loading a document from a warm cache only maps the entry into memory and
+rebuilds the tree. Dublin Core is parsed again from the tree, so entries
+are just XML and no code is ever loaded from the cache directory.
+
+To use it, set it as the default for all documents:
+
+    WLDocument.cache = DocumentCache('/var/cache/librarian')
+
+or pass `cache=` to `WLDocument.from_file`. Pass `cache=False`
+to skip the cache for a single call.
+"""
+from __future__ import with_statement
+import hashlib
+import mmap
+import os
+from tempfile import NamedTemporaryFile
+
+from lxml import etree
+
+import librarian
+from librarian import parse_xml_string
+
+MAGIC = 'WLC2'
+EXT = '.wlc'
+
+
+class DocumentCache(object):
+    """Stores parsed documents in a directory, evicting least recently used."""
+
+    def __init__(self, dir_, max_size=256 * 1024 * 1024):
+        self.dir = dir_
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(dir_):
+            os.makedirs(dir_)
+
+    def key(self, data, parse_dublincore, strict, meta_fallbacks):
+        """Computes the entry key for source data and parsing options."""
+        options = repr((librarian.__version__, bool(parse_dublincore),
+                        bool(strict), sorted((meta_fallbacks or {}).items())))
+        digest = hashlib.sha1(options)
+        digest.update('\0')
+        digest.update(data)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dir, key + EXT)
+
+    def load(self, doc_class, source, parse_dublincore=True, provider=None,
+             strict=False, meta_fallbacks=None):
+        """Returns a doc_class instance for source, using the cache if possible.
+
+        Only paths and regular files can be cached; other sources
+        are just parsed.
+        """
+        kwargs = dict(parse_dublincore=parse_dublincore, provider=provider,
+                      strict=strict, meta_fallbacks=meta_fallbacks)
+        if isinstance(source, basestring):
+            with open(source, 'rb') as f:
+                return self.load(doc_class, f, **kwargs)
+        try:
+            fileno = source.fileno()
+            mapped = (source.tell() == 0 and os.fstat(fileno).st_size > 0 and
+                      mmap.mmap(fileno, 0, access=mmap.ACCESS_READ))
+        except (AttributeError, IOError, OSError, ValueError):
+            mapped = None
+        if not mapped:
+            return doc_class.from_file(source, cache=False, **kwargs)
+
+        try:
+            key = self.key(mapped, parse_dublincore, strict, meta_fallbacks)
+            doc = self.get(doc_class, key, **kwargs)
+            if doc is None:
+                doc = doc_class.from_bytes(mapped, **kwargs)
+                self.put(key, doc)
+            return doc
+        finally:
+            mapped.close()
+
+    def get(self, doc_class, key, parse_dublincore=True, provider=None,
+            strict=False, meta_fallbacks=None):
+        """Rebuilds a document from an entry, or returns None on a miss.
+
+        Any entry which can't be loaded is a miss, and is removed.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        try:
+            if entry[:len(MAGIC)] != MAGIC:
+                raise ValueError('Not a document cache entry.')
+            doc = doc_class(parse_xml_string(entry, len(MAGIC)),
+                            parse_dublincore=parse_dublincore,
+                            provider=provider, strict=strict,
+                            meta_fallbacks=meta_fallbacks)
+        except Exception:
+            self.misses += 1
+            self.discard(key)
+            return None
+        finally:
+            entry.close()
+
+        self.hits += 1
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return doc
+
+    def put(self, key, doc):
+        """Stores a freshly parsed document and evicts old entries."""
+        temp = NamedTemporaryFile(dir=self.dir, suffix='.tmp', delete=False)
+        try:
+            temp.write(MAGIC)
+            temp.write(etree.tostring(doc.edoc, encoding='utf-8'))
+            temp.close()
+            os.rename(temp.name, self.path(key))
+        except:
+            temp.close()
+            os.unlink(temp.name)
+            raise
+        self.evict()
+
+    def discard(self, key):
+        try:
+            os.unlink(self.path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_size."""
+        entries = []
+        total = 0
+        for fname in os.listdir(self.dir):
+            if not fname.endswith(EXT):
+                continue
+            try:
+                st = os.stat(os.path.join(self.dir, fname))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, fname in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.dir, fname))
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        for fname in os.listdir(self.dir):
+            if fname.endswith(EXT):
+                os.unlink(os.path.join(self.dir, fname))
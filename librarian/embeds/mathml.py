@@ -1,10 +1,10 @@
 from lxml import etree
-from librarian import get_resource
+from librarian import get_resource, get_xslt
 from . import TreeEmbed, create_embed, downgrades_to, converts_to
 
 class MathML(TreeEmbed):
     @downgrades_to('application/x-latex')
     def to_latex(self):
-        xslt = etree.parse(get_resource('res/embeds/mathml/mathml2latex.xslt'))
-        output = self.tree.xslt(xslt)
+        xslt = get_xslt(get_resource('res/embeds/mathml/mathml2latex.xslt'))
+        output = xslt(self.tree)
         return create_embed('application/x-latex', data=unicode(output))
@@ -16,33 +16,36 @@ import zipfile
 from tempfile import mkdtemp, NamedTemporaryFile
 from shutil import rmtree
 
-from librarian import RDFNS, WLNS, NCXNS, OPFNS, XHTMLNS, DCNS, OutputFile
-from librarian.cover import DefaultEbookCover
+from librarian import WLNS, NCXNS, OPFNS, XHTMLNS, DCNS, OutputFile
 
-from librarian import functions, get_resource
-
-from librarian.hyphenator import Hyphenator
+from librarian import functions, languages, get_resource, get_xslt, read_resource
 
 functions.reg_person_name()
 functions.reg_lang_code_3to2()
 
-
-def set_hyph_language(source_tree):
-    def get_short_lng_code(text):
-        result = ''
-        text = ''.join(text)
-        with open(get_resource('res/ISO-639-2_8859-1.txt'), 'rb') as f:
-            for line in f:
-                list = line.strip().split('|')
-                if list[0] == text:
-                    result = list[2]
-        if result == '':
-            return text
-        else:
-            return result
-    bibl_lng = etree.XPath('//dc:language//text()',
-                           namespaces={'dc': str(DCNS)})(source_tree)
-    short_lng = get_short_lng_code(bibl_lng[0])
+STYLESHEETS = (
+    'epub/xsltAnnotations.xsl',
+    'epub/xsltChunkTitle.xsl',
+    'epub/xsltContent.xsl',
+    'epub/xsltLast.xsl',
+    'epub/xsltScheme.xsl',
+    'epub/xsltTitle.xsl',
+)
+RESOURCES = (
+    'epub/cover.html',
+    'epub/emptyChunk.html',
+    'epub/support.html',
+    'epub/toc.html',
+)
+
+# Top-level elements used by title pages.
+TITLE_TAGS = ('autor_utworu', 'dzielo_nadrzedne', 'nazwa_utworu', 'podtytul')
+
+
+def get_hyphenator(language):
+    """Returns a Hyphenator for a language code, or None if there's no dictionary."""
+    from librarian.hyphenator import Hyphenator
+    short_lng = languages.lang_code_3to2(language)
     try:
         return Hyphenator(get_resource('res/hyph-dictionaries/hyph_' +
                                        short_lng + '.dic'))
@@ -50,9 +53,15 @@ def set_hyph_language(source_tree):
         pass
 
 
-def hyphenate_and_fix_conjunctions(source_tree, hyph):
+def set_hyph_language(source_tree):
+    bibl_lng = etree.XPath('//dc:language//text()',
+                           namespaces={'dc': str(DCNS)})(source_tree)
+    return get_hyphenator(bibl_lng[0])
+
+
+def hyphenate_and_fix_conjunctions(source_tree, hyph, path='/utwor/*[2]//text()'):
     if hyph is not None:
-        texts = etree.XPath('/utwor/*[2]//text()')(source_tree)
+        texts = etree.XPath(path)(source_tree)
         for t in texts:
             parent = t.getparent()
             newt = ''
@@ -112,8 +121,7 @@ def node_name(node):
 def xslt(xml, sheet):
     if isinstance(xml, etree._Element):
         xml = etree.ElementTree(xml)
-    with open(sheet) as xsltf:
-        return xml.xslt(etree.parse(xsltf))
+    return get_xslt(sheet)(xml)
 
 
 def replace_characters(node):
@@ -313,8 +321,7 @@ class TOC(object):
         return "\n".join(texts)
 
     def html(self):
-        with open(get_resource('epub/toc.html')) as f:
-            t = unicode(f.read(), 'utf-8')
+        t = unicode(read_resource('epub/toc.html'), 'utf-8')
         return t % self.html_part()
 
 
@@ -326,8 +333,12 @@ def used_chars(element):
     return chars
 
 
-def chop(main_text):
-    """ divide main content of the XML file into chunks """
+def chop(main_text, tags=None):
+    """ divide main content of the XML file into chunks
+
+    main_text can also be any iterable of top-level nodes,
+    if a list of their tags is given
+    """
 
     # prepare a container for each chunk
     part_xml = etree.Element('utwor')
@@ -339,8 +350,9 @@ def chop(main_text):
     # the below loop are workaround for a problem with epubs in drama ebooks without acts
     is_scene = False
     is_act = False
-    for one_part in main_text:
-        name = one_part.tag
+    if tags is None:
+        tags = [one_part.tag for one_part in main_text]
+    for name in tags:
         if name == 'naglowek_scena':
             is_scene = True
         elif name == 'naglowek_akt':
@@ -373,7 +385,7 @@ def chop(main_text):
     yield part_xml
 
 
-def transform_chunk(chunk_xml, chunk_no, annotations, empty=False, _empty_html_static=[]):
+def transform_chunk(chunk_xml, chunk_no, annotations, empty=False):
     """ transforms one chunk, returns a HTML string, a TOC object and a set of used characters """
 
     toc = TOC()
@@ -386,10 +398,8 @@ def transform_chunk(chunk_xml, chunk_no, annotations, empty=False, _empty_html_s
             subnumber = toc.add(node_name(element), "part%d.html" % chunk_no, level=1, is_part=False)
             element.set('sub', str(subnumber))
     if empty:
-        if not _empty_html_static:
-            _empty_html_static.append(open(get_resource('epub/emptyChunk.html')).read())
         chars = set()
-        output_html = _empty_html_static[0]
+        output_html = read_resource('epub/emptyChunk.html')
     else:
         find_annotations(annotations, chunk_xml, chunk_no)
         replace_by_verse(chunk_xml)
@@ -417,10 +427,56 @@ def transform(wldoc, verbose=False,
     def transform_file(wldoc, chunk_counter=1, first=True, sample=None):
         """ processes one input file and proceeds to its children """
 
-        replace_characters(wldoc.edoc.getroot())
+        toc, chunk_counter, chars, sample = transform_content(
+            wldoc, chunk_counter, first, sample)
 
-        hyphenator = set_hyph_language(wldoc.edoc.getroot())
-        hyphenate_and_fix_conjunctions(wldoc.edoc.getroot(), hyphenator)
+        # Parts are loaded one at a time, so release this file's tree
+        # before loading them.
+        wldoc.edoc = None
+        for child in wldoc.parts(prefetch=True):
+            child_toc, chunk_counter, chunk_chars, sample = transform_file(
+                child, chunk_counter, first=False, sample=sample)
+            toc.append(child_toc)
+            chars = chars.union(chunk_chars)
+            del child
+
+        return toc, chunk_counter, chars, sample
+
+    def transform_content(wldoc, chunk_counter, first, sample):
+        """ processes one input file, without its children """
+
+        lazy = wldoc.is_lazy
+        tree = wldoc.skeleton if lazy else wldoc.edoc
+        replace_characters(tree.getroot())
+
+        hyphenator = set_hyph_language(tree.getroot())
+        hyphenate_and_fix_conjunctions(tree.getroot(), hyphenator)
+
+        if first:
+            # The editorial page goes last, but the tree is released by then.
+            last_page.append(xslt(tree, get_resource('epub/xsltLast.xsl')))
+
+        if lazy:
+            # Main text is parsed in runs of nodes, which need the same
+            # fixes as the whole tree would get.
+            main_text = wldoc.main_text(tree)
+            in_hyphenated = main_text.getparent().index(main_text) == 1
+
+            def prepared(runs):
+                for run in runs:
+                    parent = run[0].getparent()
+                    replace_characters(parent)
+                    if in_hyphenated:
+                        hyphenate_and_fix_conjunctions(parent, hyphenator, './/text()')
+                    for node in run:
+                        yield node
+
+            # Title pages only need top-level header elements.
+            title_tree = deepcopy(tree)
+            wldoc.main_text(title_tree).extend(
+                prepared(wldoc.iter_body_runs(TITLE_TAGS)))
+        else:
+            title_tree = tree
 
         # every input file will have a TOC entry,
         # pointing to starting chunk
@@ -428,7 +484,7 @@ def transform(wldoc, verbose=False,
         chars = set()
         if first:
             # write book title page
-            html_tree = xslt(wldoc.edoc, get_resource('epub/xsltTitle.xsl'))
+            html_tree = xslt(title_tree, get_resource('epub/xsltTitle.xsl'))
             chars = used_chars(html_tree.getroot())
             zip.writestr(
                 'OPS/title.html',
@@ -445,9 +501,9 @@ def transform(wldoc, verbose=False,
             # write title page for every parent
             if sample is not None and sample <= 0:
                 chars = set()
-                html_string = open(get_resource('epub/emptyChunk.html')).read()
+                html_string = read_resource('epub/emptyChunk.html')
             else:
-                html_tree = xslt(wldoc.edoc, get_resource('epub/xsltChunkTitle.xsl'))
+                html_tree = xslt(title_tree, get_resource('epub/xsltChunkTitle.xsl'))
                 chars = used_chars(html_tree.getroot())
                 html_string = etree.tostring(
                     html_tree, pretty_print=True, xml_declaration=True,
@@ -460,57 +516,49 @@ def transform(wldoc, verbose=False,
             add_to_spine(spine, chunk_counter)
             chunk_counter += 1
 
-        if len(wldoc.edoc.getroot()) > 1:
-            # rdf before style master
-            main_text = wldoc.edoc.getroot()[1]
+        if lazy:
+            chunks = chop(prepared(wldoc.iter_body_runs()), wldoc.body_tags())
         else:
-            # rdf in style master
-            main_text = wldoc.edoc.getroot()[0]
-            if main_text.tag == RDFNS('RDF'):
-                main_text = None
-
-        if main_text is not None:
-            for chunk_xml in chop(main_text):
-                empty = False
-                if sample is not None:
-                    if sample <= 0:
-                        empty = True
-                    else:
-                        sample -= len(chunk_xml.xpath('//strofa|//akap|//akap_cd|//akap_dialog'))
-                chunk_html, chunk_toc, chunk_chars = transform_chunk(chunk_xml, chunk_counter, annotations, empty)
-
-                toc.extend(chunk_toc)
-                chars = chars.union(chunk_chars)
-                zip.writestr('OPS/part%d.html' % chunk_counter, chunk_html)
-                add_to_manifest(manifest, chunk_counter)
-                add_to_spine(spine, chunk_counter)
-                chunk_counter += 1
-
-        for child in wldoc.parts():
-            child_toc, chunk_counter, chunk_chars, sample = transform_file(
-                child, chunk_counter, first=False, sample=sample)
-            toc.append(child_toc)
+            main_text = wldoc.main_text(tree)
+            chunks = chop(main_text) if main_text is not None else ()
+
+        for chunk_xml in chunks:
+            empty = False
+            if sample is not None:
+                if sample <= 0:
+                    empty = True
+                else:
+                    sample -= len(chunk_xml.xpath('//strofa|//akap|//akap_cd|//akap_dialog'))
+            chunk_html, chunk_toc, chunk_chars = transform_chunk(chunk_xml, chunk_counter, annotations, empty)
+
+            toc.extend(chunk_toc)
             chars = chars.union(chunk_chars)
+            zip.writestr('OPS/part%d.html' % chunk_counter, chunk_html)
+            add_to_manifest(manifest, chunk_counter)
+            add_to_spine(spine, chunk_counter)
+            chunk_counter += 1
 
         return toc, chunk_counter, chars, sample
 
-    document = deepcopy(wldoc)
+    document = wldoc.fork()
     del wldoc
+    # Lazy documents are transformed without parsing all of the main text.
+    tree = document.skeleton if document.is_lazy else document.edoc
 
     if flags:
         for flag in flags:
-            document.edoc.getroot().set(flag, 'yes')
+            tree.getroot().set(flag, 'yes')
 
     # add editors info
     editors = document.editors()
     if editors:
-        document.edoc.getroot().set('editors', u', '.join(sorted(
+        tree.getroot().set('editors', u', '.join(sorted(
             editor.readable() for editor in editors)))
     if document.book_info.funders:
-        document.edoc.getroot().set('funders', u', '.join(
+        tree.getroot().set('funders', u', '.join(
             document.book_info.funders))
     if document.book_info.thanks:
-        document.edoc.getroot().set('thanks', document.book_info.thanks)
+        tree.getroot().set('thanks', document.book_info.thanks)
 
     opf = xslt(document.book_info.to_etree(), get_resource('epub/xsltContent.xsl'))
     manifest = opf.find('.//' + OPFNS('manifest'))
@@ -547,6 +595,7 @@ def transform(wldoc, verbose=False,
 
     if cover:
         if cover is True:
+            from librarian.cover import DefaultEbookCover
             cover = DefaultEbookCover
 
         cover_file = StringIO()
@@ -556,7 +605,7 @@ def transform(wldoc, verbose=False,
         zip.writestr(os.path.join('OPS', cover_name), cover_file.getvalue())
         del cover_file
 
-        cover_tree = etree.parse(get_resource('epub/cover.html'))
+        cover_tree = etree.ElementTree(etree.fromstring(read_resource('epub/cover.html')))
         cover_tree.find('//' + XHTMLNS('img')).set('src', cover_name)
         zip.writestr('OPS/cover.html', etree.tostring(
             cover_tree, pretty_print=True, xml_declaration=True,
@@ -567,9 +616,9 @@ def transform(wldoc, verbose=False,
 
         if bound_cover.uses_dc_cover:
             if document.book_info.cover_by:
-                document.edoc.getroot().set('data-cover-by', document.book_info.cover_by)
+                tree.getroot().set('data-cover-by', document.book_info.cover_by)
             if document.book_info.cover_source:
-                document.edoc.getroot().set('data-cover-source', document.book_info.cover_source)
+                tree.getroot().set('data-cover-source', document.book_info.cover_source)
 
         manifest.append(etree.fromstring(
             '<item id="cover" href="cover.html" media-type="application/xhtml+xml" />'))
@@ -598,6 +647,8 @@ def transform(wldoc, verbose=False,
             '<itemref idref="html_toc" />'))
         guide.append(etree.fromstring('<reference href="toc.html" type="toc" title="Spis treści"/>'))
 
+    last_page = []
+    del tree
     toc, chunk_counter, chars, sample = transform_file(document, sample=sample)
 
     if len(toc.children) < 2:
@@ -625,7 +676,7 @@ def transform(wldoc, verbose=False,
         '<item id="support" href="support.html" media-type="application/xhtml+xml" />'))
     spine.append(etree.fromstring(
         '<itemref idref="support" />'))
-    html_string = open(get_resource('epub/support.html')).read()
+    html_string = read_resource('epub/support.html')
     chars.update(used_chars(etree.fromstring(html_string)))
     zip.writestr('OPS/support.html', html_string)
 
@@ -634,7 +685,7 @@ def transform(wldoc, verbose=False,
         '<item id="last" href="last.html" media-type="application/xhtml+xml" />'))
     spine.append(etree.fromstring(
         '<itemref idref="last" />'))
-    html_tree = xslt(document.edoc, get_resource('epub/xsltLast.xsl'))
+    html_tree = last_page[0]
     chars.update(used_chars(html_tree.getroot()))
     zip.writestr('OPS/last.html', etree.tostring(
         html_tree, pretty_print=True, xml_declaration=True,
@@ -691,3 +742,15 @@ def transform(wldoc, verbose=False,
     zip.close()
 
     return OutputFile.from_filename(output_file.name)
+
+
+def warmup(languages=()):
+    """Compiles stylesheets, loads hyphenation dictionaries, fonts and resources."""
+    for sheet in STYLESHEETS:
+        get_xslt(get_resource(sheet))
+    for path in RESOURCES:
+        read_resource(path)
+    for language in languages:
+        get_hyphenator(language)
+    from librarian.cover import DefaultEbookCover
+    DefaultEbookCover.warmup()
@@ -4,16 +4,25 @@
 # Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
 #
 import os.path
-from copy import deepcopy
 from lxml import etree
 
-from librarian import functions, OutputFile
+from librarian import functions, OutputFile, RDFNS, get_xslt
 from .epub import replace_by_verse
 
 
-functions.reg_substitute_entities()
 functions.reg_person_name()
 
+STYLESHEET = os.path.join(os.path.dirname(__file__), 'fb2/fb2.xslt')
+
+# Only text rendered in inline mode gets entities converted. fb2.xslt
+# copies everything inside these as it is in other modes...
+RAW_TAGS = ('wers_do_prawej', 'dramat_wspolczesny')
+# ...and text directly inside these (rendered in para and poem modes).
+RAW_TEXT_TAGS = ('utwor', 'powiesc', 'opowiadanie', 'liryka_l', 'liryka_lp',
+                 'dramat_wierszowany_l', 'dramat_wierszowany_lp', '_section',
+                 'dlugi_cytat', 'motto', 'dedykacja', 'nota', 'poezja_cyt',
+                 'strofa', 'lista_osob', 'kwestia', 'tabela', 'wiersz')
+
 
 def sectionify(tree):
     """Finds section headers and adds a tree of _section tags."""
@@ -43,21 +52,28 @@ def transform(wldoc, verbose=False,
     flags: less-advertising, working-copy
     """
 
-    document = deepcopy(wldoc)
+    document = wldoc.fork()
     del wldoc
 
     if flags:
         for flag in flags:
             document.edoc.getroot().set(flag, 'yes')
 
-    style_filename = os.path.join(os.path.dirname(__file__), 'fb2/fb2.xslt')
-    style = etree.parse(style_filename)
+    style = get_xslt(STYLESHEET)
 
     replace_by_verse(document.edoc)
     sectionify(document.edoc)
+    # Dublin Core is only used as it is.
+    functions.substitute_entities(document.edoc, exclude=[RDFNS('RDF')],
+                                  raw=RAW_TAGS, raw_text=RAW_TEXT_TAGS)
 
     result = document.transform(style)
 
     return OutputFile.from_string(unicode(result).encode('utf-8'))
 
+
+def warmup(languages=()):
+    """Compiles the stylesheet."""
+    get_xslt(STYLESHEET)
+
 # vim:et
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""Canonical fingerprints of document trees.
+
+Nodes are hashed in their canonical XML form (C14N, without comments),
+with runs of whitespace counted as a single space. Dublin Core fields
+are taken sorted by name; values of a repeated field keep their order.
+"""
+import hashlib
+import re
+
+from lxml import etree
+
+from librarian import RDFNS
+
+WHITESPACE = re.compile(r'\s+')
+
+
+def canonical(node):
+    """Returns canonical XML of a node, without its tail."""
+    try:
+        data = etree.tostring(node, method='c14n', with_comments=False)
+    except etree.C14NError:
+        # C14N won't take relative namespace URIs.
+        data = etree.tostring(node, encoding='utf-8', with_tail=False)
+    return WHITESPACE.sub(' ', data)
+
+
+class Hasher(object):
+    """Feeds canonical forms of nodes into a hash.
+
+    Tokens are separated with control characters, which can't appear
+    in XML.
+    """
+
+    def __init__(self):
+        self.hash = hashlib.sha1()
+
+    def token(self, kind, *values):
+        self.hash.update((u'%s\0%s\1' % (
+            kind, u'\0'.join(values))).encode('utf-8'))
+
+    def start(self, elem):
+        self.token('<', elem.tag, *(
+            u'%s=%s' % item for item in sorted(elem.attrib.items())))
+
+    def end(self):
+        self.token('>')
+
+    def node(self, node):
+        """Adds a node, without its tail."""
+        if node.tag is etree.Comment:
+            return
+        if node.tag is etree.PI:
+            # Not to be passed to C14N alone.
+            self.token('?', node.target, node.text or u'')
+        elif node.tag == RDFNS('RDF'):
+            self.dublin_core(node)
+        else:
+            self.hash.update(canonical(node))
+            self.token('')
+
+    def dublin_core(self, rdf):
+        self.start(rdf)
+        for description in rdf.iterchildren(RDFNS('Description')):
+            self.start(description)
+            fields = [field for field in description
+                      if isinstance(field.tag, basestring)]
+            for field in sorted(fields, key=lambda field: field.tag):
+                self.start(field)
+                self.token('T', WHITESPACE.sub(
+                    u' ', field.text or u'').strip())
+                self.end()
+            self.end()
+        self.end()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def node_fingerprint(node):
+    """Returns a canonical hash of a node, without its tail."""
+    hasher = Hasher()
+    hasher.node(node)
+    return hasher.hexdigest()
@@ -7,7 +7,7 @@ from lxml import etree
 import re
 
 from librarian.dcparser import Person
-from librarian import get_resource
+from librarian import languages
 
 def _register_function(f):
     """ Register extension function with lxml """
@@ -15,22 +15,81 @@ def _register_function(f):
     ns[f.__name__] = f
 
 
-def reg_substitute_entities():
-    ENTITY_SUBSTITUTIONS = [
-        (u'---', u'—'),
-        (u'--', u'–'),
-        (u'...', u'…'),
-        (u',,', u'„'),
-        (u'"', u'”'),
-    ]
+ENTITY_SUBSTITUTIONS = [
+    (u'---', u'—'),
+    (u'--', u'–'),
+    (u'...', u'…'),
+    (u',,', u'„'),
+    (u'"', u'”'),
+]
+# Longer entities come first, so one pass gives the same result
+# as replacing them one by one.
+ENTITY_EXPR = re.compile(u'|'.join(
+    re.escape(entity) for entity, substitution in ENTITY_SUBSTITUTIONS))
+
+
+def _replace_entity(match, substitutions=dict(ENTITY_SUBSTITUTIONS)):
+    return substitutions[match.group()]
+
+
+def substitute_entities(tree, exclude=(), raw=(), raw_text=()):
+    """Converts entities in all text of a tree, in place.
+
+    Text inside elements with tags in exclude is left alone (but not
+    their tails), as is the content of comments and processing
+    instructions.
+
+    Some text is copied as it is by a stylesheet, but converted where
+    it's rendered elsewhere: all text inside elements with tags in raw,
+    and the own text and children's tails of elements with tags in
+    raw_text. If such text has entities, it's moved into a new _raw
+    element, which has the converted text in its converted attribute.
+    """
+    sub = ENTITY_EXPR.subn
+
+    def keep(text, converted):
+        wrapper = etree.Element('_raw', converted=converted)
+        wrapper.text = text
+        return wrapper
+
+    def convert(elem, in_raw):
+        in_raw = in_raw or elem.tag in raw
+        own = not in_raw and elem.tag not in raw_text
+        # Wrappers are added as we go, so they're not to be visited.
+        children = elem if own else list(elem)
+        if elem.text:
+            text, count = sub(_replace_entity, elem.text)
+            if count:
+                if own:
+                    elem.text = text
+                else:
+                    elem.insert(0, keep(elem.text, text))
+                    elem.text = None
+        for child in children:
+            if isinstance(child.tag, basestring) and child.tag not in exclude:
+                convert(child, in_raw)
+            if child.tail:
+                text, count = sub(_replace_entity, child.tail)
+                if count:
+                    if own:
+                        child.tail = text
+                    else:
+                        wrapper = keep(child.tail, text)
+                        child.tail = None
+                        child.addnext(wrapper)
+
+    if hasattr(tree, 'getroot'):
+        tree = tree.getroot()
+    if tree.tag not in exclude:
+        convert(tree, False)
+
 
+def reg_substitute_entities():
     def substitute_entities(context, text):
         """XPath extension function converting all entites in passed text."""
         if isinstance(text, list):
             text = ''.join(text)
-        for entity, substitutution in ENTITY_SUBSTITUTIONS:
-            text = text.replace(entity, substitutution)
-        return text
+        return ENTITY_EXPR.sub(_replace_entity, text)
 
     _register_function(substitute_entities)
 
@@ -105,20 +164,10 @@ def reg_texcommand():
     _register_function(texcommand)
     
 def reg_lang_code_3to2():
-	def lang_code_3to2(context, text):
-		"""Convert 3-letter language code to 2-letter code"""
-		result = ''
-		text = ''.join(text)
-		with open(get_resource('res/ISO-639-2_8859-1.txt'), 'rb') as f:
-			for line in f:
-				list = line.strip().split('|')
-				if list[0] == text:
-					result=list[2]
-		if result == '':
-			return text
-		else:
-			return result
-	_register_function(lang_code_3to2)
+    def lang_code_3to2(context, text):
+        """Convert 3-letter language code to 2-letter code"""
+        return languages.lang_code_3to2(''.join(text))
+    _register_function(lang_code_3to2)
 
 
 def mathml_latex(context, trees):
@@ -5,17 +5,18 @@
 #
 import os
 import re
-import cStringIO
-import copy
+from copy import deepcopy
+from io import BytesIO
 
 from lxml import etree
-from librarian import XHTMLNS, ParseError, OutputFile
+from librarian import XHTMLNS, RDFNS, ParseError, OutputFile, get_resource, get_xslt
 from librarian import functions
 
 from lxml.etree import XMLSyntaxError, XSLTApplyError
 
-functions.reg_substitute_entities()
 functions.reg_person_name()
+# Used by the editor stylesheets.
+functions.reg_substitute_entities()
 
 STYLESHEETS = {
     'legacy': 'xslt/book2html.xslt',
@@ -23,9 +24,25 @@ STYLESHEETS = {
     'partial': 'xslt/wl2html_partial.xslt'
 }
 
+# Renders only the footnotes of the legacy HTML.
+ANNOTATIONS_STYLESHEET = 'xslt/book2html_annotations.xslt'
+
+# Used to find qualifiers at the start of annotations.
+RE_QUALIFIER = re.compile(ur'[^\u2014]+\s+\(([^\)]+)\)\s+\u2014')
+
+# Text of these is put in the legacy HTML as it is.
+RAW_TAGS = (RDFNS('RDF'), 'motyw', 'naglowek_listy', 'mat')
+
 def get_stylesheet(name):
     return os.path.join(os.path.dirname(__file__), STYLESHEETS[name])
 
+
+def warmup(languages=()):
+    """Compiles the stylesheets."""
+    for name in STYLESHEETS:
+        get_xslt(get_stylesheet(name))
+    get_xslt(get_resource(ANNOTATIONS_STYLESHEET))
+
 def html_has_content(text):
     return etree.ETXPath('//p|//{%(ns)s}p|//h1|//{%(ns)s}h1' % {'ns': str(XHTMLNS)})(text)
 
@@ -38,10 +55,9 @@ def transform(wldoc, stylesheet='legacy', options=None, flags=None):
     """
     # Parse XSLT
     try:
-        style_filename = get_stylesheet(stylesheet)
-        style = etree.parse(style_filename)
+        style = get_xslt(get_stylesheet(stylesheet))
 
-        document = copy.deepcopy(wldoc)
+        document = wldoc.fork()
         del wldoc
         document.swap_endlines()
 
@@ -50,6 +66,8 @@ def transform(wldoc, stylesheet='legacy', options=None, flags=None):
                 document.edoc.getroot().set(flag, 'yes')
 
         document.clean_ed_note()
+        if stylesheet == 'legacy':
+            functions.substitute_entities(document.edoc, exclude=RAW_TAGS)
 
         if not options:
             options = {}
@@ -57,9 +75,7 @@ def transform(wldoc, stylesheet='legacy', options=None, flags=None):
         del document # no longer needed large object :)
 
         if html_has_content(result):
-            add_anchors(result.getroot())
-            add_table_of_themes(result.getroot())
-            add_table_of_contents(result.getroot())
+            add_anchors_and_tables(result.getroot())
 
             return OutputFile.from_string(etree.tostring(result, method='html',
                 xml_declaration=False, pretty_print=True, encoding='utf-8'))
@@ -71,19 +87,35 @@ def transform(wldoc, stylesheet='legacy', options=None, flags=None):
         raise ParseError(e)
 
 class Fragment(object):
-    def __init__(self, id, themes):
+    """A theme fragment, rendered on demand from the document's event log.
+
+    The log is shared by all fragments of a document. A fragment keeps
+    only the elements it starts inside of and its offsets in the log.
+    """
+    def __init__(self, id, themes, log, start, parents=()):
         super(Fragment, self).__init__()
         self.id = id
         self.themes = themes
-        self.events = []
+        self.log = log
+        self.start = start
+        self.end = None
+        self.parents = parents
 
-    def append(self, event, element):
-        self.events.append((event, element))
+    @property
+    def closed(self):
+        return self.end is not None
+
+    @property
+    def events(self):
+        events = [('parent', parent) for parent in self.parents]
+        events.extend(self.log[self.start:self.end])
+        return events
 
     def closed_events(self):
+        events = self.events
         stack = []
-        for event, element in self.events:
-            if event == 'start':
+        for event, element in events:
+            if event in ('start', 'parent'):
                 stack.append(('end', element))
             elif event == 'end':
                 try:
@@ -92,14 +124,14 @@ class Fragment(object):
                     print 'CLOSED NON-OPEN TAG:', element
 
         stack.reverse()
-        return self.events + stack
+        return events + stack
 
     def to_string(self):
         result = []
         for event, element in self.closed_events():
-            if event == 'start':
+            if event in ('start', 'parent'):
                 result.append(u'<%s %s>' % (element.tag, ' '.join('%s="%s"' % (k, v) for k, v in element.attrib.items())))
-                if element.text:
+                if event == 'start' and element.text:
                     result.append(element.text)
             elif event == 'end':
                 result.append(u'</%s>' % element.tag)
@@ -114,75 +146,224 @@ class Fragment(object):
         return self.to_string()
 
 
-def extract_fragments(input_filename):
-    """Extracts theme fragments from input_filename."""
-    open_fragments = {}
-    closed_fragments = {}
+def iter_fragments(input_filename):
+    """Extracts theme fragments from input_filename.
 
-    # iterparse would die on a HTML document
+    Yields fragments as they get closed, then the ones left open.
+    """
     parser = etree.HTMLParser(encoding='utf-8')
-    buf = cStringIO.StringIO()
-    buf.write(etree.tostring(etree.parse(input_filename, parser).getroot()[0][0], encoding='utf-8'))
-    buf.seek(0)
+    root = etree.parse(input_filename, parser).getroot()[0][0]
+    # Only the book text is used, without anything around it.
+    root.tail = None
+
+    # Elements are logged as they are, the tree is not changed.
+    log = []
+    open_fragments = {}
+
+    for event, element in etree.iterwalk(root, events=('start', 'end')):
+        if not isinstance(element.tag, basestring):
+            continue
 
-    for event, element in etree.iterparse(buf, events=('start', 'end')):
         # Process begin and end elements
         if element.get('class', '') in ('theme-begin', 'theme-end'):
             if not event == 'end': continue # Process elements only once, on end event
 
             # Open new fragment
             if element.get('class', '') == 'theme-begin':
-                fragment = Fragment(id=element.get('fid'), themes=element.text)
-
                 # Append parents
                 parent = element.getparent()
                 parents = []
                 while parent.get('id', None) != 'book-text':
-                    cparent = copy.deepcopy(parent)
-                    cparent.text = None
-                    parents.append(cparent)
+                    parents.append(parent)
                     parent = parent.getparent()
-
                 parents.reverse()
-                for parent in parents:
-                    fragment.append('start', parent)
 
+                fragment = Fragment(id=element.get('fid'), themes=element.text,
+                                    log=log, start=len(log), parents=parents)
                 open_fragments[fragment.id] = fragment
 
             # Close existing fragment
             else:
                 try:
-                    fragment = open_fragments[element.get('fid')]
+                    fragment = open_fragments.pop(element.get('fid'))
                 except KeyError:
                     print '%s:closed not open fragment #%s' % (input_filename, element.get('fid'))
                 else:
-                    closed_fragments[fragment.id] = fragment
-                    del open_fragments[fragment.id]
+                    fragment.end = len(log)
+                    yield fragment
 
             # Append element tail to lost_text (we don't want to lose any text)
-            if element.tail:
-                for fragment_id in open_fragments:
-                    open_fragments[fragment_id].append('text', element.tail)
-
+            if element.tail and open_fragments:
+                log.append(('text', element.tail))
 
         # Process all elements except begin and end
+        elif not open_fragments:
+            continue
         else:
             # Omit annotation tags
             if (len(element.get('name', '')) or 
                     element.get('class', '') in ('annotation', 'anchor')):
                 if event == 'end' and element.tail:
-                    for fragment_id in open_fragments:
-                        open_fragments[fragment_id].append('text', element.tail)
+                    log.append(('text', element.tail))
             else:
-                for fragment_id in open_fragments:
-                    open_fragments[fragment_id].append(event, copy.copy(element))
+                log.append((event, element))
+
+    for fragment in open_fragments.values():
+        yield fragment
 
+
+def extract_fragments(input_filename):
+    """Extracts theme fragments from input_filename.
+
+    Returns dicts of closed and unclosed fragments by id.
+    """
+    closed_fragments = {}
+    open_fragments = {}
+    for fragment in iter_fragments(input_filename):
+        if fragment.closed:
+            closed_fragments[fragment.id] = fragment
+        else:
+            open_fragments[fragment.id] = fragment
     return closed_fragments, open_fragments
 
 
-def add_anchor(element, prefix, with_link=True, with_target=True, link_text=None):
+def _copy_range(node, begin, end, begin_path, end_path):
+    """Copies node, without what comes before begin or after end.
+
+    begin and end are descendants of node, or None for no limit;
+    begin_path and end_path are sets of them and their ancestors.
+    """
+    copy = etree.Element(node.tag, node.attrib)
+    if begin is None:
+        copy.text = node.text
+    for child in node:
+        if begin is not None:
+            if child not in begin_path:
+                continue
+            if child is begin:
+                child_copy = deepcopy(child)
+            elif child in end_path:
+                copy.append(_copy_range(child, begin, end, begin_path, end_path))
+                break
+            else:
+                child_copy = _copy_range(child, begin, None, begin_path, end_path)
+                child_copy.tail = child.tail
+            begin = None
+        elif child in end_path:
+            if child is end:
+                child_copy = deepcopy(child)
+            else:
+                child_copy = _copy_range(child, None, end, begin_path, end_path)
+            child_copy.tail = None
+            copy.append(child_copy)
+            break
+        else:
+            child_copy = deepcopy(child)
+        copy.append(child_copy)
+    return copy
+
+
+def _remove_keeping_tail(element):
     parent = element.getparent()
-    index = parent.index(element)
+    if element.tail:
+        previous = element.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + element.tail
+        else:
+            parent.text = (parent.text or '') + element.tail
+    parent.remove(element)
+
+
+class SourceFragment(object):
+    """A theme fragment found in the WL source.
+
+    Only the part of the source between its begin and end is rendered
+    to HTML, and only when asked for.
+
+    Unlike a Fragment extracted from HTML, it ends right at its end:
+    text following the end inside an element, like " b" in
+    <wyroznienie>a<end/></wyroznienie> b, is left out.
+    """
+    def __init__(self, id, begin):
+        super(SourceFragment, self).__init__()
+        self.id = id
+        self.themes = None
+        self.begin = begin
+        self.end = None
+
+    @property
+    def closed(self):
+        return self.end is not None
+
+    def source(self):
+        """Returns the source of the fragment, with all its ancestors."""
+        begin_path = set(self.begin.iterancestors())
+        begin_path.add(self.begin)
+        if self.end is not None:
+            end_path = set(self.end.iterancestors())
+            end_path.add(self.end)
+        else:
+            end_path = ()
+        root = self.begin.getroottree().getroot()
+        source = _copy_range(root, self.begin, self.end, begin_path, end_path)
+        # Other fragments are left out, and their motifs aren't rendered.
+        for element in list(source.iter('begin', 'end')):
+            if element.get('id', '')[1:] != self.id:
+                _remove_keeping_tail(element)
+        return source
+
+    def to_string(self):
+        from librarian.parser import WLDocument
+
+        document = WLDocument(etree.ElementTree(self.source()),
+                              parse_dublincore=False)
+        output = transform(document)
+        if output is not None:
+            for fragment in iter_fragments(BytesIO(output.get_string())):
+                if fragment.id == self.id:
+                    return fragment.to_string()
+        return u''
+
+    def __unicode__(self):
+        return self.to_string()
+
+
+def iter_source_fragments(wldoc):
+    """Extracts theme fragments straight from a WLDocument.
+
+    Yields fragments as they get closed, then the ones left open,
+    in one pass over the source.
+    """
+    open_fragments = {}
+    for element in wldoc.edoc.getroot().iter('begin', 'end', 'motyw'):
+        # Like in HTML, where clean_ed_note() drops them.
+        if next(element.iterancestors('nota_red'), None) is not None:
+            continue
+        fid = element.get('id', '')[1:]
+        if element.tag == 'begin':
+            open_fragments[fid] = SourceFragment(fid, element)
+        elif element.tag == 'motyw':
+            fragment = None
+            if element.get('id', '').startswith('m'):
+                fragment = open_fragments.get(fid)
+            if fragment is not None and fragment.themes is None:
+                fragment.themes = element.text
+        else:
+            fragment = open_fragments.pop(fid, None)
+            if fragment is not None:
+                fragment.end = element
+                yield fragment
+
+    for fragment in open_fragments.values():
+        yield fragment
+
+
+def add_anchor(element, prefix, with_link=True, with_target=True, link_text=None):
+    if with_target:
+        anchor_target = etree.Element('a', name='%s' % prefix)
+        anchor_target.set('class', 'target')
+        anchor_target.text = u' '
+        element.addprevious(anchor_target)
 
     if with_link:
         if link_text is None:
@@ -190,62 +371,94 @@ def add_anchor(element, prefix, with_link=True, with_target=True, link_text=None
         anchor = etree.Element('a', href='#%s' % prefix)
         anchor.set('class', 'anchor')
         anchor.text = unicode(link_text)
-        parent.insert(index, anchor)
+        element.addprevious(anchor)
 
-    if with_target:
-        anchor_target = etree.Element('a', name='%s' % prefix)
-        anchor_target.set('class', 'target')
-        anchor_target.text = u' '
-        parent.insert(index, anchor_target)
+
+def skips_anchors(element):
+    """Paragraphs and verses inside these elements are not numbered."""
+    return (element.get('class') in ('note', 'motto', 'motto_podpis', 'dedication')
+        or element.get('id') == 'nota_red'
+        or element.tag == 'blockquote')
 
 
-def any_ancestor(element, test):
-    for ancestor in element.iterancestors():
-        if test(ancestor):
-            return True
-    return False
+def skips_toc(element):
+    """Headings inside these elements are left out of the table of contents."""
+    return (element.get('id') in ('footnotes', 'nota_red')
+        or element.get('class') in ('person-list',))
 
 
-def add_anchors(root):
+def raw_printable_text(element):
+    # Hide link texts of footnotes and themes for a moment, instead of
+    # working on a copy.
+    hidden = [e for e in element.findall('a')
+              if e.get('class') in ('annotation', 'theme-begin')]
+    texts = [e.text for e in hidden]
+    for e in hidden:
+        e.text = ''
+    try:
+        return etree.tostring(element, method='text', encoding=unicode).strip()
+    finally:
+        for e, text in zip(hidden, texts):
+            e.text = text
+
+
+def add_anchors_and_tables(root):
+    """Numbers paragraphs and verses, adds tables of themes and contents.
+
+    It's all done in one walk over the tree. Along with each element
+    still being visited, the stack holds whether its descendants are
+    excluded from numbering and from the table of contents.
+    """
     counter = 1
-    for element in root.iterdescendants():
-        if any_ancestor(element, lambda e: e.get('class') in ('note', 'motto', 'motto_podpis', 'dedication')
-        or e.get('id') == 'nota_red'
-        or e.tag == 'blockquote'):
+    headings = []
+    book_themes = {}
+
+    stack = [(iter(list(root)), skips_anchors(root), skips_toc(root))]
+    while stack:
+        children, no_anchors, no_toc = stack[-1]
+        element = next(children, None)
+        if element is None:
+            stack.pop()
+            continue
+        if not isinstance(element.tag, basestring):
             continue
 
-        if element.tag == 'p' and 'verse' in element.get('class', ''):
-            if counter == 1 or counter % 5 == 0:
+        if not no_anchors:
+            if element.tag == 'p' and 'verse' in element.get('class', ''):
+                if counter == 1 or counter % 5 == 0:
+                    add_anchor(element, "f%d" % counter, link_text=counter)
+                counter += 1
+            elif 'paragraph' in element.get('class', ''):
                 add_anchor(element, "f%d" % counter, link_text=counter)
-            counter += 1
-        elif 'paragraph' in element.get('class', ''):
-            add_anchor(element, "f%d" % counter, link_text=counter)
-            counter += 1
+                counter += 1
 
+        if element.tag in ('h2', 'h3'):
+            if not no_toc:
+                add_anchor(element, "s%d" % (len(headings) + 1), with_link=False)
+                headings.append(element)
+        elif element.tag == 'a' and element.get('class') == 'theme-begin':
+            if element.text:
+                for theme_name in element.text.split(','):
+                    book_themes.setdefault(theme_name.strip(), []).append(
+                        element.get('name'))
 
-def raw_printable_text(element):
-    working = copy.deepcopy(element)
-    for e in working.findall('a'):
-        if e.get('class') in ('annotation', 'theme-begin'):
-            e.text = ''
-    return etree.tostring(working, method='text', encoding=unicode).strip()
+        if len(element):
+            stack.append((iter(list(element)),
+                          no_anchors or skips_anchors(element),
+                          no_toc or skips_toc(element)))
 
+    root.insert(0, table_of_themes(book_themes))
+    root.insert(0, table_of_contents(headings))
 
-def add_table_of_contents(root):
-    sections = []
-    counter = 1
-    for element in root.iterdescendants():
-        if element.tag in ('h2', 'h3'):
-            if any_ancestor(element, lambda e: e.get('id') in ('footnotes', 'nota_red') or e.get('class') in ('person-list',)):
-                continue
 
-            element_text = raw_printable_text(element)
-            if element.tag == 'h3' and len(sections) and sections[-1][1] == 'h2':
-                sections[-1][3].append((counter, element.tag, element_text, []))
-            else:
-                sections.append((counter, element.tag, element_text, []))
-            add_anchor(element, "s%d" % counter, with_link=False)
-            counter += 1
+def table_of_contents(headings):
+    sections = []
+    for counter, element in enumerate(headings, 1):
+        element_text = raw_printable_text(element)
+        if element.tag == 'h3' and len(sections) and sections[-1][1] == 'h2':
+            sections[-1][3].append((counter, element.tag, element_text, []))
+        else:
+            sections.append((counter, element.tag, element_text, []))
 
     toc = etree.Element('div')
     toc.set('id', 'toc')
@@ -263,22 +476,15 @@ def add_table_of_contents(root):
                 subsection_element = etree.SubElement(subsection_list, 'li')
                 add_anchor(subsection_element, "s%d" % n, with_target=False, link_text=text)
 
-    root.insert(0, toc)
+    return toc
 
-    
-def add_table_of_themes(root):
+
+def table_of_themes(book_themes):
     try:
         from sortify import sortify
     except ImportError:
         sortify = lambda x: x
 
-    book_themes = {}
-    for fragment in root.findall('.//a[@class="theme-begin"]'):
-        if not fragment.text:
-            continue
-        theme_names = [s.strip() for s in fragment.text.split(',')]
-        for theme_name in theme_names:
-            book_themes.setdefault(theme_name, []).append(fragment.get('name'))
     book_themes = book_themes.items()
     book_themes.sort(key=lambda s: sortify(s[0]))
     themes_div = etree.Element('div', id="themes")
@@ -290,7 +496,56 @@ def add_table_of_themes(root):
             item = etree.SubElement(themes_li, 'a', href="#%s" % fragment)
             item.text = str(i + 1)
             item.tail = ' '
-    root.insert(0, themes_div)
+    return themes_div
+
+
+_qualifier_lookup = None
+
+def match_qualifiers(qualifier_str):
+    """Returns the standard qualifiers from a comma or semicolon separated list.
+
+    An item is taken if it is a qualifier, or if it's "z" followed by
+    a one-word qualifier and, optionally, more words.
+    """
+    global _qualifier_lookup
+    if _qualifier_lookup is None:
+        from .fn_qualifiers import FN_QUALIFIERS
+        _qualifier_lookup = frozenset(FN_QUALIFIERS)
+
+    qualifiers = []
+    for candidate in qualifier_str.replace(u';', u',').split(u','):
+        candidate = candidate.strip()
+        if candidate in _qualifier_lookup:
+            qualifiers.append(candidate)
+        elif candidate.startswith(u'z '):
+            subcandidate = candidate.split(None, 2)[1]
+            if subcandidate in _qualifier_lookup:
+                qualifiers.append(subcandidate)
+    return qualifiers
+
+
+def footnote_annotation(footnote):
+    """Returns an annotation tuple for a footnote div.
+
+    The div is the one found in the footnotes section of the legacy
+    HTML; its anchor links are removed from it.
+    """
+    fn_type = footnote.get('class').split('-')[1]
+    anchor = footnote.find('a[@class="annotation"]').get('href')[1:]
+    del footnote[:2]
+    footnote.text = None
+    if len(footnote) and footnote[-1].tail == '\n':
+        footnote[-1].tail = None
+    text_str = etree.tostring(footnote, method='text', encoding=unicode).strip()
+    html_str = etree.tostring(footnote, method='html', encoding=unicode).strip()
+
+    match = RE_QUALIFIER.match(text_str)
+    if match:
+        qualifiers = match_qualifiers(match.group(1))
+    else:
+        qualifiers = []
+
+    return anchor, fn_type, qualifiers, text_str, html_str
 
 
 def extract_annotations(html_path):
@@ -300,37 +555,31 @@ def extract_annotations(html_path):
     anchor, footnote type, valid qualifiers, text, html.
 
     """
-    from .fn_qualifiers import FN_QUALIFIERS
-
     parser = etree.HTMLParser(encoding='utf-8')
     tree = etree.parse(html_path, parser)
     footnotes = tree.find('//*[@id="footnotes"]')
-    re_qualifier = re.compile(ur'[^\u2014]+\s+\(([^\)]+)\)\s+\u2014')
     if footnotes is not None:
         for footnote in footnotes.findall('div'):
-            fn_type = footnote.get('class').split('-')[1]
-            anchor = footnote.find('a[@class="annotation"]').get('href')[1:]
-            del footnote[:2]
-            footnote.text = None
-            if len(footnote) and footnote[-1].tail == '\n':
-                footnote[-1].tail = None
-            text_str = etree.tostring(footnote, method='text', encoding=unicode).strip()
-            html_str = etree.tostring(footnote, method='html', encoding=unicode).strip()
-
-            match = re_qualifier.match(text_str)
-            if match:
-                qualifier_str = match.group(1)
-                qualifiers = []
-                for candidate in re.split('[;,]', qualifier_str):
-                    candidate = candidate.strip()
-                    if candidate in FN_QUALIFIERS:
-                        qualifiers.append(candidate)
-                    elif candidate.startswith('z '):
-                        subcandidate = candidate.split()[1]
-                        if subcandidate in FN_QUALIFIERS:
-                            qualifiers.append(subcandidate)
-            else:
-                qualifiers = []
+            yield footnote_annotation(footnote)
+
 
-            yield anchor, fn_type, qualifiers, text_str, html_str
+def iter_source_annotations(wldoc):
+    """Extracts annotations straight from a WLDocument.
 
+    Yields the same tuples as extract_annotations, but renders
+    only the footnotes instead of the whole book.
+    """
+    style = get_xslt(get_resource(ANNOTATIONS_STYLESHEET))
+    document = wldoc.fork()
+    document.swap_endlines()
+    document.clean_ed_note()
+    functions.substitute_entities(document.edoc, exclude=RAW_TAGS)
+    try:
+        footnotes = document.transform(style).getroot()
+    except (XMLSyntaxError, XSLTApplyError), e:
+        raise ParseError(e)
+    del document
+    # Namespaces declared in the stylesheet would end up in every footnote.
+    etree.cleanup_namespaces(footnotes)
+    for footnote in footnotes:
+        yield footnote_annotation(footnote)
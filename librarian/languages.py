@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""ISO 639 language codes.
+
+The table in res/ISO-639-2_8859-1.txt is read once, on first use,
+and indexed by every code it lists: bibliographic (B) and terminologic
+(T) three-letter codes and two-letter ISO 639-1 codes.
+"""
+from collections import namedtuple
+
+from librarian import get_resource
+
+TABLE_FILE = 'res/ISO-639-2_8859-1.txt'
+
+Language = namedtuple('Language', 'bibliographic terminologic alpha2 english french')
+
+_index = None
+
+
+def _load():
+    index = {}
+    with open(get_resource(TABLE_FILE), 'rb') as f:
+        for line in f:
+            fields = line.decode('iso-8859-1').strip().split(u'|')
+            if len(fields) != 5:
+                continue
+            language = Language(*fields)
+            # Later lines win, as they did when the file was scanned.
+            for code in language[:3]:
+                if code:
+                    index[code] = language
+    return index
+
+
+def get_language(code):
+    """Returns the Language for a B, T or two-letter code, or None."""
+    global _index
+    if _index is None:
+        _index = _load()
+    return _index.get(code)
+
+
+def lang_code_3to2(code):
+    """Converts a three-letter code to a two-letter one.
+
+    Codes without a two-letter equivalent are returned as they are.
+    """
+    language = get_language(code)
+    if language is None or not language.alpha2:
+        return code
+    return language.alpha2
+
+
+def lang_code_2to3(code, terminologic=False):
+    """Converts a two-letter code to a three-letter one.
+
+    The bibliographic code is returned, unless terminologic is set and
+    the language has a separate terminologic code. Unknown codes are
+    returned as they are.
+    """
+    language = get_language(code)
+    if language is None:
+        return code
+    if terminologic and language.terminologic:
+        return language.terminologic
+    return language.bibliographic
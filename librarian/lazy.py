@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""Lazy loading of documents.
+
+For a header-only document, the source is parsed only up to the end
+of Dublin Core.
+
+For a lazy document, the source is scanned once and the top-level
+nodes of the main text element are indexed by their byte offsets.
+Only a skeleton of the document (the root, Dublin Core and an empty
+main text element) is parsed up front; each top-level node is parsed
+when asked for. lxml doesn't report byte offsets of parsed nodes,
+so the scan is done with expat.
+"""
+from io import BytesIO
+import re
+from xml.parsers import expat
+
+from lxml import etree
+
+from librarian import RDFNS, parse_xml_string
+
+QNAME = re.compile(r'<([^\s/>]+)')
+# Consecutive top-level nodes are parsed together, up to this many bytes.
+RUN_SIZE = 256 * 1024
+
+
+def tag_end(data, pos):
+    """Returns the offset just past the tag starting at pos."""
+    quote = None
+    while True:
+        c = data[pos]
+        pos += 1
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c == '>':
+            return pos
+
+
+def qname(data, pos):
+    """Returns the qualified name of the tag starting at pos."""
+    return QNAME.match(data[pos:pos + 256]).group(1)
+
+
+def parse_header(data):
+    """Parses a document up to the end of its Dublin Core.
+
+    Returns the partial tree, or None if there's no Dublin Core.
+    """
+    if isinstance(data, str):
+        data = BytesIO(data)
+    else:
+        data.seek(0)
+    for event, element in etree.iterparse(data, tag=RDFNS('RDF')):
+        return element.getroottree()
+
+
+class Source(object):
+    """Source of a document, kept to be parsed fully when needed.
+
+    data is a byte string or a buffer (like a mmap).
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def full_tree(self):
+        return parse_xml_string(self.data)
+
+
+class BodyIndex(Source):
+    """Byte offsets of the top-level nodes of a document's main text.
+
+    data is the whole document, as a byte string or a buffer (like
+    a mmap). Raises ValueError if the document has no main text to
+    index and ExpatError if it isn't well-formed.
+
+    Nodes start at offsets, and elements end (without their tails) at
+    ends. If Dublin Core is outside the main text, it spans from
+    dc_start to dc_end.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.offsets = []
+        self.ends = []
+        self.tags = []
+        self._depth = 0
+        self.root_start = self.master_start = self.master_end = None
+        self.rdf_start = self.rdf_end = None
+        self.dc_start = self.dc_end = None
+
+        self._parser = expat.ParserCreate(namespace_separator='}')
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CommentHandler = self._comment
+        self._parser.ProcessingInstructionHandler = self._pi
+        if isinstance(data, str):
+            self._parser.Parse(data, True)
+        else:
+            data.seek(0)
+            self._parser.ParseFile(data)
+        del self._parser
+
+        if self.master_end is None or self.master_end == self.master_start:
+            raise ValueError('No main text to index.')
+        self.root_content = tag_end(data, self.root_start)
+        self.master_content = tag_end(data, self.master_start)
+        self.closing = '</%s></%s>' % (qname(data, self.master_start),
+                                       qname(data, self.root_start))
+
+    def _in_master(self):
+        return self._depth == 2 and self.master_end is None and \
+            self.master_start is not None
+
+    def _start(self, name, attrs):
+        pos = self._parser.CurrentByteIndex
+        tag = '{' + name if '}' in name else name
+        if self._in_master():
+            self.offsets.append(pos)
+            self.tags.append(tag)
+            self._child_start = pos
+            if tag == RDFNS('RDF'):
+                self.rdf_start = pos
+        elif self._depth == 0:
+            self.root_start = pos
+        elif self._depth == 1 and self.master_start is None:
+            if tag == RDFNS('RDF'):
+                self.dc_start = pos
+            else:
+                self.master_start = pos
+        self._depth += 1
+
+    def _end(self, name):
+        self._depth -= 1
+        pos = self._parser.CurrentByteIndex
+        if self._depth == 1 and self.master_start is not None and \
+                self.master_end is None:
+            self.master_end = pos
+        elif self._depth == 1 and self.dc_start is not None and \
+                self.dc_end is None:
+            self.dc_end = self._element_end(self.dc_start, pos)
+        elif self._in_master():
+            self.ends.append(self._element_end(self._child_start, pos))
+            if self.rdf_start is not None and self.rdf_end is None:
+                self.rdf_end = self.ends[-1]
+
+    def _element_end(self, start, pos):
+        # For an empty element, expat reports its end past the start tag.
+        if pos == tag_end(self.data, start) and self.data[pos - 2:pos] == '/>':
+            return pos
+        return tag_end(self.data, pos)
+
+    def _comment(self, data):
+        if self._in_master():
+            self.offsets.append(self._parser.CurrentByteIndex)
+            self.ends.append(None)
+            self.tags.append(etree.Comment)
+
+    def _pi(self, target, data):
+        if self._in_master():
+            self.offsets.append(self._parser.CurrentByteIndex)
+            self.ends.append(None)
+            self.tags.append(etree.PI)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def skeleton(self):
+        """Parses the document without the main text's contents.
+
+        Dublin Core is kept, even if it's inside the main text element.
+        """
+        data = self.data
+        parts = [data[:self.master_content]]
+        if self.rdf_start is not None:
+            parts.append(data[self.rdf_start:self.rdf_end])
+        parts.append(data[self.master_end:])
+        return parse_xml_string(''.join(parts))
+
+    def _end_of(self, i):
+        return self.offsets[i + 1] if i + 1 < len(self.offsets) else self.master_end
+
+    def nodes(self, start, stop):
+        """Parses top-level nodes of the main text from start to stop - 1.
+
+        Nodes are returned with their tails, in a list.
+        """
+        data = self.data
+        tree = parse_xml_string(''.join([
+            data[:self.root_content],
+            data[self.master_start:self.master_content],
+            data[self.offsets[start]:self._end_of(stop - 1)],
+            self.closing]))
+        return list(tree.getroot()[0])
+
+    def iter_runs(self, tags=None):
+        """Parses runs of consecutive top-level nodes of the main text.
+
+        Only nodes with given tags are parsed, if tags are given.
+        Yields lists of nodes, each parsed from about RUN_SIZE bytes.
+        """
+        start = None
+        for i, tag in enumerate(self.tags):
+            if tags is not None and tag not in tags:
+                if start is not None:
+                    yield self.nodes(start, i)
+                    start = None
+                continue
+            if start is None:
+                start = i
+            if self._end_of(i) - self.offsets[start] >= RUN_SIZE:
+                yield self.nodes(start, i + 1)
+                start = None
+        if start is not None:
+            yield self.nodes(start, len(self.tags))
+
+    def iter_nodes(self, tags=None):
+        """Parses top-level nodes of the main text, yielding them one by one."""
+        for run in self.iter_runs(tags):
+            for node in run:
+                yield node
+
+    __iter__ = iter_nodes
@@ -4,7 +4,6 @@
 # Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
 #
 
-from copy import deepcopy
 import os
 import subprocess
 from tempfile import NamedTemporaryFile
@@ -22,7 +21,7 @@ def transform(wldoc, verbose=False, sample=None, cover=None,
     flags: less-advertising,
     """
 
-    document = deepcopy(wldoc)
+    document = wldoc.fork()
     del wldoc
 
     epub = document.as_epub(verbose=verbose, sample=sample,
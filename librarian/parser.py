@@ -4,24 +4,35 @@
 # Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
 #
 from librarian import ValidationError, NoDublinCore,  ParseError, NoProvider
-from librarian import RDFNS
-from librarian.cover import DefaultEbookCover
+from librarian import RDFNS, parse_xml_file, parse_xml_string, map_xml_file
 from librarian import dcparser
+from librarian.chunks import ChunkIndex, STEP
+from librarian.fingerprint import Hasher, node_fingerprint
+from librarian.lazy import BodyIndex, Source, parse_header
 
 from xml.parsers.expat import ExpatError
 from lxml import etree
 from lxml.etree import XMLSyntaxError, XSLTApplyError
 
+from copy import copy, deepcopy
+import hashlib
+import mmap
 import os
 import re
-from StringIO import StringIO
 
 class WLDocument(object):
     LINE_SWAP_EXPR = re.compile(r'/\s', re.MULTILINE | re.UNICODE)
     provider = None
+    cache = None  # a doccache.DocumentCache used by from_file
+    header_only = False
 
     def __init__(self, edoc, parse_dublincore=True, provider=None, 
-                    strict=False, meta_fallbacks=None):
+                    strict=False, meta_fallbacks=None, book_info=None):
+        """Wraps a parsed document tree.
+
+        book_info can be passed to reuse already validated Dublin Core
+        metadata instead of parsing it from the tree.
+        """
         self.edoc = edoc
         self.provider = provider
 
@@ -38,70 +49,346 @@ class WLDocument(object):
             if self.rdf_elem is None:
                 raise NoDublinCore('Document has no DublinCore - which is required.')
 
-            self.book_info = dcparser.BookInfo.from_element(
+            if book_info is None:
+                book_info = dcparser.BookInfo.from_element(
                     self.rdf_elem, fallbacks=meta_fallbacks, strict=strict)
+            self.book_info = book_info
         else:
             self.book_info = None
 
+    _edoc = None
+    _pristine = None
+    _rdf_elem = None
+    _source = None
+    _fingerprint = None
+    _chunk_fingerprints = None
+    _changed = None
+    _digests = None
+    skeleton = None
+
+    @property
+    def edoc(self):
+        if self._edoc is None:
+            if self._pristine is not None:
+                self._edoc = deepcopy(self._pristine)
+                self._pristine = None
+            elif self._source is not None:
+                # Lazy or header-only document used as a whole, parse all of it.
+                self._edoc = self._source.full_tree()
+                if self.skeleton is not None:
+                    self._edoc.getroot().attrib.update(self.skeleton.getroot().attrib)
+                    self.skeleton = None
+        return self._edoc
+
+    @edoc.setter
+    def edoc(self, edoc):
+        self._edoc = edoc
+        self._pristine = None
+        self._rdf_elem = None
+        self._source = None
+        self.skeleton = None
+        self._fingerprint = self._chunk_fingerprints = None
+        self._changed = None
+
+    @property
+    def is_lazy(self):
+        """True if the main text hasn't been parsed yet.
+
+        A lazy document has a `skeleton` tree: the document without the
+        contents of its main text element, but with Dublin Core. Use
+        iter_body() to get the main text one element at a time. Using
+        edoc parses the whole document; attributes set on the skeleton's
+        root are kept.
+        """
+        return self._edoc is None and self._pristine is None and \
+            self.skeleton is not None
+
+    def main_text(self, tree=None):
+        """Finds the main text element in tree (defaults to edoc)."""
+        if tree is None:
+            tree = self.edoc
+        root = tree.getroot()
+        if len(root) > 1:
+            # rdf before style master
+            return root[1]
+        # rdf in style master
+        if root[0].tag == RDFNS('RDF'):
+            return None
+        return root[0]
+
+    def body_tags(self):
+        """Lists tags of the main text's top-level nodes."""
+        if self.is_lazy:
+            return list(self._source.tags)
+        main_text = self.main_text()
+        return [] if main_text is None else [node.tag for node in main_text]
+
+    def iter_body(self, tags=None):
+        """Iterates over top-level nodes of the main text.
+
+        Only nodes with given tags are included, if tags are given.
+        For a lazy document, each node is parsed on demand, and isn't
+        kept by the document.
+        """
+        if self.is_lazy:
+            return self._source.iter_nodes(tags)
+        main_text = self.main_text()
+        if main_text is None:
+            return iter(())
+        return (node for node in main_text if tags is None or node.tag in tags)
+
+    def iter_body_runs(self, tags=None):
+        """Iterates over runs of consecutive top-level nodes of the main text.
+
+        Like iter_body(), but yields lists of nodes. For a lazy document,
+        each run is parsed at once, from a bounded part of the source.
+        """
+        if self.is_lazy:
+            return self._source.iter_runs(tags)
+        return ([node] for node in self.iter_body(tags))
+
+    @property
+    def rdf_elem(self):
+        if self._rdf_elem is None:
+            self._rdf_elem = self.edoc.getroot().find('.//' + RDFNS('RDF'))
+        return self._rdf_elem
+
+    @rdf_elem.setter
+    def rdf_elem(self, rdf_elem):
+        self._rdf_elem = rdf_elem
+
+    def fork(self):
+        """Returns a copy of the document, for a converter to modify.
+
+        The tree is copied only when the fork's edoc is first used, so a
+        fork that is only forked again (like in mobi, which hands the
+        book to epub) costs nothing. book_info and provider are shared.
+        The original shouldn't be modified while it has forks that
+        haven't touched their tree yet.
+        """
+        fork = copy(self)
+        fork._pristine = self._edoc if self._edoc is not None else self._pristine
+        fork._edoc = None
+        fork._rdf_elem = None
+        fork._fingerprint = fork._chunk_fingerprints = None
+        if self._changed is not None:
+            fork._changed = set(self._changed)
+        if self.skeleton is not None:
+            fork.skeleton = deepcopy(self.skeleton)
+        return fork
+
+    def __getstate__(self):
+        """Pickles the document compactly, to be sent to another process.
+
+        The tree is pickled serialized and book_info with its already
+        validated values, so nothing is validated again. A lazy or
+        header-only document is pickled as its source, and opened
+        the same way when unpickled. The provider is pickled too.
+        """
+        state = {
+            'book_info': self.book_info,
+            'provider': self.provider,
+            'header_only': self.header_only,
+            'fingerprints': (self._fingerprint, self._chunk_fingerprints),
+        }
+        tree = self._edoc if self._edoc is not None else self._pristine
+        if tree is None and self._source is not None:
+            state['source'] = self._source.data[:]
+            state['lazy'] = self.is_lazy
+        else:
+            state['tree'] = etree.tostring(tree, encoding='utf-8')
+        return state
+
+    def __setstate__(self, state):
+        self.header_only = state['header_only']
+        if 'tree' in state:
+            tree = parse_xml_string(state['tree'])
+        elif state['lazy']:
+            body = BodyIndex(state['source'])
+            tree = body.skeleton()
+        else:
+            tree = parse_header(state['source'])
+        self.__init__(tree, parse_dublincore=state['book_info'] is not None,
+                      provider=state['provider'], book_info=state['book_info'])
+        if 'source' in state:
+            self._edoc = self._rdf_elem = None
+            if state['lazy']:
+                self.skeleton, self._source = tree, body
+            else:
+                self._source = Source(state['source'])
+        self._fingerprint, self._chunk_fingerprints = state['fingerprints']
+
     @classmethod
     def from_string(cls, xml, *args, **kwargs):
-        return cls.from_file(StringIO(xml), *args, **kwargs)
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        return cls.from_bytes(xml, *args, **kwargs)
 
     @classmethod
-    def from_file(cls, xmlfile, *args, **kwargs):
+    def from_bytes(cls, data, *args, **kwargs):
+        """Parses a document from a byte string or a buffer (like a mmap).
 
-        # first, prepare for parsing
-        if isinstance(xmlfile, basestring):
-            file = open(xmlfile, 'rb')
+        With `lazy=True` or `header_only=True`, data is kept for parsing
+        the main text later, and with `incremental=True` for
+        serialize_incremental(), so it shouldn't be modified or closed.
+        """
+        lazy = kwargs.pop('lazy', False)
+        if kwargs.pop('incremental', False):
             try:
-                data = file.read()
-            finally:
-                file.close()
-        else:
-            data = xmlfile.read()
+                body = BodyIndex(data)
+            except (ValueError, ExpatError):
+                body = None
+            try:
+                doc = cls(parse_xml_string(data), *args, **kwargs)
+            except (ExpatError, XMLSyntaxError, XSLTApplyError), e:
+                raise ParseError(e)
+            if body is not None:
+                doc._source = body
+                doc._changed = set()
+                doc._digests = doc._source_digests()
+                if doc.book_info is not None:
+                    doc._dc_fingerprint = node_fingerprint(
+                        doc.book_info.to_etree())
+            return doc
+        elif kwargs.pop('header_only', False):
+            try:
+                tree = parse_header(data)
+            except XMLSyntaxError, e:
+                raise ParseError(e)
+            if tree is not None:
+                doc = cls.__new__(cls)
+                doc.header_only = True
+                doc.__init__(tree, *args, **kwargs)
+                doc._edoc = doc._rdf_elem = None
+                doc._source = Source(data)
+                return doc
+        elif lazy:
+            try:
+                body = BodyIndex(data)
+            except (ValueError, ExpatError):
+                # Nothing to be lazy about, or let lxml report the error.
+                pass
+            else:
+                try:
+                    doc = cls(body.skeleton(), *args, **kwargs)
+                except (XMLSyntaxError, XSLTApplyError), e:
+                    raise ParseError(e)
+                doc.skeleton, doc._edoc = doc._edoc, None
+                doc._rdf_elem = None
+                doc._source = body
+                return doc
+        try:
+            tree = parse_xml_string(data)
+            return cls(tree, *args, **kwargs)
+        except (ExpatError, XMLSyntaxError, XSLTApplyError), e:
+            raise ParseError(e)
 
-        if not isinstance(data, unicode):
-            data = data.decode('utf-8')
+    @classmethod
+    def from_file(cls, xmlfile, *args, **kwargs):
+        """Parses a document from a path, a file-like object or a parsed tree.
 
-        data = data.replace(u'\ufeff', '')
+        Uses the DocumentCache passed as `cache` or set as the `cache`
+        class attribute, unless `cache=False` is passed.
 
-        try:
-            parser = etree.XMLParser(remove_blank_text=False)
-            tree = etree.parse(StringIO(data.encode('utf-8')), parser)
+        With `lazy=True`, only the document's skeleton is parsed, and
+        the main text is parsed one top-level element at a time when
+        needed (see is_lazy).
 
+        With `header_only=True`, parsing stops after Dublin Core, which
+        is enough for book_info, parts() and editors(). The rest is
+        parsed when edoc is first used. Parts of such a document are
+        opened header-only as well.
+
+        With `incremental=True`, the source is kept for
+        serialize_incremental().
+        """
+        cache = kwargs.pop('cache', None)
+        if (kwargs.get('lazy') or kwargs.get('header_only') or
+                kwargs.get('incremental')) and not isinstance(
+                xmlfile, (etree._ElementTree, etree._Element)):
+            data = map_xml_file(xmlfile)
+            doc = None
+            try:
+                doc = cls.from_bytes(data, *args, **kwargs)
+                return doc
+            finally:
+                # Unless the document parses the rest of it later.
+                if isinstance(data, mmap.mmap) and (
+                        doc is None or doc._source is None):
+                    data.close()
+        kwargs.pop('lazy', None)
+        kwargs.pop('header_only', None)
+        kwargs.pop('incremental', None)
+
+        if cache is None:
+            cache = cls.cache
+        if cache:
+            return cache.load(cls, xmlfile, *args, **kwargs)
+
+        try:
+            tree = parse_xml_file(xmlfile)
             return cls(tree, *args, **kwargs)
         except (ExpatError, XMLSyntaxError, XSLTApplyError), e:
             raise ParseError(e)
 
-    def swap_endlines(self):
-        """Converts line breaks in stanzas into <br/> tags."""
+    def swap_endlines(self, elem=None):
+        """Converts line breaks in stanzas into <br/> tags.
+
+        Works on the whole document, or only inside elem.
+        """
+        split = self.LINE_SWAP_EXPR.split
+
+        def breaks(chunks):
+            for chunk in chunks:
+                br = etree.Element('br')
+                br.tail = chunk
+                yield br
+
+        if elem is None:
+            elem = self.edoc
         # only swap inside stanzas
-        for elem in self.edoc.iter('strofa'):
-            for child in list(elem):
-                if child.tail:
-                    chunks = self.LINE_SWAP_EXPR.split(child.tail)
-                    ins_index = elem.index(child) + 1
-                    while len(chunks) > 1:
-                        ins = etree.Element('br')
-                        ins.tail = chunks.pop()
-                        elem.insert(ins_index, ins)
-                    child.tail = chunks.pop(0)
+        for elem in elem.iter('strofa'):
+            # Build the new list of children in one pass.
+            children = []
+            changed = False
             if elem.text:
-                chunks = self.LINE_SWAP_EXPR.split(elem.text)
-                while len(chunks) > 1:
-                    ins = etree.Element('br')
-                    ins.tail = chunks.pop()
-                    elem.insert(0, ins)
-                elem.text = chunks.pop(0)
-
-    def parts(self):
+                chunks = split(elem.text)
+                if len(chunks) > 1:
+                    elem.text = chunks[0]
+                    children.extend(breaks(chunks[1:]))
+                    changed = True
+            for child in elem:
+                children.append(child)
+                if child.tail:
+                    chunks = split(child.tail)
+                    if len(chunks) > 1:
+                        child.tail = chunks[0]
+                        children.extend(breaks(chunks[1:]))
+                        changed = True
+            if changed:
+                elem[:] = children
+                self._touch(elem)
+
+    def parts(self, header_only=False, prefetch=False):
+        """Yields the parts of the document.
+
+        Parts are opened header-only if header_only is set, or if this
+        document is, which is enough for their book_info and parts().
+        With prefetch, the provider is told about all of them first,
+        so it can fetch or parse them ahead.
+        """
         if self.provider is None:
             raise NoProvider('No document provider supplied.')
         if self.book_info is None:
             raise NoDublinCore('No Dublin Core in document.')
+        kwargs = self._part_kwargs(header_only)
+        if prefetch and self.book_info.parts:
+            self.provider.prefetch(self.book_info.parts, type(self), **kwargs)
         for part_uri in self.book_info.parts:
-            yield self.from_file(self.provider.by_uri(part_uri),
-                    provider=self.provider)
+            yield self.provider.document_by_uri(part_uri, type(self), **kwargs)
+
+    def _part_kwargs(self, header_only=False):
+        return {'header_only': True} if header_only or self.header_only else {}
 
     def chunk(self, path):
         # convert the path to XPath
@@ -113,11 +400,15 @@ class WLDocument(object):
         else:
             return elems[0]
 
+    def chunk_index(self):
+        """Returns a ChunkIndex, for reading and merging many chunks."""
+        return ChunkIndex(self)
+
     def path_to_xpath(self, path):
         parts = []
 
         for part in path.split('/'):
-            match = re.match(r'([^\[]+)\[(\d+)\]', part)
+            match = STEP.match(part)
             if not match:
                 parts.append(part)
             else:
@@ -130,17 +421,131 @@ class WLDocument(object):
         return '/'.join(parts)
 
     def transform(self, stylesheet, **options):
+        if isinstance(stylesheet, etree.XSLT):
+            return stylesheet(self.edoc, **options)
         return self.edoc.xslt(stylesheet, **options)
 
     def update_dc(self):
         if self.book_info:
             parent = self.rdf_elem.getparent()
-            parent.replace( self.rdf_elem, self.book_info.to_etree(parent) )
+            new_rdf_elem = self.book_info.to_etree(parent)
+            parent.replace( self.rdf_elem, new_rdf_elem )
+            self.rdf_elem = new_rdf_elem
+            self._fingerprint = None
 
     def serialize(self):
         self.update_dc()
         return etree.tostring(self.edoc, encoding=unicode, pretty_print=True)
 
+    def _touch(self, elem):
+        """Notes that elem has changed.
+
+        Fingerprints are computed again, and serialize_incremental()
+        splices in the node elem is in.
+        """
+        self._fingerprint = self._chunk_fingerprints = None
+        if self._changed is None:
+            return
+        main_text = self.main_text()
+        root = self.edoc.getroot()
+        # Find the top-level node elem is in.
+        node, parent = elem, elem.getparent()
+        while parent is not None and parent is not main_text and \
+                parent is not root:
+            node, parent = parent, parent.getparent()
+        if parent is not None and parent is main_text:
+            self._changed.add(main_text.index(node))
+        elif parent is root and node is self.rdf_elem and \
+                self._source.dc_start is not None:
+            self._changed.add('dc')
+        else:
+            # Can't be spliced in, serialize everything.
+            self._changed.add(None)
+
+    def _source_digests(self):
+        """Returns digests of the tree, to find out what serialize_incremental()
+        can copy from the source.
+
+        That's a digest of everything outside the main text's top-level
+        nodes (but Dublin Core, which comes from book_info), and for
+        each of these nodes, a digest of the node and its tail.
+        """
+        root = self.edoc.getroot()
+        main_text = self.main_text()
+        outline = hashlib.sha1()
+        for node in root.iter():
+            if node is main_text:
+                outline.update(repr((node.tag, sorted(node.attrib.items()),
+                                     node.text, node.tail)))
+            elif node is root:
+                outline.update(repr((node.tag, sorted(node.attrib.items()),
+                                     node.text)))
+            elif node.getparent() is root:
+                if node is self.rdf_elem and self.book_info is not None:
+                    outline.update(repr(node.tail))
+                else:
+                    outline.update(etree.tostring(node, encoding='utf-8'))
+        nodes = [(hashlib.sha1(etree.tostring(
+                      node, encoding='utf-8', with_tail=False)).digest(), node.tail)
+                 for node in main_text]
+        return outline.digest(), nodes
+
+    def serialize_incremental(self):
+        """Serializes the document, reusing its source where possible.
+
+        For a document opened with `incremental=True`, only top-level
+        elements of the main text that have changed, and Dublin Core
+        if book_info has changed, are serialized again. The rest is
+        copied from the source, so it keeps its formatting. Otherwise,
+        or if anything else has changed, falls back to serialize(),
+        encoded in UTF-8.
+        """
+        if self._changed is not None and self.book_info is not None and \
+                node_fingerprint(self.book_info.to_etree()) != self._dc_fingerprint:
+            self.update_dc()
+            self._touch(self.rdf_elem)
+        main_text = self.main_text()
+        if self._changed is None or None in self._changed or \
+                main_text is None or len(main_text) != len(self._source):
+            return self.serialize().encode('utf-8')
+
+        # Changes made straight to the tree aren't noted by _touch().
+        outline, nodes = self._source_digests()
+        if outline != self._digests[0]:
+            return self.serialize().encode('utf-8')
+        changed = set(self._changed)
+        for i, (digest, old_digest) in enumerate(zip(nodes, self._digests[1])):
+            if digest[1] != old_digest[1] and i not in changed:
+                # Tails aren't spliced in. Merged chunks lose their
+                # tails in the tree, but keep them in the output.
+                return self.serialize().encode('utf-8')
+            if digest[0] != old_digest[0]:
+                changed.add(i)
+
+        source = self._source
+        encoding = self.edoc.docinfo.encoding or 'utf-8'
+        splices = []
+        for i in changed:
+            if i == 'dc':
+                splices.append((source.dc_start, source.dc_end, self.rdf_elem))
+            elif source.ends[i] is None:
+                # A comment or processing instruction.
+                return self.serialize().encode('utf-8')
+            else:
+                splices.append((source.offsets[i], source.ends[i], main_text[i]))
+        splices.sort()
+        output = []
+        position = 0
+        for start, end, elem in splices:
+            output.append(source.data[position:start])
+            # Pretty printed like serialize() does, without the tail.
+            output.append(etree.tostring(
+                elem, encoding=encoding, xml_declaration=False, with_tail=False,
+                pretty_print=True).rstrip('\n'))
+            position = end
+        output.append(source.data[position:])
+        return ''.join(output)
+
     def merge_chunks(self, chunk_dict):
         unmerged = []
 
@@ -152,6 +557,8 @@ class WLDocument(object):
                 node.getparent().replace(node, repl)
             except Exception, e:
                 unmerged.append( repr( (key, xpath, e) ) )
+            else:
+                self._touch(repl)
 
         return unmerged
 
@@ -164,6 +571,7 @@ class WLDocument(object):
             node.clear()
             node.tag = 'span'
             node.tail = tail
+            self._touch(node)
 
     def editors(self):
         """Returns a set of all editors for book and its children.
@@ -174,12 +582,63 @@ class WLDocument(object):
             raise NoDublinCore('No Dublin Core in document.')
         persons = set(self.book_info.editors +
                         self.book_info.technical_editors)
-        for child in self.parts():
+        # Only Dublin Core of the parts is needed.
+        for child in self.parts(header_only=True):
             persons.update(child.editors())
         if None in persons:
             persons.remove(None)
         return persons
 
+    def chunk_fingerprints(self):
+        """Returns canonical hashes of the main text's top-level nodes.
+
+        Hashes are hex strings, in the order of body_tags(). A lazy
+        document is hashed without parsing all of it at once.
+        """
+        if self._chunk_fingerprints is None:
+            self._chunk_fingerprints = [
+                node_fingerprint(node) for node in self.iter_body()]
+        return self._chunk_fingerprints
+
+    def fingerprint(self, flags=()):
+        """Returns a canonical hash of the document and all its parts.
+
+        The hash doesn't depend on insignificant whitespace, comments
+        or the order of Dublin Core fields, so it can be used as a cache
+        key. Flags, like the ones passed to converters, are included
+        if given. Parts are loaded with the provider.
+
+        Hashes are memoized. They're forgotten when edoc is replaced
+        or changed with the document's methods, like merge_chunks(), but
+        not when the tree is modified directly.
+        """
+        if self._fingerprint is None:
+            tree = self.skeleton if self.is_lazy else self.edoc
+            root = tree.getroot()
+            main_text = self.main_text(tree)
+            hasher = Hasher()
+            hasher.start(root)
+            for node in root:
+                if node is main_text:
+                    hasher.start(node)
+                    for tag, chunk in zip(self.body_tags(),
+                                          self.chunk_fingerprints()):
+                        if tag is not etree.Comment:
+                            hasher.token('#', chunk)
+                    hasher.end()
+                else:
+                    hasher.node(node)
+            hasher.end()
+            if self.book_info is not None and self.book_info.parts:
+                for part in self.parts():
+                    hasher.token('+', part.fingerprint())
+            self._fingerprint = hasher.hexdigest()
+        if not flags:
+            return self._fingerprint
+        hasher = Hasher()
+        hasher.token('=', self._fingerprint, *sorted(flags))
+        return hasher.hexdigest()
+
     # Converters
 
     def as_html(self, *args, **kwargs):
@@ -208,6 +667,7 @@ class WLDocument(object):
 
     def as_cover(self, cover_class=None, *args, **kwargs):
         if cover_class is None:
+            from librarian.cover import DefaultEbookCover
             cover_class = DefaultEbookCover
         return cover_class(self.book_info, *args, **kwargs).output_file()
 
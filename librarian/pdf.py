@@ -19,27 +19,33 @@ import re
 from copy import deepcopy
 from subprocess import call, PIPE
 
-from Texml.processor import process
 from lxml import etree
 from lxml.etree import XMLSyntaxError, XSLTApplyError
 
 from librarian.dcparser import Person
 from librarian.parser import WLDocument
-from librarian import ParseError, DCNS, get_resource, OutputFile
+from librarian import ParseError, DCNS, get_resource, get_xslt, read_resource, OutputFile
 from librarian import functions
-from librarian.cover import DefaultEbookCover
 from .sponsor import sponsor_logo
 
 
-functions.reg_substitute_entities()
 functions.reg_strip()
 functions.reg_starts_white()
 functions.reg_ends_white()
 functions.reg_texcommand()
 
+PARTS_PI = re.compile(r'<\?parts\s*\?>')
+
 STYLESHEETS = {
     'wl2tex': 'pdf/wl2tex.xslt',
 }
+# Copied next to the TeX file.
+RESOURCES = (
+    'pdf/wl.cls',
+    'res/wl-logo.png',
+)
+# Width of the cover image rendered for the PDF.
+COVER_WIDTH = 1200
 
 #CUSTOMIZATIONS = [
 #    'nofootnotes',
@@ -59,25 +65,38 @@ def insert_tags(doc, split_re, tagname, exclude=None):
     <a><b>A<d/>B<d/>C</b>X<d/>Y<d/>Z</a>
     """
 
+    def tags(chunks):
+        for chunk in chunks:
+            ins = etree.Element(tagname)
+            ins.tail = chunk
+            yield ins
+
+    def splits(elem):
+        # Comments and such have always been left alone.
+        return (isinstance(elem.tag, basestring) and
+                not (exclude and elem.tag in exclude))
+
+    # Each element gets its new list of children built in one pass,
+    # its text and its children's tails split together.
     for elem in doc.iter(tag=etree.Element):
-        if exclude and elem.tag in exclude:
-            continue
-        if elem.text:
+        children = []
+        changed = False
+        if elem.text and splits(elem):
             chunks = split_re.split(elem.text)
-            while len(chunks) > 1:
-                ins = etree.Element(tagname)
-                ins.tail = chunks.pop()
-                elem.insert(0, ins)
-            elem.text = chunks.pop(0)
-        if elem.tail:
-            chunks = split_re.split(elem.tail)
-            parent = elem.getparent()
-            ins_index = parent.index(elem) + 1
-            while len(chunks) > 1:
-                ins = etree.Element(tagname)
-                ins.tail = chunks.pop()
-                parent.insert(ins_index, ins)
-            elem.tail = chunks.pop(0)
+            if len(chunks) > 1:
+                elem.text = chunks[0]
+                children.extend(tags(chunks[1:]))
+                changed = True
+        for child in elem:
+            children.append(child)
+            if child.tail and splits(child):
+                chunks = split_re.split(child.tail)
+                if len(chunks) > 1:
+                    child.tail = chunks[0]
+                    children.extend(tags(chunks[1:]))
+                    changed = True
+        if changed:
+            elem[:] = children
 
 
 def substitute_hyphens(doc):
@@ -171,6 +190,18 @@ def parse_creator(doc):
         person.getparent().insert(0, person_parsed)
 
 
+def hack_tree(doc):
+    """ prepares the document tree for the wl2tex stylesheet """
+    move_motifs_inside(doc)
+    hack_motifs(doc)
+    parse_creator(doc)
+    substitute_hyphens(doc)
+    fix_hanging(doc)
+    fix_tables(doc)
+    functions.substitute_entities(doc, exclude=[
+        DCNS('identifier.url'), DCNS('rights.license'), 'mat'])
+
+
 def get_stylesheet(name):
     return get_resource(STYLESHEETS[name])
 
@@ -196,7 +227,7 @@ def package_available(package, args='', verbose=False):
 
 
 def transform(wldoc, verbose=False, save_tex=None, morefloats=None,
-              cover=None, flags=None, customizations=None):
+              cover=None, flags=None, customizations=None, streaming=False):
     """ produces a PDF file with XeLaTeX
 
     wldoc: a WLDocument
@@ -206,18 +237,27 @@ def transform(wldoc, verbose=False, save_tex=None, morefloats=None,
     cover: a cover.Cover factory or True for default
     flags: less-advertising,
     customizations: user requested customizations regarding various formatting parameters (passed to wl LaTeX class)
+    streaming: transforms parts of the book one by one, writing their TeXML
+        to a file, so only one of them is in memory at a time
     """
 
     # Parse XSLT
     try:
         book_info = wldoc.book_info
-        document = load_including_children(wldoc)
+        if streaming:
+            document = load_part(wldoc)
+            if book_info.parts:
+                add_parts_placeholder(document)
+        else:
+            document = load_including_children(wldoc)
+        provider = document.provider
         root = document.edoc.getroot()
 
         if cover:
             if cover is True:
+                from librarian.cover import DefaultEbookCover
                 cover = DefaultEbookCover
-            bound_cover = cover(book_info, width=1200)
+            bound_cover = cover(book_info, width=COVER_WIDTH)
             root.set('data-cover-width', str(bound_cover.width))
             root.set('data-cover-height', str(bound_cover.height))
             if bound_cover.uses_dc_cover:
@@ -251,16 +291,10 @@ def transform(wldoc, verbose=False, save_tex=None, morefloats=None,
             root.set('thanks', document.book_info.thanks)
 
         # hack the tree
-        move_motifs_inside(document.edoc)
-        hack_motifs(document.edoc)
-        parse_creator(document.edoc)
-        substitute_hyphens(document.edoc)
-        fix_hanging(document.edoc)
-        fix_tables(document.edoc)
+        hack_tree(document.edoc)
 
         # wl -> TeXML
-        style_filename = get_stylesheet("wl2tex")
-        style = etree.parse(style_filename)
+        style = get_xslt(get_stylesheet("wl2tex"))
         functions.reg_mathml_latex()
 
         # TeXML -> LaTeX
@@ -286,18 +320,36 @@ def transform(wldoc, verbose=False, save_tex=None, morefloats=None,
 
         del document # no longer needed large object :)
 
+        from Texml.processor import process
         tex_path = os.path.join(temp, 'doc.tex')
         fout = open(tex_path, 'w')
-        process(StringIO(texml), fout, 'utf-8')
+        if streaming:
+            def render_part(uri):
+                part = load_part(provider=provider, uri=uri)
+                if part.book_info.parts:
+                    add_parts_placeholder(part)
+                hack_tree(part.edoc)
+                return (split_texml(part.transform(style, part='1'), fragment=True),
+                        part.book_info.parts)
+
+            texml_path = os.path.join(temp, 'doc.texml')
+            with open(texml_path, 'w') as f:
+                write_texml(f, split_texml(texml), book_info.parts, render_part)
+            del texml
+            with open(texml_path) as f:
+                process(f, fout, 'utf-8')
+        else:
+            process(StringIO(texml), fout, 'utf-8')
+            del texml
         fout.close()
-        del texml
 
         if save_tex:
             shutil.copy(tex_path, save_tex)
 
         # LaTeX -> PDF
-        shutil.copy(get_resource('pdf/wl.cls'), temp)
-        shutil.copy(get_resource('res/wl-logo.png'), temp)
+        for path in RESOURCES:
+            with open(os.path.join(temp, os.path.basename(path)), 'wb') as f:
+                f.write(read_resource(path))
 
         try:
             cwd = os.getcwd()
@@ -331,23 +383,112 @@ def load_including_children(wldoc=None, provider=None, uri=None):
     Either wldoc or provider and URI must be provided.
     """
 
+    document = load_part(wldoc, provider, uri)
+    for child_uri in document.book_info.parts:
+        child = load_including_children(provider=document.provider, uri=child_uri)
+        document.edoc.getroot().append(child.edoc.getroot())
+    return document
+
+
+ALIEN_EXPR = re.compile(ur"[\u0400-\u04ff]+")
+
+
+def mark_aliens(root):
+    """ Wraps runs of Cyrillic text in <alien> elements, in place. """
+
+    def split(text):
+        parts = ALIEN_EXPR.split(text)
+        return parts[0], zip(ALIEN_EXPR.findall(text), parts[1:])
+
+    for element in list(root.iter(tag=etree.Element)):
+        if element.text and ALIEN_EXPR.search(element.text):
+            element.text, aliens = split(element.text)
+            for i, (alien, tail) in enumerate(aliens):
+                new = etree.Element('alien')
+                new.text, new.tail = alien, tail or None
+                element.insert(i, new)
+            if element.text == '':
+                element.text = None
+        if element.tail and ALIEN_EXPR.search(element.tail):
+            element.tail, aliens = split(element.tail)
+            previous = element
+            for alien, tail in aliens:
+                new = etree.Element('alien')
+                new.text, new.tail = alien, tail or None
+                previous.addnext(new)
+                previous = new
+            if element.tail == '':
+                element.tail = None
+
+
+def load_part(wldoc=None, provider=None, uri=None):
+    """ Loads a single part of a book, like load_including_children,
+    but without its children.
+
+    A part is fetched with provider.document_by_uri(), so a
+    CachingDocProvider passed in is used.
+    """
+
     if uri and provider:
-        f = provider.by_uri(uri)
-        text = f.read().decode('utf-8')
-        f.close()
+        document = provider.document_by_uri(uri, WLDocument)
     elif wldoc is not None:
-        text = etree.tostring(wldoc.edoc, encoding=unicode)
-        provider = wldoc.provider
+        document = wldoc.fork()
     else:
         raise ValueError('Neither a WLDocument, nor provider and URI were provided.')
 
-    text = re.sub(ur"([\u0400-\u04ff]+)", ur"<alien>\1</alien>", text)
-
-    document = WLDocument.from_string(text,
-                parse_dublincore=True, provider=provider)
+    mark_aliens(document.edoc.getroot())
     document.swap_endlines()
-
-    for child_uri in document.book_info.parts:
-        child = load_including_children(provider=provider, uri=child_uri)
-        document.edoc.getroot().append(child.edoc.getroot())
     return document
+
+
+def add_parts_placeholder(document):
+    """ Marks where the parts go, for them to be rendered separately. """
+    etree.SubElement(document.edoc.getroot(), 'utwor',
+                     {'data-parts-placeholder': 'yes'})
+
+
+def split_texml(texml, fragment=False):
+    """ Serializes TeXML, split where the parts go.
+
+    Returns the TeXML before and after the parts (None if there's no
+    place for them). A fragment is serialized without XML declaration.
+    """
+    marker = texml.getroot().find('.//parts-placeholder')
+    if marker is not None:
+        pi = etree.ProcessingInstruction('parts')
+        pi.tail = marker.tail
+        marker.getparent().replace(marker, pi)
+    text = str(texml)
+    if fragment and text.startswith('<?xml'):
+        text = text[text.index('?>') + 2:]
+    if marker is None:
+        return text, None
+    before, after = PARTS_PI.split(text, 1)
+    return before, after
+
+
+def write_texml(output, texml, parts, render_part):
+    """ Writes out TeXML split by split_texml, with the parts in place.
+
+    render_part(uri) should return a part's split TeXML and its own
+    parts. Parts are rendered one by one, so only one of them needs
+    to be in memory at a time.
+    """
+    before, after = texml
+    output.write(before)
+    for uri in parts:
+        part_texml, part_parts = render_part(uri)
+        write_texml(output, part_texml, part_parts, render_part)
+        del part_texml
+    if after is not None:
+        output.write(after)
+
+
+def warmup(languages=()):
+    """Compiles stylesheets, loads cover fonts and LaTeX resources."""
+    for name in STYLESHEETS:
+        get_xslt(get_stylesheet(name))
+    for path in RESOURCES:
+        read_resource(path)
+    from librarian.cover import DefaultEbookCover
+    DefaultEbookCover.warmup(width=COVER_WIDTH)
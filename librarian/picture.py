@@ -1,9 +1,9 @@
 
 from dcparser import (as_person, as_date, Field, WorkInfo, DCNS)
-from librarian import (RDFNS, ValidationError, NoDublinCore, ParseError, WLURI)
+from librarian import (RDFNS, ValidationError, NoDublinCore, ParseError, WLURI,
+                       parse_xml_file, parse_xml_string)
 from xml.parsers.expat import ExpatError
 from os import path
-from StringIO import StringIO
 from lxml import etree
 from lxml.etree import (XMLSyntaxError, XSLTApplyError, Element)
 import re
@@ -99,39 +99,40 @@ class WLPicture(object):
 
     @classmethod
     def from_string(cls, xml, *args, **kwargs):
-        return cls.from_file(StringIO(xml), *args, **kwargs)
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        return cls.from_bytes(xml, *args, **kwargs)
 
     @classmethod
-    def from_file(cls, xmlfile, parse_dublincore=True, image_store=None):
-
-        # first, prepare for parsing
-        if isinstance(xmlfile, basestring):
-            file = open(xmlfile, 'rb')
-            try:
-                data = file.read()
-            finally:
-                file.close()
-        else:
-            data = xmlfile.read()
-
-        if not isinstance(data, unicode):
-            data = data.decode('utf-8')
-
-        data = data.replace(u'\ufeff', '')
+    def from_bytes(cls, data, parse_dublincore=True, image_store=None):
+        """Parses a picture from a byte string or a buffer (like a mmap)."""
+        try:
+            tree = parse_xml_string(data)
+        except (ExpatError, XMLSyntaxError, XSLTApplyError), e:
+            raise ParseError(e)
+        return cls._from_tree(tree, parse_dublincore, image_store)
 
+    @classmethod
+    def from_file(cls, xmlfile, parse_dublincore=True, image_store=None):
+        """Parses a picture from a path, a file-like object or a parsed tree."""
         # assume images are in the same directory
-        if image_store is None and xmlfile.name is not None:
-            image_store = ImageStore(path.dirname(xmlfile.name))
+        if image_store is None:
+            if isinstance(xmlfile, basestring):
+                image_store = ImageStore(path.dirname(xmlfile))
+            elif getattr(xmlfile, 'name', None) is not None:
+                image_store = ImageStore(path.dirname(xmlfile.name))
 
         try:
-            parser = etree.XMLParser(remove_blank_text=False)
-            tree = etree.parse(StringIO(data.encode('utf-8')), parser)
-
-            me =  cls(tree, parse_dublincore=parse_dublincore, image_store=image_store)
-            me.load_frame_info()
-            return me
+            tree = parse_xml_file(xmlfile)
         except (ExpatError, XMLSyntaxError, XSLTApplyError), e:
             raise ParseError(e)
+        return cls._from_tree(tree, parse_dublincore, image_store)
+
+    @classmethod
+    def _from_tree(cls, tree, parse_dublincore, image_store):
+        me = cls(tree, parse_dublincore=parse_dublincore, image_store=image_store)
+        me.load_frame_info()
+        return me
 
     @property
     def mime_type(self):
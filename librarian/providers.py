@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""Document providers serving a corpus from a single file or over HTTP.
+
+Providers are pickled by their settings, so that documents can be sent
+to worker processes along with them. They're opened again when
+unpickled.
+"""
+from __future__ import with_statement
+from contextlib import closing
+from cStringIO import StringIO
+import errno
+import hashlib
+import httplib
+import json
+import mmap
+from multiprocessing.pool import ThreadPool
+import os
+import socket
+import sqlite3
+import struct
+from tempfile import NamedTemporaryFile
+import threading
+import time
+import urllib
+import urlparse
+import zipfile
+import zlib
+
+from librarian import DocProvider, WLURI, URLOpener
+
+
+class BytesDocProvider(DocProvider):
+    """Base class for providers fetching raw document bytes.
+
+    Subclasses implement bytes_by_slugs(), returning document bytes
+    for many slugs at once. Documents are parsed straight from them.
+    Documents passed to prefetch(), like the parts of a book, are
+    fetched all at once with by_slugs() and kept until asked for.
+    """
+
+    _prefetched = None
+
+    def bytes_by_slugs(self, slugs):
+        """Should return a dict mapping slugs to document bytes."""
+        raise NotImplementedError
+
+    def bytes_by_slug(self, slug):
+        data = self._pop_prefetched(slug)
+        if data is not None:
+            return data
+        try:
+            return self.bytes_by_slugs([slug])[slug]
+        except KeyError:
+            raise IOError('No such document: %s' % slug)
+
+    def prefetch(self, uris, doc_class, **kwargs):
+        try:
+            files = self.by_slugs([WLURI(uri).slug for uri in uris])
+        except IOError:
+            # It's just a hint, errors are raised when the document is needed.
+            return
+        # Only the latest documents are kept, they're about to be needed.
+        self._prefetched = files
+
+    def _pop_prefetched(self, slug):
+        if self._prefetched:
+            f = self._prefetched.pop(slug, None)
+            if f is not None:
+                return f.read()
+
+    def by_slug(self, slug):
+        return StringIO(self.bytes_by_slug(slug))
+
+    def by_slugs(self, slugs):
+        return dict((slug, StringIO(data))
+                    for slug, data in self.bytes_by_slugs(slugs).items())
+
+    def document_by_uri(self, uri, doc_class, **kwargs):
+        data = self.bytes_by_slug(WLURI(uri).slug)
+        return doc_class.from_bytes(data, provider=self, **kwargs)
+
+
+class CorpusDocProvider(BytesDocProvider):
+    """Base class for providers keeping all documents in one file,
+    indexed by slug in self.index."""
+
+    def slugs(self):
+        """Lists slugs of all the documents."""
+        return sorted(self.index)
+
+
+class ZipDocProvider(CorpusDocProvider):
+    """Serves documents from <slug>.xml files in a ZIP archive.
+
+    The archive is memory-mapped and indexed by slug when opened.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = {}
+        with closing(zipfile.ZipFile(path)) as zipf:
+            for info in zipf.infolist():
+                name, ext = os.path.splitext(os.path.basename(info.filename))
+                if ext != '.xml':
+                    continue
+                if name in self.index:
+                    raise IOError('Duplicate document %s in %s: %s and %s' % (
+                        name, path, self.index[name].filename, info.filename))
+                self.index[name] = info
+
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def close(self):
+        self.map.close()
+
+    def _read(self, info):
+        # Data follows the local file header, whose extra field
+        # may differ from the one in the central directory.
+        offset = info.header_offset
+        name_length, extra_length = struct.unpack(
+            '<HH', self.map[offset + 26:offset + 30])
+        start = offset + 30 + name_length + extra_length
+        data = self.map[start:start + info.compress_size]
+        if info.compress_type == zipfile.ZIP_STORED:
+            return data
+        elif info.compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -15)
+        raise IOError('Unsupported compression in %s: %s' % (
+            self.path, info.filename))
+
+    def bytes_by_slugs(self, slugs):
+        return dict((slug, self._read(self.index[slug]))
+                    for slug in slugs if slug in self.index)
+
+    def mtime_by_slug(self, slug):
+        info = self.index.get(slug)
+        if info is not None:
+            return time.mktime(info.date_time + (0, 0, -1))
+
+
+class SQLiteDocProvider(CorpusDocProvider):
+    """Serves documents from an SQLite database.
+
+    Documents are stored in a `documents (slug, xml, mtime)` table,
+    read through SQLite's memory-mapped I/O. The slug index is loaded
+    when opening the database.
+    """
+
+    SCHEMA = """CREATE TABLE IF NOT EXISTS documents (
+        slug TEXT PRIMARY KEY, xml BLOB NOT NULL, mtime REAL)"""
+
+    def __init__(self, path, mmap_size=256 * 1024 * 1024):
+        self.path = path
+        self.mmap_size = mmap_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA mmap_size = %d' % mmap_size)
+        self.db.execute(self.SCHEMA)
+        self.index = dict(self.db.execute('SELECT slug, mtime FROM documents'))
+
+    def __getstate__(self):
+        return self.path, self.mmap_size
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def close(self):
+        self.db.close()
+
+    def store(self, slug, data, mtime=None):
+        """Adds or replaces a document."""
+        if mtime is None:
+            mtime = time.time()
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO documents VALUES (?, ?, ?)',
+                                (slug, sqlite3.Binary(data), mtime))
+            self.index[slug] = mtime
+
+    def import_files(self, paths):
+        """Stores <slug>.xml files."""
+        for path in paths:
+            slug = os.path.splitext(os.path.basename(path))[0]
+            with open(path, 'rb') as f:
+                self.store(slug, f.read(), os.path.getmtime(path))
+
+    def bytes_by_slugs(self, slugs):
+        slugs = [slug for slug in slugs if slug in self.index]
+        result = {}
+        with self.lock:
+            # Stay below SQLite's default limit of 999 variables.
+            for start in xrange(0, len(slugs), 500):
+                batch = slugs[start:start + 500]
+                result.update((slug, str(xml)) for slug, xml in self.db.execute(
+                    'SELECT slug, xml FROM documents WHERE slug IN (%s)' %
+                    ','.join('?' * len(batch)), batch))
+        return result
+
+    def mtime_by_slug(self, slug):
+        return self.index.get(slug)
+
+
+class HTTPDocProvider(BytesDocProvider):
+    """Fetches documents over HTTP.
+
+    url_template is formatted with a document's slug, like
+    'http://example.com/documents/%s.xml'. Connections are kept alive
+    and reused, up to max_connections per host. With a cache_dir,
+    responses are kept on disk and revalidated with ETag and
+    Last-Modified, so unchanged documents aren't downloaded again.
+
+    mtime_by_slug() returns a document's ETag or Last-Modified, so a
+    CachingDocProvider wrapping this one parses a document again only
+    when it changes. It sends a conditional GET with the validators
+    last seen. If the document has changed, the body that came with
+    the answer is kept for the parse that follows, so each lookup
+    takes one request.
+    """
+
+    def __init__(self, url_template, cache_dir=None, max_connections=4,
+                 timeout=30):
+        self.url_template = url_template
+        self.cache_dir = cache_dir
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle = {}
+        self.open_connections = {}
+        self.lock = threading.Condition()
+        self.requests = 0
+        self.not_modified = 0
+        self.validators = {}
+        self.fresh = {}
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __getstate__(self):
+        return (self.url_template, self.cache_dir, self.max_connections,
+                self.timeout)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def url(self, slug):
+        return self.url_template % urllib.quote(slug)
+
+    def _acquire(self, host):
+        with self.lock:
+            while True:
+                idle = self.idle.setdefault(host, [])
+                if idle:
+                    return idle.pop()
+                if self.open_connections.get(host, 0) < self.max_connections:
+                    self.open_connections[host] = self.open_connections.get(host, 0) + 1
+                    break
+                self.lock.wait()
+        scheme, netloc = host
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _release(self, host, connection, reuse):
+        with self.lock:
+            if reuse:
+                self.idle[host].append(connection)
+            else:
+                connection.close()
+                self.open_connections[host] -= 1
+            self.lock.notify()
+
+    def _get(self, url, headers):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        host = scheme, netloc
+        headers['User-Agent'] = URLOpener.version
+        for retry in False, True:
+            connection = self._acquire(host)
+            try:
+                connection.request('GET', path or '/', headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                # A kept-alive connection might have been closed by the server.
+                self._release(host, connection, reuse=False)
+                if retry:
+                    raise IOError('Error fetching %s: %s' % (url, e))
+                continue
+            self._release(host, connection, reuse=not response.will_close)
+            with self.lock:
+                self.requests += 1
+            return response, body
+
+    def _check_status(self, url, response):
+        # Missing documents raise IOError with ENOENT, like missing files.
+        if response.status == httplib.NOT_FOUND:
+            raise IOError(errno.ENOENT, 'Error fetching %s: HTTP 404' % url)
+        if response.status != httplib.OK:
+            raise IOError('Error fetching %s: HTTP %d' % (url, response.status))
+
+    def _cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest())
+
+    def _write_cache(self, path, data):
+        temp = NamedTemporaryFile(dir=self.cache_dir, delete=False)
+        temp.write(data)
+        temp.close()
+        os.rename(temp.name, path)
+
+    def _known_validators(self, url):
+        """Returns ETag and Last-Modified of the copy seen last, or None."""
+        with self.lock:
+            validators = self.validators.get(url)
+        if validators is None and self.cache_dir is not None:
+            try:
+                with open(self._cache_path(url) + '.json') as f:
+                    meta = json.load(f)
+            except (IOError, ValueError):
+                pass
+            else:
+                validators = meta.get('etag'), meta.get('last_modified')
+        return validators
+
+    def _conditional_get(self, url, validators):
+        """Fetches a document, unless it matches the validators.
+
+        Returns its body, or None if it hasn't changed, and its
+        validators.
+        """
+        headers = {}
+        if validators is not None:
+            etag, last_modified = validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        response, body = self._get(url, headers)
+        if response.status == httplib.NOT_MODIFIED and headers:
+            with self.lock:
+                self.not_modified += 1
+            return None, validators
+        self._check_status(url, response)
+
+        validators = response.getheader('ETag'), response.getheader('Last-Modified')
+        if self.cache_dir is not None:
+            path = self._cache_path(url)
+            self._write_cache(path, body)
+            self._write_cache(path + '.json', json.dumps({
+                'etag': validators[0],
+                'last_modified': validators[1],
+            }))
+        with self.lock:
+            self.validators[url] = validators
+        return body, validators
+
+    def fetch(self, url):
+        """Returns the body of a document, revalidating the cached copy."""
+        if self.cache_dir is None:
+            return self._conditional_get(url, None)[0]
+        body, validators = self._conditional_get(url, self._known_validators(url))
+        if body is None:
+            path = self._cache_path(url)
+            try:
+                with open(path, 'rb') as f:
+                    body = f.read()
+            except IOError:
+                # Lost the body somehow, fetch it again.
+                with self.lock:
+                    self.validators.pop(url, None)
+                os.unlink(path + '.json')
+                return self.fetch(url)
+        return body
+
+    def bytes_by_slugs(self, slugs):
+        slugs = list(slugs)
+
+        def fetch(slug):
+            try:
+                return slug, self.fetch(self.url(slug))
+            except IOError, e:
+                # Missing documents are left out, like in other providers.
+                if e.errno != errno.ENOENT:
+                    raise
+                return slug, None
+
+        if len(slugs) > 1:
+            pool = ThreadPool(min(len(slugs), self.max_connections))
+            try:
+                results = pool.map(fetch, slugs)
+            finally:
+                pool.close()
+        else:
+            results = map(fetch, slugs)
+        return dict((slug, data) for slug, data in results if data is not None)
+
+    def bytes_by_slug(self, slug):
+        with self.lock:
+            data = self.fresh.pop(slug, None)
+        if data is None:
+            data = self._pop_prefetched(slug)
+        if data is not None:
+            return data
+        return self.fetch(self.url(slug))
+
+    def mtime_by_slug(self, slug):
+        url = self.url(slug)
+        body, validators = self._conditional_get(url, self._known_validators(url))
+        if body is not None:
+            # It's about to be parsed, don't fetch it again.
+            with self.lock:
+                self.fresh[slug] = body
+        etag, last_modified = validators
+        return etag or last_modified
+
+    def close(self):
+        """Closes all the idle connections."""
+        with self.lock:
+            for host, connections in self.idle.items():
+                for connection in connections:
+                    connection.close()
+                self.open_connections[host] -= len(connections)
+                del connections[:]
@@ -3,13 +3,17 @@
 # This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
 # Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
 #
-import copy
-from librarian import functions, OutputFile
+from librarian import functions, OutputFile, RDFNS, get_xslt
+from copy import deepcopy
 from lxml import etree
 import os
 
+STYLESHEET = os.path.join(os.path.dirname(__file__), 'xslt/book2txt.xslt')
+HEADER_TAGS = ('autor_utworu', 'dzielo_nadrzedne', 'nazwa_utworu', 'podtytul')
+# Text of these is put in the output as it is.
+RAW_TAGS = (RDFNS('RDF'), 'naglowek_listy')
+
 
-functions.reg_substitute_entities()
 functions.reg_wrap_words()
 functions.reg_strip()
 functions.reg_person_name()
@@ -35,20 +39,25 @@ def transform(wldoc, flags=None, **options):
     possible flags: raw-text,
     """
     # Parse XSLT
-    style_filename = os.path.join(os.path.dirname(__file__), 'xslt/book2txt.xslt')
-    style = etree.parse(style_filename)
+    style = get_xslt(STYLESHEET)
 
-    document = copy.deepcopy(wldoc)
+    document = wldoc.fork()
     del wldoc
-    document.swap_endlines()
-
-    if flags:
-        for flag in flags:
-            document.edoc.getroot().set(flag, 'yes')
     if 'wrapping' in options:
         options['wrapping'] = str(options['wrapping'])
 
-    result = document.transform(style, **options)
+    if document.is_lazy:
+        if flags:
+            for flag in flags:
+                document.skeleton.getroot().set(flag, 'yes')
+        result = transform_lazy(document, style, **options)
+    else:
+        document.swap_endlines()
+        functions.substitute_entities(document.edoc, exclude=RAW_TAGS)
+        if flags:
+            for flag in flags:
+                document.edoc.getroot().set(flag, 'yes')
+        result = document.transform(style, **options)
 
     if not flags or 'raw-text' not in flags:
         if document.book_info:
@@ -97,3 +106,46 @@ def transform(wldoc, flags=None, **options):
         result = unicode(result).encode('utf-8')
     return OutputFile.from_string("\r\n".join(result.splitlines()) + "\r\n")
 
+
+
+def transform_lazy(document, style, **options):
+    """Transforms a lazy document one top-level element at a time.
+
+    Output for every element of the main text doesn't depend on other
+    elements, so each one is transformed in a copy of the skeleton,
+    and the results are joined. The title header is made from the
+    skeleton and the top-level header elements.
+    """
+    skeleton = document.skeleton
+    main_text = document.main_text(skeleton)
+    rdf = skeleton.getroot().find('*')
+    ending = u'\n\n'
+
+    def shell():
+        root = etree.Element(skeleton.getroot().tag, skeleton.getroot().attrib,
+                             nsmap=skeleton.getroot().nsmap)
+        return root, etree.SubElement(root, main_text.tag, main_text.attrib)
+
+    # The header needs Dublin Core and header elements.
+    root, master = shell()
+    if rdf is not main_text:
+        root.insert(0, deepcopy(rdf))
+    master.extend(deepcopy(elem) for elem in main_text)
+    master.extend(document.iter_body(HEADER_TAGS))
+    functions.substitute_entities(root, exclude=RAW_TAGS)
+    output = [unicode(style(root.getroottree(), **options))[:-len(ending)]]
+
+    body_tags = set(document.body_tags()).difference(HEADER_TAGS)
+    for run in document.iter_body_runs(body_tags):
+        root, master = shell()
+        master.extend(run)
+        document.swap_endlines(master)
+        functions.substitute_entities(master, exclude=RAW_TAGS)
+        output.append(unicode(style(root.getroottree(), **options))[:-len(ending)])
+    output.append(ending)
+    return u''.join(output)
+
+
+def warmup(languages=()):
+    """Compiles the stylesheet."""
+    get_xslt(STYLESHEET)
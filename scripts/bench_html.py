@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""Measures HTML conversion time on a generated book.
+
+Usage: python scripts/bench_html.py [-p PARAGRAPHS] [-n RUNS] [-o FILE]
+
+The book has chapters with footnotes, themes, verses, mottos and
+editorial notes, so that all of the HTML post-processing gets used.
+"""
+from __future__ import with_statement
+
+import optparse
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lxml import etree
+from librarian import html
+from librarian.parser import WLDocument
+
+HEADER = u"""<?xml version="1.0" encoding="utf-8"?>
+<utwor><opowiadanie>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<rdf:Description rdf:about="http://redakcja.wolnelektury.pl/documents/book/bench/">
+<dc:creator xml:lang="pl">Fikcyjny, Adam</dc:creator>
+<dc:title xml:lang="pl">Książka testowa</dc:title>
+<dc:publisher xml:lang="pl">Fundacja Nowoczesna Polska</dc:publisher>
+<dc:subject.period xml:lang="pl">Pozytywizm</dc:subject.period>
+<dc:subject.type xml:lang="pl">Epika</dc:subject.type>
+<dc:subject.genre xml:lang="pl">Powieść</dc:subject.genre>
+<dc:identifier.url xml:lang="pl">http://wolnelektury.pl/katalog/lektura/bench</dc:identifier.url>
+<dc:rights xml:lang="pl">Domena publiczna</dc:rights>
+<dc:date xml:lang="pl">2010-01-01</dc:date>
+<dc:language xml:lang="pl">pol</dc:language>
+</rdf:Description>
+</rdf:RDF>
+<autor_utworu>Adam Fikcyjny</autor_utworu>
+<nazwa_utworu>Książka testowa</nazwa_utworu>
+<dedykacja>Dla <pa>Przypis w dedykacji.</pa>czytelników</dedykacja>
+<motto>Słowa motta<pe>Przypis w motcie.</pe></motto>
+<motto_podpis>Autor motta</motto_podpis>
+<nota_red><akap>Nota redakcyjna.</akap></nota_red>
+<lista_osob><naglowek_listy>Osoby</naglowek_listy>
+<lista_osoba>Pierwsza osoba</lista_osoba></lista_osob>
+"""
+
+FOOTER = u"""</opowiadanie></utwor>"""
+
+
+def make_book(paragraphs):
+    """Returns source of a book with the given number of paragraphs."""
+    parts = [HEADER]
+    for n in xrange(paragraphs):
+        if n % 200 == 0:
+            parts.append(u'<naglowek_czesc>Część %d<pa>Przypis %d.</pa></naglowek_czesc>\n' % (n, n))
+        if n % 50 == 0:
+            parts.append(u'<naglowek_rozdzial><begin id="b%d"/><motyw id="m%d">Temat %d</motyw>'
+                         u'Rozdział %d</naglowek_rozdzial>\n' % (n, n, n % 7, n))
+        if n % 25 == 10:
+            parts.append(u'<naglowek_podrozdzial>Podrozdział %d</naglowek_podrozdzial>\n' % n)
+        if n % 10 == 5:
+            parts.append(u'<strofa>Pierwszy wers,/\nDrugi wers,/\nTrzeci wers</strofa>\n')
+        # Footnote numbering makes the XSLT quadratic, so keep them few.
+        if n % 50 == 20:
+            footnote = u'<pa>Przypis do akapitu %d.</pa>' % n
+        else:
+            footnote = u''
+        parts.append(u'<akap>Akapit %d, --- w którym <wyroznienie>coś</wyroznienie> '
+                     u'się dzieje%s.</akap>\n' % (n, footnote))
+        if n % 50 == 49:
+            parts.append(u'<akap><end id="e%d"/></akap>\n' % (n - 49))
+    parts.append(FOOTER)
+    return u''.join(parts).encode('utf-8')
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.split('\n\n')[1])
+    parser.add_option('-p', '--paragraphs', type='int', dest='paragraphs',
+            default=10000, help='number of paragraphs in the book')
+    parser.add_option('-n', '--runs', type='int', dest='runs', default=5,
+            help='number of runs')
+    parser.add_option('-o', '--output', dest='output', metavar='FILE',
+            help='also save the generated book to FILE')
+    options, args = parser.parse_args()
+
+    source = make_book(options.paragraphs)
+    if options.output:
+        with open(options.output, 'wb') as f:
+            f.write(source)
+    doc = WLDocument.from_string(source)
+    style = html.get_xslt(html.get_stylesheet('legacy'))
+    document = doc.fork()
+    document.swap_endlines()
+    document.clean_ed_note()
+    html.functions.substitute_entities(document.edoc, exclude=html.RAW_TAGS)
+    rendered = etree.tostring(document.transform(style))
+
+    postprocess, total = [], []
+    for i in range(options.runs):
+        tree = etree.fromstring(rendered)
+        start = time.time()
+        html.add_anchors_and_tables(tree)
+        postprocess.append(time.time() - start)
+
+        start = time.time()
+        doc.as_html()
+        total.append(time.time() - start)
+
+    print '%d paragraphs' % options.paragraphs
+    print 'post-processing: %8.1f ms' % (min(postprocess) * 1000)
+    print 'whole transform: %8.1f ms' % (min(total) * 1000)
+
+
+if __name__ == '__main__':
+    main()
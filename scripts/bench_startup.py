@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""Measures startup time of the book2* scripts.
+
+Usage: python scripts/bench_startup.py [-n RUNS] [SOURCE]
+
+Each script is run with --help, or converts SOURCE if given, and the
+best and median wall times are printed.
+"""
+from __future__ import with_statement
+
+import optparse
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SCRIPTS = ('book2cover', 'book2epub', 'book2fb2', 'book2html',
+           'book2mobi', 'book2pdf', 'book2txt')
+
+
+def run_times(args, runs, env):
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.call(args, stdout=devnull, stderr=devnull, env=env)
+            times.append(time.time() - start)
+    return sorted(times)
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.split('\n\n')[1])
+    parser.add_option('-n', '--runs', type='int', dest='runs', default=10,
+            help='number of runs of each script')
+    options, args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [ROOT, env.get('PYTHONPATH')]))
+    output_dir = tempfile.mkdtemp('-librarian-bench')
+    try:
+        baseline = run_times([sys.executable, '-c', 'pass'], options.runs, env)
+        print '%-12s %8.1f ms' % ('python', baseline[0] * 1000)
+        for script in SCRIPTS:
+            cmd = [sys.executable, os.path.join(ROOT, 'scripts', script)]
+            if args:
+                cmd += ['-O', output_dir, args[0]]
+            else:
+                cmd.append('--help')
+            times = run_times(cmd, options.runs, env)
+            print '%-12s %8.1f ms  (median %.1f ms)' % (
+                script, times[0] * 1000, times[len(times) // 2] * 1000)
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+"""Measures line ending swapping and PDF tag insertion on long stanzas.
+
+Usage: python scripts/bench_verses.py [-v VERSES] [-s STANZAS] [-n RUNS] [-o FILE] [-c]
+
+Each stanza of the generated book has the given number of verses, with
+emphasis, hyphenated words and one-letter words in them, so that
+swap_endlines() and both of pdf.insert_tags() uses have work to do.
+
+With --compare, the old quadratic versions are run on the same books,
+for 1/8, 1/4, 1/2 and all of the verses, and the old to new time ratio
+is printed for each size.
+"""
+from __future__ import with_statement
+
+from copy import deepcopy
+import optparse
+import os.path
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lxml import etree
+
+from librarian import DCNS, pdf
+from librarian.parser import WLDocument
+
+HEADER = u"""<?xml version="1.0" encoding="utf-8"?>
+<utwor><liryka_l>
+<autor_utworu>Adam Fikcyjny</autor_utworu>
+<nazwa_utworu>Długie strofy</nazwa_utworu>
+"""
+
+FOOTER = u"""</liryka_l></utwor>"""
+
+
+def make_book(verses, stanzas):
+    """Returns source of a book with stanzas of the given length."""
+    parts = [HEADER]
+    for s in xrange(stanzas):
+        parts.append(u'<strofa>')
+        parts.append(u'/\n'.join(
+            u'Wers %d, w <wyroznienie>biało-czerwonym</wyroznienie> i szarym' % n
+            for n in xrange(verses)))
+        parts.append(u'</strofa>\n')
+    parts.append(FOOTER)
+    return u''.join(parts).encode('utf-8')
+
+
+# The versions from before the linear rewrite, for --compare. Each
+# <br/> or tag is inserted with insert(), which moves all the following
+# children, and found with index(), which walks them.
+def old_swap_endlines(edoc):
+    for elem in edoc.iter('strofa'):
+        for child in list(elem):
+            if child.tail:
+                chunks = WLDocument.LINE_SWAP_EXPR.split(child.tail)
+                ins_index = elem.index(child) + 1
+                while len(chunks) > 1:
+                    ins = etree.Element('br')
+                    ins.tail = chunks.pop()
+                    elem.insert(ins_index, ins)
+                child.tail = chunks.pop(0)
+        if elem.text:
+            chunks = WLDocument.LINE_SWAP_EXPR.split(elem.text)
+            while len(chunks) > 1:
+                ins = etree.Element('br')
+                ins.tail = chunks.pop()
+                elem.insert(0, ins)
+            elem.text = chunks.pop(0)
+
+
+def old_insert_tags(doc, split_re, tagname, exclude=None):
+    for elem in doc.iter(tag=etree.Element):
+        if exclude and elem.tag in exclude:
+            continue
+        if elem.text:
+            chunks = split_re.split(elem.text)
+            while len(chunks) > 1:
+                ins = etree.Element(tagname)
+                ins.tail = chunks.pop()
+                elem.insert(0, ins)
+            elem.text = chunks.pop(0)
+        if elem.tail:
+            chunks = split_re.split(elem.tail)
+            parent = elem.getparent()
+            ins_index = parent.index(elem) + 1
+            while len(chunks) > 1:
+                ins = etree.Element(tagname)
+                ins.tail = chunks.pop()
+                parent.insert(ins_index, ins)
+            elem.tail = chunks.pop(0)
+
+
+def old_substitute_hyphens(doc):
+    old_insert_tags(doc,
+                re.compile("(?<=[^-\s])-(?=[^-\s])"),
+                "dywiz",
+                exclude=[DCNS("identifier.url"), DCNS("rights.license")]
+                )
+
+
+def old_fix_hanging(doc):
+    old_insert_tags(doc,
+                re.compile("(?<=\s\w)\s+"),
+                "nbsp",
+                exclude=[DCNS("identifier.url"), DCNS("rights.license")]
+                )
+
+
+def best_time(func, make_arg, runs):
+    times = []
+    for i in range(runs):
+        arg = make_arg()
+        start = time.time()
+        func(arg)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def measure(source, runs, old=False):
+    """Returns best times of the three functions, new or old, on source."""
+    doc = WLDocument.from_string(source, parse_dublincore=False)
+    swapped = doc.fork()
+    swapped.swap_endlines()
+
+    if old:
+        swap = best_time(old_swap_endlines, lambda: deepcopy(doc.edoc), runs)
+        substitute_hyphens, fix_hanging = old_substitute_hyphens, old_fix_hanging
+    else:
+        def fork():
+            # Forks copy the tree on first use, which isn't to be measured.
+            document = doc.fork()
+            document.edoc
+            return document
+
+        swap = best_time(lambda document: document.swap_endlines(),
+                         fork, runs)
+        substitute_hyphens, fix_hanging = pdf.substitute_hyphens, pdf.fix_hanging
+    hyphens = best_time(substitute_hyphens,
+                        lambda: deepcopy(swapped.edoc), runs)
+    hanging = best_time(fix_hanging,
+                        lambda: deepcopy(swapped.edoc), runs)
+    return [('swap_endlines', swap), ('substitute_hyphens', hyphens),
+            ('fix_hanging', hanging)]
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.split('\n\n')[1])
+    parser.add_option('-v', '--verses', type='int', dest='verses',
+            default=8000, help='number of verses in a stanza')
+    parser.add_option('-s', '--stanzas', type='int', dest='stanzas',
+            default=1, help='number of stanzas')
+    parser.add_option('-n', '--runs', type='int', dest='runs', default=5,
+            help='number of runs')
+    parser.add_option('-o', '--output', dest='output', metavar='FILE',
+            help='also save the generated book to FILE')
+    parser.add_option('-c', '--compare', action='store_true', dest='compare',
+            default=False, help='also run the old quadratic versions')
+    options, args = parser.parse_args()
+
+    source = make_book(options.verses, options.stanzas)
+    if options.output:
+        with open(options.output, 'wb') as f:
+            f.write(source)
+
+    if not options.compare:
+        print '%d stanzas of %d verses' % (options.stanzas, options.verses)
+        for name, best in measure(source, options.runs):
+            print '%-19s %8.1f ms' % (name + ':', best * 1000)
+        return
+
+    print '%d stanzas of N verses, old and new times' % options.stanzas
+    print '%8s  %-19s %10s %10s %7s' % ('N', '', 'old', 'new', 'ratio')
+    for verses in sorted(set(max(options.verses // d, 1) for d in (8, 4, 2, 1))):
+        source = make_book(verses, options.stanzas)
+        new = measure(source, options.runs)
+        old = measure(source, options.runs, old=True)
+        for (name, new_best), (old_name, old_best) in zip(new, old):
+            print '%8d  %-19s %7.1f ms %7.1f ms %6.1fx' % (
+                verses, name, old_best * 1000, new_best * 1000,
+                old_best / max(new_best, 1e-6))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,8 +6,14 @@
 #
 import os
 import os.path
+import re
 from distutils.core import setup
 
+def get_version():
+    """Reads the version from librarian/__init__.py, without importing it."""
+    with open(os.path.join(os.path.dirname(__file__), 'librarian', '__init__.py')) as f:
+        return re.search(r"^__version__ = '([^']+)'", f.read(), re.M).group(1)
+
 def whole_tree(prefix, path):
     files = []
     for f in (f for f in os.listdir(os.path.join(prefix, path)) if not f[0]=='.'):
@@ -21,7 +27,7 @@ def whole_tree(prefix, path):
 
 setup(
     name='librarian',
-    version='1.6',
+    version=get_version(),
     description='Converter from WolneLektury.pl XML-based language to XHTML, TXT and other formats',
     author="Marek Stępniowski",
     author_email='marek@stepniowski.com',
@@ -46,6 +52,7 @@ setup(
              'scripts/book2partner',
              'scripts/book2cover',
              'scripts/bookfragments',
+             'scripts/bookannotations',
              'scripts/genslugs'],
     tests_require=['nose>=0.11', 'coverage>=3.0.1'],
 )
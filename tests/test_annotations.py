@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+from librarian.annotations import AnnotationIndex, get_headword
+from librarian.html import match_qualifiers
+from nose.tools import *
+
+
+BOOKS = {
+    'jeden': '<pe>Gemajna (daw., z niem. gemein) --- szeregowiec.</pe>'
+             '<pr>Kordelas --- krótka broń.</pr>',
+    'dwa': '<pe>Gemajna (daw., z niem. gemein) --- szeregowiec.</pe>'
+           '<pa>Przypis autorski.</pa>',
+}
+
+# Books that aren't valid WL documents.
+BAD_BOOKS = {
+    'zepsuty': '<utwor><opowiadanie><akap><pe>Niedomknięty</akap></opowiadanie></utwor>',
+    'dramat': '<dramat><akap>Tekst<pe>Przypis.</pe></akap></dramat>',
+}
+
+
+def write_book(dir_, slug, footnotes=None, source=None):
+    path = os.path.join(dir_, slug + '.xml')
+    if source is None:
+        source = ('<utwor><opowiadanie><akap>Tekst%s</akap></opowiadanie></utwor>'
+                  % footnotes)
+    with open(path, 'wb') as f:
+        f.write(source.encode('utf-8'))
+    return path
+
+
+def test_match_qualifiers():
+    eq_(match_qualifiers('daw.; z niem. gemein, nieznany, łac.'),
+        ['daw.', 'niem.', 'łac.'])
+    eq_(match_qualifiers('z mit. gr.'), ['mit.'])
+
+
+def test_headword():
+    eq_(get_headword('Gemajna (daw.) — szeregowiec.'), 'gemajna')
+    eq_(get_headword('a — b (c) — d'), 'a')
+    eq_(get_headword('Przypis autorski.'), None)
+
+
+def test_index():
+    dir_ = tempfile.mkdtemp('-librarian-test')
+    try:
+        ok_paths = [write_book(dir_, slug, footnotes)
+                    for slug, footnotes in BOOKS.items()]
+        bad_paths = [write_book(dir_, slug, source=source)
+                     for slug, source in BAD_BOOKS.items()]
+        index = AnnotationIndex(os.path.join(dir_, 'annotations.sqlite'))
+
+        for processes in 2, 1:
+            results = dict(index.update(ok_paths + bad_paths,
+                                        processes=processes, force=True))
+            eq_(len(results), 4)
+            for path in bad_paths:
+                assert_true(results[path])
+            for path in ok_paths:
+                eq_(results[path], None)
+        eq_(index.db.execute('SELECT COUNT(*) FROM annotation').fetchone()[0], 3)
+
+        found = index.lookup('GEMAJNA')
+        eq_(len(found), 1)
+        eq_(found[0][:3], ('pe', ['daw.', 'niem.'],
+                           'Gemajna (daw., z niem. gemein) — szeregowiec.'))
+        eq_(found[0][4], 2)
+
+        # Only the changed book is harvested again.
+        write_book(dir_, 'dwa', '<pr>Kordelas --- krótka broń.</pr>')
+        eq_([path for path, error in index.update(ok_paths)],
+            [os.path.join(dir_, 'dwa.xml')])
+        eq_(index.lookup('gemajna')[0][4], 1)
+        eq_(index.lookup('kordelas')[0][4], 2)
+        eq_(index.db.execute('SELECT COUNT(*) FROM annotation').fetchone()[0], 2)
+
+        index.remove('jeden')
+        eq_(index.lookup('gemajna'), [])
+        eq_(index.lookup('kordelas')[0][4], 1)
+        index.close()
+    finally:
+        shutil.rmtree(dir_)
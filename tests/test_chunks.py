@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+from lxml import etree
+from nose.tools import *
+from librarian import serialize_children
+from librarian.parser import WLDocument
+from utils import get_fixture
+
+
+def chunk_paths(doc):
+    """Paths to the elements outside Dublin Core, in the editor's format."""
+    paths = []
+    for elem in doc.edoc.getroot().iter(tag=etree.Element):
+        steps = []
+        while elem.getparent() is not None:
+            parent = elem.getparent()
+            position = list(parent.iterchildren(tag=etree.Element)).index(elem)
+            steps.insert(0, '%s[%d]' % (parent.xpath('name(*[%d])' % (position + 1)), position))
+            elem = parent
+        if ':' not in ''.join(steps):
+            paths.append('/'.join(['.', 'utwor'] + steps))
+            if steps:
+                paths.append('/'.join(steps))
+    return paths
+
+
+def test_get():
+    doc = WLDocument.from_file(get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml'))
+    index = doc.chunk_index()
+    paths = chunk_paths(doc) + [
+        'liryka_lp', 'liryka_lp/strofa', './utwor/liryka_lp', 'nothing',
+        'liryka_l[0]', 'liryka_lp[0]/strofa[99]', 'liryka_l/strofa/..']
+    for path in paths:
+        assert_true(index.get(path) is doc.chunk(path), path)
+    contents = index.serialize(paths)
+    for path in paths:
+        elem = doc.chunk(path)
+        assert_equal(contents[path],
+                     None if elem is None else serialize_children(elem))
+
+
+def test_merge():
+    path = get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml')
+    chunks = {
+        'liryka_lp[0]/strofa[3]': u'Nowa <i>strofa</i>/\nwers',
+        'liryka_lp[0]/strofa[4]': u'<niedomknięty>',
+        'liryka_lp[0]/strofa[99]': u'nic',
+    }
+    doc = WLDocument.from_file(path)
+    expected_doc = WLDocument.from_file(path)
+    expected = expected_doc.merge_chunks(chunks)
+    assert_equal(sorted(doc.chunk_index().merge(chunks)), sorted(expected))
+    assert_equal(len(expected), 2)
+    assert_equal(etree.tostring(doc.edoc), etree.tostring(expected_doc.edoc))
+
+
+def test_merge_nested():
+    doc = WLDocument.from_file(get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml'))
+    index = doc.chunk_index()
+    unmerged = index.merge({
+        'liryka_lp[0]': u'<strofa>Nowa strofa</strofa>',
+        'liryka_lp[0]/strofa[3]': u'Zmieniona',
+    })
+    assert_equal(len(unmerged), 1)
+    assert_true('liryka_lp[0]/strofa[3]' in unmerged[0])
+    assert_equal(index.serialize(['liryka_lp[0]/strofa[0]']).values(),
+                 [u'Nowa strofa'])
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+from __future__ import with_statement
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from lxml import etree
+from nose.tools import *
+from librarian.doccache import DocumentCache
+from librarian.parser import WLDocument
+from utils import get_fixture
+
+
+class TestDocumentCache(object):
+    def setUp(self):
+        self.dir = mkdtemp('-librarian-test')
+        self.cache = DocumentCache(self.dir)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_warm_load(self):
+        path = get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml')
+        cold = WLDocument.from_file(path, cache=self.cache)
+        warm = WLDocument.from_file(open(path), cache=self.cache)
+        assert_equal((self.cache.hits, self.cache.misses), (1, 1))
+        assert_equal(etree.tostring(warm.edoc), etree.tostring(cold.edoc))
+        assert_equal(warm.book_info.to_dict(), cold.book_info.to_dict())
+        assert_equal(warm.book_info.title.lang, cold.book_info.title.lang)
+        assert_equal(warm.as_text().get_string(), cold.as_text().get_string())
+
+    def test_options_in_key(self):
+        path = get_fixture('text', 'asnyk_miedzy_nami_nodc.xml')
+        doc = WLDocument.from_file(path, parse_dublincore=False, cache=self.cache)
+        assert_true(doc.book_info is None)
+        doc = WLDocument.from_file(path, parse_dublincore=False, cache=self.cache)
+        assert_true(doc.book_info is None)
+        assert_equal((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_disabled(self):
+        path = get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml')
+        WLDocument.cache = self.cache
+        try:
+            WLDocument.from_file(path, cache=False)
+            assert_equal(os.listdir(self.dir), [])
+            WLDocument.from_file(path)
+            assert_equal(len(os.listdir(self.dir)), 1)
+        finally:
+            WLDocument.cache = None
+
+    def test_eviction(self):
+        self.cache.max_size = 1
+        WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+                             cache=self.cache)
+        assert_equal(os.listdir(self.dir), [])
+
+    def test_broken_entry(self):
+        path = get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml')
+        cold = WLDocument.from_file(path, cache=self.cache)
+        entry = os.path.join(self.dir, os.listdir(self.dir)[0])
+        for data in 'WLC2<utwor>', 'WLC1\0\0\0\1x', '':
+            with open(entry, 'wb') as f:
+                f.write(data)
+            doc = WLDocument.from_file(path, cache=self.cache)
+            assert_equal(etree.tostring(doc.edoc), etree.tostring(cold.edoc))
+        assert_equal((self.cache.hits, self.cache.misses), (0, 4))
+        WLDocument.from_file(path, cache=self.cache)
+        assert_equal(self.cache.hits, 1)
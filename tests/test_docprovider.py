@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+import os
+import shutil
+from tempfile import mkdtemp
+from nose.tools import *
+from librarian import DirDocProvider, CachingDocProvider
+from librarian.parser import WLDocument
+from utils import get_fixture
+
+
+def test_caching_provider():
+    provider = CachingDocProvider(DirDocProvider(get_fixture('text', '')))
+    doc = WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+                               provider=provider)
+    editors = doc.editors()
+    assert_equal(doc.editors(), editors)
+    assert_equal((provider.hits, provider.misses), (2, 2))
+    parts = list(doc.parts())
+    assert_equal(len(parts), 2)
+    list(doc.parts())
+    assert_equal((provider.hits, provider.misses), (4, 4))
+
+    # Every caller gets a separate copy.
+    parts[0].edoc.getroot().set('modified', 'yes')
+    assert_equal(next(doc.parts()).edoc.getroot().get('modified'), None)
+
+
+def test_caching_provider_mtime():
+    tmpdir = mkdtemp('-librarian-test')
+    try:
+        path = os.path.join(tmpdir, 'part.xml')
+        shutil.copy(get_fixture('text', 'do-mlodych.xml'), path)
+        provider = CachingDocProvider(DirDocProvider(tmpdir), max_documents=1)
+        uri = 'http://wolnelektury.pl/katalog/lektura/part/'
+        provider.document_by_uri(uri, WLDocument)
+        provider.document_by_uri(uri, WLDocument)
+        mtime = os.path.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+        provider.document_by_uri(uri, WLDocument)
+        assert_equal((provider.hits, provider.misses), (1, 2))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_prefetch():
+    provider = CachingDocProvider(DirDocProvider(get_fixture('text', '')),
+                                  prefetch_workers=2)
+    try:
+        doc = WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+                                   provider=provider)
+        # Nothing is prefetched unless asked for.
+        assert_equal(provider.pending, {})
+        parts = doc.parts(prefetch=True)
+        first = next(parts)
+        assert_equal(len(provider.pending), 1)
+        titles = [first.book_info.title] + [part.book_info.title for part in parts]
+        assert_equal(titles, [part.book_info.title for part in
+            WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+                provider=DirDocProvider(get_fixture('text', ''))).parts()])
+        assert_equal(provider.pending, {})
+        assert_equal(provider.misses, 2)
+    finally:
+        provider.close()
+
+
+def test_prefetch_pending():
+    path = get_fixture('text', 'asnyk_zbior.xml')
+    uris = ['http://wolnelektury.pl/katalog/lektura/%s' % slug for slug in
+            ('do-mlodych', 'miedzy-nami-nic-nie-bylo', 'asnyk_zbior')]
+    provider = CachingDocProvider(DirDocProvider(get_fixture('text', '')),
+                                  prefetch_workers=2)
+    assert_equal(provider.max_documents, 16)
+    try:
+        # No more than prefetch_workers are parsed ahead.
+        provider.prefetch(uris, WLDocument)
+        assert_equal(len(provider.pending), 2)
+        assert_equal(len(provider.queue), 1)
+        provider.document_by_uri(uris[0], WLDocument)
+        assert_equal(len(provider.pending), 2)
+        assert_equal(len(provider.queue), 0)
+        provider.clear()
+        assert_equal(provider.pending, {})
+    finally:
+        provider.close()
+
+    # Documents parsed by then are kept when the threads are stopped.
+    provider = CachingDocProvider(DirDocProvider(get_fixture('text', '')),
+                                  prefetch_workers=2)
+    provider.prefetch(uris[:2], WLDocument)
+    provider.close()
+    assert_equal(provider.pending, {})
+    assert_equal(len(provider.documents), 2)
+    doc = WLDocument.from_file(path, provider=provider)
+    assert_equal(len(list(doc.parts())), 2)
+    assert_equal((provider.hits, provider.misses), (2, 2))
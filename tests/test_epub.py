@@ -29,3 +29,18 @@ def test_transform():
                 u'Opracowanie redakcyjne i przypisy: '
                 u'Adam Fikcyjny, Aleksandra Sekuła, Olga Sutkowska.')
     assert_true(editors_attribution)
+
+
+def test_parts_parsed_once():
+    class CountingProvider(DirDocProvider):
+        def document_by_uri(self, uri, doc_class, **kwargs):
+            self.requests.append((uri, kwargs.get('header_only', False)))
+            return DirDocProvider.document_by_uri(self, uri, doc_class, **kwargs)
+
+    provider = CountingProvider(get_fixture('text', ''))
+    provider.requests = []
+    WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+                         provider=provider).as_epub(flags=['without-fonts'])
+    parsed = [uri for uri, header_only in provider.requests if not header_only]
+    assert_equal(len(parsed), 2)
+    assert_equal(len(set(parsed)), 2)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+from librarian.parser import WLDocument
+from nose.tools import *
+from utils import get_fixture
+
+
+def check_transform(name):
+    fb2 = WLDocument.from_file(get_fixture('text', name + '.xml')).as_fb2().get_string()
+    assert_equal(fb2, open(get_fixture('text', name + '_expected.fb2')).read())
+
+
+def test_transform():
+    # Text copied outside of inline mode keeps its entities.
+    for name in 'entities', 'entities_dramat':
+        yield check_transform, name
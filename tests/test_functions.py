@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+from lxml import etree
+from nose.tools import *
+from librarian import functions, languages
+
+
+def test_substitute_entities():
+    tree = etree.XML(u'<a>,,A---b--c..."<b>x...</b>y--<c>,,z"</c>'
+                     u'<!-- ... --></a>')
+    functions.substitute_entities(tree, exclude=['c'])
+    assert_equal(etree.tostring(tree, encoding=unicode),
+                 u'<a>„A—b–c…”<b>x…</b>y–<c>,,z"</c><!-- ... --></a>')
+
+    tree = etree.XML(u'<a>a...<b>b...</b>c...<c>d...</c>-<d>e...<b>f</b>'
+                     u'g...</d></a>')
+    functions.substitute_entities(tree, exclude=['c'], raw=['d'],
+                                  raw_text=['a'])
+    assert_equal(etree.tostring(tree, encoding=unicode),
+                 u'<a><_raw converted="a…">a...</_raw><b>b…</b>'
+                 u'<_raw converted="c…">c...</_raw><c>d...</c>-'
+                 u'<d><_raw converted="e…">e...</_raw><b>f</b>'
+                 u'<_raw converted="g…">g...</_raw></d></a>')
+
+
+def test_lang_codes():
+    assert_equal(languages.lang_code_3to2('pol'), 'pl')
+    assert_equal(languages.lang_code_3to2('ger'), 'de')
+    assert_equal(languages.lang_code_3to2('deu'), 'de')
+    assert_equal(languages.lang_code_3to2('ace'), 'ace')
+    assert_equal(languages.lang_code_3to2('xxx'), 'xxx')
+    assert_equal(languages.lang_code_2to3('de'), 'ger')
+    assert_equal(languages.lang_code_2to3('de', terminologic=True), 'deu')
+    assert_equal(languages.lang_code_2to3('pl', terminologic=True), 'pol')
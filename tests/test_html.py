@@ -38,3 +38,23 @@ def test_empty():
             '<utwor />',
             parse_dublincore=False,
         ).as_html()
+
+
+def test_anchors_and_tables():
+    from lxml import etree
+    from librarian.html import add_anchors_and_tables
+    root = etree.XML(
+        '<div id="book-text">'
+        '<h2>Head<a class="annotation">[1]</a>er</h2>'
+        '<div class="paragraph">One</div>'
+        '<blockquote><div class="paragraph">Quoted</div></blockquote>'
+        '<h3><a class="theme-begin" name="m1">Love, Death</a>Sub</h3>'
+        '<div class="paragraph">Two</div>'
+        '<div id="footnotes"><h3>Footnotes</h3></div>'
+        '</div>')
+    add_anchors_and_tables(root)
+    assert_equal(root[0].get('id'), 'toc')
+    assert_equal([a.text for a in root[0].iter('a')], ['Header', 'Sub'])
+    assert_equal([a.get('href') for a in root[1].iter('a')], ['#m1', '#m1'])
+    assert_equal([a.get('name') for a in root.iter('a')
+                  if a.get('class') == 'target'], ['s1', 'f1', 's2', 'f2'])
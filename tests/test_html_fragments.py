@@ -18,3 +18,72 @@ def test_fragments():
                                     for f in closed_fragments.values())
     assert_equal(fragments_text, file(expected_output_file_path).read().decode('utf-8'))
 
+
+
+def test_overlapping_fragments():
+    from StringIO import StringIO
+    from librarian.html import iter_fragments
+    source = StringIO(
+        '<div id="book-text"><div class="stanza">'
+        '<a class="theme-begin" fid="1">A</a>one '
+        '<a class="theme-begin" fid="2">B</a>two<a class="theme-end" fid="1"/> '
+        'three</div><p>four</p>'
+        '<a class="theme-end" fid="2"/><a class="theme-begin" fid="3">C</a>five</div>')
+    fragments = list(iter_fragments(source))
+    assert_equal([(f.id, f.closed) for f in fragments],
+                 [('1', True), ('2', True), ('3', False)])
+    assert_equal(unicode(fragments[0]), u'<div class="stanza">one two</div>')
+    assert_equal(unicode(fragments[1]),
+                 u'<div class="stanza">two three</div><p >four</p>')
+
+
+def test_source_fragments():
+    from librarian.html import iter_source_fragments
+    from librarian.parser import WLDocument
+
+    closed_fragments, open_fragments = extract_fragments(
+        get_fixture('text', 'asnyk_miedzy_nami_expected.html'))
+    fragments = list(iter_source_fragments(WLDocument.from_file(
+        get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml'))))
+    assert_equal(sorted(f.id for f in fragments), sorted(closed_fragments))
+    for fragment in fragments:
+        assert_true(fragment.closed)
+        expected = closed_fragments[fragment.id]
+        assert_equal(fragment.themes, expected.themes)
+        assert_equal(unicode(fragment), unicode(expected))
+
+
+def test_source_fragment_ends_at_end():
+    from StringIO import StringIO
+    from librarian.html import iter_fragments, iter_source_fragments, transform
+    from librarian.parser import WLDocument
+
+    doc = WLDocument.from_string(
+        '<utwor><opowiadanie><akap>raz <begin id="b2"/><motyw id="m2">X</motyw>'
+        'dwa <wyroznienie>em<end id="e2"/>fa</wyroznienie> cztery</akap>'
+        '</opowiadanie></utwor>', parse_dublincore=False)
+    fragment, = iter_source_fragments(doc)
+    assert_equal(unicode(fragment),
+                 u'<p class="paragraph">dwa <em class="author-emphasis">em</em></p>\n')
+    # From HTML, the tail of the element the fragment ends in is kept.
+    html_fragment, = iter_fragments(StringIO(transform(doc).get_string()))
+    assert_equal(unicode(html_fragment),
+                 u'<p class="paragraph">dwa <em class="author-emphasis">em</em> cztery</p>\n')
+
+
+def test_source_fragments_skip_ed_note():
+    from StringIO import StringIO
+    from librarian.html import iter_fragments, iter_source_fragments, transform
+    from librarian.parser import WLDocument
+
+    doc = WLDocument.from_string(
+        '<utwor><opowiadanie><akap>raz <begin id="b1"/><motyw id="m1">X</motyw>'
+        'dwa<end id="e1"/></akap><nota_red><akap>trzy <begin id="b2"/>'
+        '<motyw id="m2">Y</motyw>cztery<end id="e2"/></akap>'
+        '<akap><begin id="b3"/><motyw id="m3">Z</motyw>pięć</akap></nota_red>'
+        '</opowiadanie></utwor>', parse_dublincore=False)
+    fragments = list(iter_source_fragments(doc))
+    html_fragments = list(iter_fragments(StringIO(transform(doc).get_string())))
+    assert_equal([(f.id, f.themes, f.closed) for f in fragments],
+                 [(f.id, f.themes, f.closed) for f in html_fragments])
+    assert_equal([f.id for f in fragments], ['1'])
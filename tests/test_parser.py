@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+import cPickle
+import re
+from StringIO import StringIO
+from lxml import etree
+from nose.tools import *
+import librarian
+from librarian import parser, ParseError, DirDocProvider, CachingDocProvider
+from librarian.parser import WLDocument
+from utils import get_fixture
+
+
+def test_load_paths_files_and_buffers():
+    path = get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml')
+    data = open(path, 'rb').read()
+    expected = etree.tostring(etree.parse(path))
+
+    for source in path, open(path), StringIO(data):
+        doc = WLDocument.from_file(source)
+        assert_equal(etree.tostring(doc.edoc), expected)
+    doc = WLDocument.from_bytes(bytearray(data))
+    assert_equal(etree.tostring(doc.edoc), expected)
+    assert_equal(doc.book_info.title, u'Między nami nic nie było')
+
+
+def test_load_parsed_tree():
+    tree = etree.parse(get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml'))
+    assert_true(WLDocument.from_file(tree).edoc is tree)
+
+
+def test_byte_order_marks():
+    doc = WLDocument.from_string(
+        u'﻿<utwor><akap>a﻿b</akap></utwor>', parse_dublincore=False)
+    assert_equal(doc.edoc.getroot()[0].text, u'ab')
+
+
+@raises(ParseError)
+def test_parse_error():
+    WLDocument.from_string('<utwor>', parse_dublincore=False)
+
+
+def test_parser_reuse_after_error():
+    try:
+        WLDocument.from_bytes(bytearray('<utwor><akap>'), parse_dublincore=False)
+    except ParseError:
+        pass
+    doc = WLDocument.from_bytes(bytearray('<utwor/>'), parse_dublincore=False)
+    assert_equal(doc.edoc.getroot().tag, 'utwor')
+
+
+def test_fork():
+    doc = WLDocument.from_file(get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml'))
+    original = etree.tostring(doc.edoc)
+
+    fork = doc.fork().fork()
+    assert_true(fork._edoc is None)
+    assert_true(fork.book_info is doc.book_info)
+    fork.swap_endlines()
+    fork.edoc.getroot().set('flag', 'yes')
+    assert_true(fork.edoc is not doc.edoc)
+    assert_true(fork.rdf_elem.getroottree().getroot() is fork.edoc.getroot())
+    assert_equal(etree.tostring(doc.edoc), original)
+    assert_not_equal(etree.tostring(fork.edoc), original)
+
+
+def test_swap_endlines():
+    doc = WLDocument.from_string(
+        '<utwor><strofa>a/\nb <i>c</i>/\n<i>d</i> e/\nf</strofa></utwor>',
+        parse_dublincore=False)
+    doc.swap_endlines()
+    assert_equal(etree.tostring(doc.edoc),
+        '<utwor><strofa>a<br/>b <i>c</i><br/><i>d</i> e<br/>f</strofa></utwor>')
+
+
+def test_swap_endlines_long_stanza():
+    verses = 5000
+    doc = WLDocument.from_string(
+        '<utwor><strofa>%s</strofa></utwor>' % '/\n'.join(
+            'verse <i>%d</i>' % i for i in range(verses)),
+        parse_dublincore=False)
+    doc.swap_endlines()
+    stanza = doc.edoc.getroot()[0]
+    assert_equal(len(stanza.findall('br')), verses - 1)
+    assert_equal([e.tag for e in stanza[:4]], ['i', 'br', 'i', 'br'])
+    assert_equal(stanza[1].tail, 'verse ')
+
+
+def test_lazy():
+    for fixture in 'miedzy-nami-nic-nie-bylo.xml', 'do-mlodych.xml':
+        path = get_fixture('text', fixture)
+        full = WLDocument.from_file(path)
+        doc = WLDocument.from_file(path, lazy=True)
+        assert_true(doc.is_lazy)
+        assert_equal(doc.book_info.title, full.book_info.title)
+        # The skeleton's main text holds Dublin Core at most.
+        assert_true(len(doc.main_text(doc.skeleton)) <= 1)
+        assert_equal(doc.body_tags(), full.body_tags())
+        assert_equal([etree.tostring(node) for node in doc.iter_body()],
+                     [etree.tostring(node) for node in full.iter_body()])
+        assert_equal(doc.as_text().get_string(), full.as_text().get_string())
+        assert_true(doc.is_lazy)
+
+        # Using the whole tree parses it, keeping the root's attributes.
+        doc.skeleton.getroot().set('flag', 'yes')
+        full.edoc.getroot().set('flag', 'yes')
+        assert_equal(etree.tostring(doc.edoc), etree.tostring(full.edoc))
+        assert_false(doc.is_lazy)
+
+
+def test_lazy_without_main_text():
+    mapped = []
+
+    def map_xml_file(source):
+        mapped.append(librarian.map_xml_file(source))
+        return mapped[-1]
+
+    parser.map_xml_file = map_xml_file
+    try:
+        doc = WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+                                   lazy=True)
+        assert_raises(librarian.NoDublinCore, WLDocument.from_file,
+                      get_fixture('text', 'asnyk_miedzy_nami_nodc.xml'),
+                      incremental=True)
+    finally:
+        parser.map_xml_file = librarian.map_xml_file
+    assert_false(doc.is_lazy)
+    assert_equal(doc.body_tags(), [])
+    # Fully parsed, so the mapped files are closed.
+    for data in mapped:
+        assert_raises(ValueError, data.size)
+
+
+def test_header_only():
+    provider = DirDocProvider(get_fixture('text', ''))
+    doc = WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+                               provider=provider, header_only=True)
+    assert_true(doc._edoc is None)
+    full = WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+                                provider=provider)
+    assert_equal(doc.editors(), full.editors())
+    for part, full_part in zip(doc.parts(), full.parts()):
+        assert_true(part.header_only)
+        assert_equal(part.book_info.title, full_part.book_info.title)
+
+        # Using the tree parses the rest.
+        assert_true(part._edoc is None)
+        assert_equal(etree.tostring(part.edoc), etree.tostring(full_part.edoc))
+
+
+def test_fingerprint():
+    path = get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml')
+    data = open(path, 'rb').read()
+    doc = WLDocument.from_bytes(data)
+    fingerprint = doc.fingerprint()
+    assert_equal(len(doc.chunk_fingerprints()), len(doc.body_tags()))
+    assert_equal(WLDocument.from_bytes(data, lazy=True).fingerprint(),
+                 fingerprint)
+    assert_not_equal(doc.fingerprint(['flag']), fingerprint)
+
+    # Whitespace, comments and the order of Dublin Core don't count.
+    reformatted = data.replace('\n', '\n  ').replace(
+        '<dc:title', '<!-- title --><dc:title')
+    title = re.search(r'\s*<dc:title.*?</dc:title>', reformatted).group()
+    reformatted = reformatted.replace(title, '').replace(
+        '</rdf:Description>', title + '</rdf:Description>')
+    assert_equal(WLDocument.from_bytes(reformatted).fingerprint(), fingerprint)
+
+    changed = WLDocument.from_bytes(data.replace('<strofa>', '<strofa>X', 1))
+    assert_not_equal(changed.fingerprint(), fingerprint)
+    assert_equal(len([1 for a, b in zip(changed.chunk_fingerprints(),
+                                        doc.chunk_fingerprints()) if a != b]), 1)
+
+
+def test_fingerprint_after_edits():
+    path = get_fixture('text', 'do-mlodych.xml')
+    data = open(path, 'rb').read()
+    key = 'liryka_l[1]/strofa[2]'
+    for edit in (lambda doc: doc.merge_chunks({key: u'Nowa strofa'}),
+                 lambda doc: doc.chunk_index().merge({key: u'Nowa strofa'})):
+        doc = WLDocument.from_bytes(data)
+        fingerprint = doc.fingerprint()
+        chunks = doc.chunk_fingerprints()
+        assert_equal(edit(doc), [])
+        assert_not_equal(doc.fingerprint(), fingerprint)
+        assert_not_equal(doc.chunk_fingerprints(), chunks)
+        reopened = WLDocument.from_bytes(doc.serialize().encode('utf-8'))
+        assert_equal(doc.fingerprint(), reopened.fingerprint())
+
+    doc = WLDocument.from_bytes(data)
+    fingerprint = doc.fingerprint()
+    doc.swap_endlines()
+    assert_not_equal(doc.fingerprint(), fingerprint)
+
+
+def test_fingerprint_parts():
+    provider = DirDocProvider(get_fixture('text', ''))
+    doc = WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+                               provider=provider)
+    fingerprint = doc.fingerprint()
+
+    class ChangedProvider(DirDocProvider):
+        def by_slug(self, slug):
+            data = DirDocProvider.by_slug(self, slug).read()
+            return StringIO(data.replace('<strofa>', '<strofa>X', 1))
+
+    changed = WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+        provider=ChangedProvider(get_fixture('text', '')))
+    assert_not_equal(changed.fingerprint(), fingerprint)
+
+
+def test_serialize_incremental():
+    path = get_fixture('text', 'do-mlodych.xml')
+    data = open(path, 'rb').read()
+    doc = WLDocument.from_file(path, incremental=True)
+    assert_equal(doc.serialize_incremental(), data)
+
+    assert_equal(doc.merge_chunks({'liryka_l[1]/strofa[2]': u'Nowa strofa'}), [])
+    output = doc.serialize_incremental()
+    start = data.index('<strofa>')
+    end = data.index('</strofa>') + len('</strofa>')
+    assert_equal(output, data[:start] + '<strofa>Nowa strofa</strofa>' + data[end:])
+
+    doc.book_info.title = u'Inny tytuł'
+    output = doc.serialize_incremental()
+    assert_true(output.endswith(data[data.index('</rdf:RDF>') + len('</rdf:RDF>'):]
+                                .replace(data[start:end], '<strofa>Nowa strofa</strofa>')))
+    changed = WLDocument.from_string(output)
+    assert_equal(changed.book_info.title, u'Inny tytuł')
+    assert_equal(changed.chunk('liryka_l[1]/strofa[2]').text, u'Nowa strofa')
+
+    # Without the source, the whole document is serialized.
+    doc = WLDocument.from_file(path)
+    assert_equal(doc.serialize_incremental(), doc.serialize().encode('utf-8'))
+
+
+def test_serialize_incremental_direct_edits():
+    path = get_fixture('text', 'do-mlodych.xml')
+    data = open(path, 'rb').read()
+
+    doc = WLDocument.from_file(path, incremental=True)
+    doc.chunk('liryka_l[1]/strofa[2]').text = u'EDITED DIRECTLY'
+    output = doc.serialize_incremental()
+    start = data.index('<strofa>')
+    end = data.index('</strofa>') + len('</strofa>')
+    assert_equal(output, data[:start] + '<strofa>EDITED DIRECTLY</strofa>' + data[end:])
+
+    doc = WLDocument.from_file(path, incremental=True)
+    doc.swap_endlines()
+    output = doc.serialize_incremental()
+    assert_not_equal(output, data)
+    assert_equal(etree.tostring(WLDocument.from_string(output).edoc),
+                 etree.tostring(doc.edoc))
+
+    # Changes outside of what can be spliced in.
+    for edit in (lambda doc: setattr(doc.chunk('liryka_l[1]/strofa[2]'), 'tail', u'X'),
+                 lambda doc: doc.edoc.getroot().set('flaga', 'tak'),
+                 lambda doc: setattr(doc.main_text(), 'text', u'X')):
+        doc = WLDocument.from_file(path, incremental=True)
+        edit(doc)
+        assert_equal(doc.serialize_incremental(), doc.serialize().encode('utf-8'))
+
+
+def test_pickle():
+    provider = CachingDocProvider(DirDocProvider(get_fixture('text', '')))
+    path = get_fixture('text', 'asnyk_zbior.xml')
+    full = WLDocument.from_file(path, provider=provider)
+    for kwargs in {}, {'lazy': True}, {'header_only': True}:
+        doc = WLDocument.from_file(path, provider=provider, **kwargs)
+        copy = cPickle.loads(cPickle.dumps(doc, cPickle.HIGHEST_PROTOCOL))
+        assert_equal(copy.header_only, doc.header_only)
+        assert_equal(copy.is_lazy, doc.is_lazy)
+        assert_equal(copy.book_info.to_dict(), doc.book_info.to_dict())
+        assert_equal([part.book_info.title for part in copy.parts()],
+                     [part.book_info.title for part in full.parts()])
+        assert_equal(etree.tostring(copy.edoc), etree.tostring(full.edoc))
+
+    doc = WLDocument.from_file(get_fixture('text', 'do-mlodych.xml'))
+    copy = cPickle.loads(cPickle.dumps(doc.fork(), cPickle.HIGHEST_PROTOCOL))
+    assert_equal(copy.book_info.released_to_public_domain_at.lang, u'pl')
+    assert_equal(copy.as_text().get_string(), doc.as_text().get_string())
@@ -3,11 +3,17 @@
 # This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
 # Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
 #
+import os
 import re
+import shutil
+import sys
+import types
 from tempfile import NamedTemporaryFile
+from lxml import etree
 from nose.tools import *
-from librarian import DirDocProvider
+from librarian import DirDocProvider, CachingDocProvider
 from librarian.parser import WLDocument
+from librarian.pdf import load_including_children, mark_aliens
 from utils import get_fixture
 
 
@@ -26,3 +32,88 @@ def test_transform():
         ur'Opracowanie redakcyjne i przypisy: ([^}]*?)\.\s*\}', tex)
     assert_equal(editors.group(1),
         u"Adam Fikcyjny, Aleksandra Sekuła, Olga Sutkowska")
+
+
+def test_load_parts_through_provider():
+    class RecordingProvider(CachingDocProvider):
+        def document_by_uri(self, uri, doc_class, **kwargs):
+            self.requests.append(kwargs)
+            return CachingDocProvider.document_by_uri(self, uri, doc_class, **kwargs)
+
+    provider = RecordingProvider(DirDocProvider(get_fixture('text', '')))
+    provider.requests = []
+    doc = WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+                               provider=provider)
+    for i in range(2):
+        document = load_including_children(doc)
+        eq_(provider.requests, [{}, {}])
+        provider.requests = []
+    eq_((provider.hits, provider.misses), (2, 2))
+
+    # Editors are read from Dublin Core only.
+    document.editors()
+    eq_(provider.requests, [{'header_only': True}] * 2)
+
+
+def test_mark_aliens():
+    root = etree.fromstring(
+        u'<strofa>Привет, <i>мир</i> i Ж/\nДа</strofa>'.encode('utf-8'))
+    mark_aliens(root)
+    eq_(etree.tostring(root, encoding=unicode),
+        u'<strofa><alien>Привет</alien>, <i><alien>мир</alien></i> i '
+        u'<alien>Ж</alien>/\n<alien>Да</alien></strofa>')
+
+
+class StopAtTeXML(Exception):
+    pass
+
+
+def get_texml(wldoc, **kwargs):
+    """Runs pdf.transform with Texml stubbed, up to where xelatex would run."""
+    output = []
+
+    def process(f, fout, encoding):
+        output.append(f.read())
+        shutil.rmtree(os.path.dirname(fout.name))
+        raise StopAtTeXML
+
+    texml = types.ModuleType('Texml')
+    texml.processor = types.ModuleType('Texml.processor')
+    texml.processor.process = process
+    saved = dict((name, sys.modules.get(name)) for name in ('Texml', 'Texml.processor'))
+    sys.modules.update({'Texml': texml, 'Texml.processor': texml.processor})
+    try:
+        wldoc.as_pdf(morefloats='new', **kwargs)
+    except StopAtTeXML:
+        pass
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+    return output[0]
+
+
+def normalize_texml(text):
+    """Drops formatting, and TeXML elements wrapping separately rendered parts."""
+    tree = etree.fromstring(text.split('?>', 1)[1],
+                            etree.XMLParser(remove_blank_text=True))
+    for element in tree.iterdescendants('{http://getfo.sourceforge.net/texml/ns1}TeXML'):
+        if not element.attrib:
+            element.tag = 'unwrap'
+    etree.strip_tags(tree, 'unwrap')
+    etree.cleanup_namespaces(tree)
+    return etree.tostring(tree, encoding=unicode)
+
+
+def test_transform_streaming():
+    texml = {}
+    for streaming in False, True:
+        doc = WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+            provider=DirDocProvider(get_fixture('text', '')))
+        texml[streaming] = get_texml(doc, streaming=streaming)
+    assert_not_equal(texml[True], texml[False])
+    text = normalize_texml(texml[False])
+    assert_true(u'W ciemnościach pogasną znów!' in text)
+    assert_equal(normalize_texml(texml[True]), text)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import cPickle
+import hashlib
+import os
+import shutil
+from SocketServer import ThreadingMixIn
+import threading
+import zipfile
+from tempfile import mkdtemp
+from nose.tools import *
+from librarian import DirDocProvider, CachingDocProvider
+from librarian.parser import WLDocument
+from librarian.providers import ZipDocProvider, SQLiteDocProvider, HTTPDocProvider
+from utils import get_fixture, get_all_fixtures
+
+
+def check_provider(provider):
+    assert_true('asnyk_zbior' in provider.slugs())
+    assert_equal(provider.by_slug('do-mlodych').read(),
+                 open(get_fixture('text', 'do-mlodych.xml'), 'rb').read())
+    assert_raises(IOError, provider.by_slug, 'nonexistent')
+    files = provider.by_slugs(['asnyk_zbior', 'do-mlodych', 'nonexistent'])
+    assert_equal(sorted(files), ['asnyk_zbior', 'do-mlodych'])
+
+    doc = WLDocument.from_file(files['asnyk_zbior'], provider=provider)
+    expected = WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+                provider=DirDocProvider(get_fixture('text', '')))
+    assert_equal(doc.editors(), expected.editors())
+    assert_equal([part.book_info.title for part in doc.parts()],
+                 [part.book_info.title for part in expected.parts()])
+
+    # A pickled provider is opened again.
+    copy = cPickle.loads(cPickle.dumps(provider, cPickle.HIGHEST_PROTOCOL))
+    try:
+        assert_equal(copy.by_slug('do-mlodych').read(),
+                     provider.by_slug('do-mlodych').read())
+    finally:
+        copy.close()
+
+
+class TestCorpusProviders(object):
+    def setUp(self):
+        self.dir = mkdtemp('-librarian-test')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_zip(self):
+        path = os.path.join(self.dir, 'corpus.zip')
+        zipf = zipfile.ZipFile(path, 'w')
+        for i, fixture in enumerate(get_all_fixtures('text', '*.xml')):
+            zipf.write(fixture, 'corpus/' + os.path.basename(fixture),
+                       (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)[i % 2])
+        zipf.close()
+        provider = ZipDocProvider(path)
+        try:
+            check_provider(provider)
+        finally:
+            provider.close()
+
+    def test_zip_duplicates(self):
+        path = os.path.join(self.dir, 'corpus.zip')
+        zipf = zipfile.ZipFile(path, 'w')
+        for dir_ in 'a', 'b':
+            zipf.write(get_fixture('text', 'do-mlodych.xml'), dir_ + '/do-mlodych.xml')
+        zipf.close()
+        assert_raises(IOError, ZipDocProvider, path)
+
+    def test_prefetch_parts(self):
+        class BulkProvider(SQLiteDocProvider):
+            def bytes_by_slugs(self, slugs):
+                self.requests.append(sorted(slugs))
+                return SQLiteDocProvider.bytes_by_slugs(self, slugs)
+
+        provider = BulkProvider(os.path.join(self.dir, 'corpus.sqlite'))
+        try:
+            provider.import_files(get_all_fixtures('text', '*.xml'))
+            provider.requests = []
+            doc = WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+                                       provider=provider)
+            titles = [part.book_info.title for part in doc.parts(prefetch=True)]
+            assert_equal(len(titles), 2)
+            # Both parts were fetched at once.
+            assert_equal(len(provider.requests), 1)
+            assert_equal(len(provider.requests[0]), 2)
+        finally:
+            provider.close()
+
+    def test_sqlite(self):
+        provider = SQLiteDocProvider(os.path.join(self.dir, 'corpus.sqlite'))
+        try:
+            provider.import_files(get_all_fixtures('text', '*.xml'))
+            check_provider(provider)
+        finally:
+            provider.close()
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests += 1
+        name = os.path.basename(self.path)
+        path = os.path.join(self.server.root, name)
+        if name == 'error.xml':
+            status = 500
+        elif not os.path.isfile(path):
+            status = 404
+        else:
+            status = None
+        if status:
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = open(path, 'rb').read()
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FixtureServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+    requests = 0
+    root = get_fixture('text', '')
+
+
+class TestHTTPDocProvider(object):
+    def setUp(self):
+        self.dir = mkdtemp('-librarian-test')
+        self.server = FixtureServer(('127.0.0.1', 0), FixtureHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/%%s.xml' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def test_http(self):
+        provider = HTTPDocProvider(self.url, cache_dir=self.dir, max_connections=1)
+        assert_equal(provider.by_slug('do-mlodych').read(),
+                     open(get_fixture('text', 'do-mlodych.xml'), 'rb').read())
+        assert_raises(IOError, provider.by_slug, 'nonexistent')
+        files = provider.by_slugs(['asnyk_zbior', 'do-mlodych', 'nonexistent'])
+        assert_equal(sorted(files), ['asnyk_zbior', 'do-mlodych'])
+
+        doc = WLDocument.from_file(files['asnyk_zbior'], provider=provider)
+        expected = WLDocument.from_file(get_fixture('text', 'asnyk_zbior.xml'),
+                    provider=DirDocProvider(get_fixture('text', '')))
+        assert_equal(doc.editors(), expected.editors())
+        provider.close()
+        # All requests went through one kept-alive connection.
+        assert_equal(self.server.connections, 1)
+        assert_true(self.server.requests > 4)
+
+        # A fresh provider revalidates the cached copies.
+        provider = HTTPDocProvider(self.url, cache_dir=self.dir)
+        assert_equal(provider.by_slug('asnyk_zbior').read(),
+                     open(get_fixture('text', 'asnyk_zbior.xml'), 'rb').read())
+        assert_equal(provider.not_modified, 1)
+        provider.close()
+
+    def test_missing_and_errors(self):
+        provider = HTTPDocProvider(self.url)
+        try:
+            files = provider.by_slugs(['do-mlodych', 'nonexistent'])
+            assert_equal(sorted(files), ['do-mlodych'])
+            # Other errors aren't mistaken for missing documents.
+            assert_raises(IOError, provider.by_slugs, ['do-mlodych', 'error'])
+            assert_raises(IOError, provider.mtime_by_slug, 'error')
+        finally:
+            provider.close()
+
+    def test_caching_revalidation(self):
+        self.server.root = os.path.join(self.dir, 'root')
+        os.mkdir(self.server.root)
+        path = os.path.join(self.server.root, 'part.xml')
+        shutil.copy(get_fixture('text', 'do-mlodych.xml'), path)
+        uri = 'http://wolnelektury.pl/katalog/lektura/part/'
+
+        provider = CachingDocProvider(HTTPDocProvider(self.url))
+        try:
+            # Every lookup takes one request.
+            provider.document_by_uri(uri, WLDocument)
+            assert_equal(self.server.requests, 1)
+            provider.document_by_uri(uri, WLDocument)
+            assert_equal((provider.hits, provider.misses), (1, 1))
+            assert_equal(self.server.requests, 2)
+            assert_equal(provider.provider.not_modified, 1)
+            shutil.copy(get_fixture('text', 'miedzy-nami-nic-nie-bylo.xml'), path)
+            doc = provider.document_by_uri(uri, WLDocument)
+            assert_equal((provider.hits, provider.misses), (1, 2))
+            assert_equal(self.server.requests, 3)
+            assert_equal(doc.book_info.title, u'Między nami nic nie było')
+        finally:
+            provider.provider.close()
+
+    def test_no_cache(self):
+        provider = HTTPDocProvider(self.url)
+        assert_equal(provider.by_slug('do-mlodych').read(),
+                     open(get_fixture('text', 'do-mlodych.xml'), 'rb').read())
+        assert_equal(provider.by_slug('do-mlodych').read(),
+                     open(get_fixture('text', 'do-mlodych.xml'), 'rb').read())
+        assert_equal(provider.not_modified, 0)
+        provider.close()
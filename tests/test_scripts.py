@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+import os
+from os.path import abspath, dirname, join
+import subprocess
+import sys
+from nose.tools import *
+
+ROOT = abspath(join(dirname(__file__), '..'))
+
+# Loaded only when a conversion needs them.
+LAZY_MODULES = ('PIL', 'Texml', 'multiprocessing.pool', 'librarian.cover',
+                'librarian.hyphenator', 'librarian.epub', 'librarian.pdf',
+                'librarian.html', 'librarian.text', 'librarian.fb2')
+
+LOAD_SCRIPT = """import imp, sys
+imp.load_source('book2script', sys.argv[1])
+print '\\n'.join(sys.modules)
+"""
+
+
+def loaded_modules(script):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.check_output(
+        [sys.executable, '-c', LOAD_SCRIPT, join(ROOT, 'scripts', script)],
+        env=env)
+    return set(output.split())
+
+
+def test_lazy_imports():
+    for script in ('book2cover', 'book2epub', 'book2fb2', 'book2html',
+                   'book2mobi', 'book2pdf', 'book2txt'):
+        modules = loaded_modules(script)
+        for name in LAZY_MODULES:
+            assert_false(name in modules, '%s loads %s' % (script, name))
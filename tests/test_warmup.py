@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+from nose.tools import *
+import librarian
+from librarian import XSLT_CACHE, get_resource, hyphenator
+
+
+def test_warmup():
+    librarian.warmup(['html', 'txt', 'epub'], languages=['pol'])
+    misses = XSLT_CACHE.misses
+    from librarian import epub, html, text
+    for sheet in epub.STYLESHEETS:
+        XSLT_CACHE.get(get_resource(sheet))
+    XSLT_CACHE.get(html.get_stylesheet('legacy'))
+    XSLT_CACHE.get(text.STYLESHEET)
+    assert_equal(XSLT_CACHE.misses, misses)
+    assert_true(get_resource('res/hyph-dictionaries/hyph_pl.dic')
+                in hyphenator.hdcache)
+    assert_true(epub.get_hyphenator('pl').hd is epub.get_hyphenator('pol').hd)
+
+
+
+def test_cover_warmup():
+    from librarian import cover, pdf
+    from librarian.cover import DefaultEbookCover
+    pdf.warmup()
+    # Fonts are loaded at the size they're used for the PDF cover.
+    bound = DefaultEbookCover(librarian.DEFAULT_BOOKINFO, width=pdf.COVER_WIDTH)
+    metr = cover.Metric(bound, bound.scale)
+    assert_not_equal(metr.title_font_size, DefaultEbookCover.title_font_size)
+    assert_true((bound.author_font_ttf, metr.author_font_size) in cover._fonts)
+    assert_true((bound.title_font_ttf, metr.title_font_size) in cover._fonts)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Librarian, licensed under GNU Affero GPLv3 or later.
+# Copyright © Fundacja Nowoczesna Polska. See NOTICE for more information.
+#
+import os
+from tempfile import NamedTemporaryFile
+from lxml import etree
+from nose.tools import *
+from librarian import XSLTCache
+
+STYLESHEET = """<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+<xsl:template match="/"><out>%s</out></xsl:template>
+</xsl:stylesheet>"""
+
+
+def test_cache():
+    temp = NamedTemporaryFile(suffix='.xslt', delete=False)
+    temp.write(STYLESHEET % 'one')
+    temp.close()
+    try:
+        cache = XSLTCache()
+        xslt = cache.get(temp.name)
+        assert_true(isinstance(xslt, etree.XSLT))
+        assert_true(cache.get(temp.name) is xslt)
+        assert_equal((cache.hits, cache.misses), (1, 1))
+
+        # Changed files get recompiled.
+        with open(temp.name, 'w') as f:
+            f.write(STYLESHEET % 'two')
+        mtime = os.path.getmtime(temp.name) + 10
+        os.utime(temp.name, (mtime, mtime))
+        result = cache.get(temp.name)(etree.XML('<a/>'))
+        assert_equal(result.getroot().text, 'two')
+        assert_equal(cache.stats(), {'hits': 1, 'misses': 2, 'size': 1})
+    finally:
+        os.unlink(temp.name)